@@ -1,7 +1,9 @@
 import sys
 import time
+from concurrent.futures import ThreadPoolExecutor
 from opcua import ua, Server, uamethod
 from opcua.server.history_sql import HistorySQLite
+from opcua.server.history_segments import HistorySegments
 
 sys.path.insert(0, "..")
 
@@ -107,6 +109,8 @@ if __name__ == "__main__":
 
     server = Server()
     server.set_endpoint("opc.tcp://0.0.0.0:4840/connected-factory/server/")
+    # robot commands sleep while the arm moves, do not block other clients meanwhile
+    server.set_method_executor(ThreadPoolExecutor(max_workers=4))
 
     uri = "https://github.com/thegazou/connected-factory"
     idx = server.register_namespace(uri)
@@ -150,7 +154,13 @@ if __name__ == "__main__":
     trigger_event = robot.add_variable(idx, "Trigger Event", False)
     trigger_event.set_writable()
 
-    server.iserver.history_manager.set_storage(HistorySQLite("temp_sensor_history.sql"))
+    if "--segments" in sys.argv[1:]:
+        # append samples to segment files instead, history of the .sql file is not imported
+        server.iserver.history_manager.set_storage(HistorySegments("temp_sensor_history"))
+    else:
+        # buffer samples and write them in one transaction every second
+        server.iserver.history_manager.set_storage(HistorySQLite("temp_sensor_history.sql", max_batch=500,
+                                                                 flush_interval=1))
 
     server.start()
     server.historize_node_data_change(temp_sensor, period=None, count=100)
@@ -0,0 +1,71 @@
+"""
+Measure Read throughput of MultiProcessServer for an increasing number of
+worker processes. Every client process opens its own connection and reads
+one variable in a loop, the kernel spreads the connections over the workers.
+
+usage: python server-multiprocess-benchmark.py [max_workers] [clients] [duration]
+"""
+import sys
+sys.path.insert(0, "..")
+import os
+import time
+import multiprocessing
+
+from opcua import ua, Client
+from opcua.server.multiprocess import MultiProcessServer
+
+
+ENDPOINT = "opc.tcp://127.0.0.1:48410/freeopcua/server/"
+URI = "http://examples.freeopcua.github.io"
+
+
+def setup(server):
+    idx = server.register_namespace(URI)
+    myobj = server.get_objects_node().add_object(idx, "MyObject")
+    myobj.add_variable(ua.NodeId("MyVariable", idx), "MyVariable", 6.7)
+
+
+def read_loop(duration, results):
+    client = Client(ENDPOINT)
+    client.connect()
+    try:
+        idx = client.get_namespace_index(URI)
+        var = client.get_node(ua.NodeId("MyVariable", idx))
+        count = 0
+        end = time.time() + duration
+        while time.time() < end:
+            var.get_value()
+            count += 1
+        results.put(count)
+    finally:
+        client.disconnect()
+
+
+def run(workers, clients, duration):
+    server = MultiProcessServer(setup, ENDPOINT, workers=workers)
+    server.start()
+    try:
+        results = multiprocessing.Queue()
+        procs = [multiprocessing.Process(target=read_loop, args=(duration, results)) for _ in range(clients)]
+        for proc in procs:
+            proc.start()
+        total = sum(results.get() for _ in procs)
+        for proc in procs:
+            proc.join()
+    finally:
+        server.stop()
+    return total / duration
+
+
+if __name__ == "__main__":
+    max_workers = int(sys.argv[1]) if len(sys.argv) > 1 else os.cpu_count()
+    clients = int(sys.argv[2]) if len(sys.argv) > 2 else 2 * max_workers
+    duration = float(sys.argv[3]) if len(sys.argv) > 3 else 5
+
+    workers = 1
+    reference = None
+    while workers <= max_workers:
+        rate = run(workers, clients, duration)
+        reference = reference or rate
+        print("{0} workers, {1} clients: {2:.0f} reads/s ({3:.2f}x)".format(workers, clients, rate, rate / reference))
+        workers *= 2
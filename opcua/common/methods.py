@@ -2,6 +2,12 @@
 High level method related functions
 """
 
+import functools
+try:
+    import asyncio
+except ImportError:
+    import trollius as asyncio
+
 from opcua import ua
 from opcua.common import node
 
@@ -51,7 +57,10 @@ def uamethod(func):
     """
     Method decorator to automatically convert
     arguments and output to and from variants
+    func may be a coroutine function, the server then awaits it
+    and converts its result when it is done
     """
+    @functools.wraps(func)
     def wrapper(parent, *args):
         if isinstance(parent, ua.NodeId):
             result = func(parent, *[arg.Value for arg in args])
@@ -61,10 +70,23 @@ def uamethod(func):
             args = args[1:]
             result = func(self, parent, *[arg.Value for arg in args])
 
+        if asyncio.iscoroutine(result):
+            return CoroutineResult(result, to_variant)
         return to_variant(result)
     return wrapper
 
 
+class CoroutineResult(object):
+    """
+    returned by a method callback whose result is only available once
+    coroutine is done, convert is applied to the result of coroutine
+    """
+
+    def __init__(self, coroutine, convert):
+        self.coroutine = coroutine
+        self.convert = convert
+
+
 def to_variant(*args):
     uaargs = []
     for arg in args:
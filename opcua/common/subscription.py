@@ -168,14 +168,18 @@ class Subscription(object):
         except Exception:
             self.logger.exception("Exception calling status change handler")
 
-    def subscribe_data_change(self, nodes, attr=ua.AttributeIds.Value):
+    def subscribe_data_change(self, nodes, attr=ua.AttributeIds.Value, sampling_interval=None, queuesize=0):
         """
         Subscribe for data change events for a node or list of nodes.
         default attribute is Value.
+        sampling_interval in ms defaults to the publishing interval,
+        0 asks the server to report every change of the value
+        queuesize is the number of changes the server keeps between two
+        publish, 0 means only the last one
         Return a handle which can be used to unsubscribe
         If more control is necessary use create_monitored_items method
         """
-        return self._subscribe(nodes, attr, queuesize=0)
+        return self._subscribe(nodes, attr, queuesize=queuesize, sampling_interval=sampling_interval)
 
     def subscribe_events(self, sourcenode=ua.ObjectIds.Server, evtypes=ua.ObjectIds.BaseEventType, evfilter=None):
         """
@@ -196,7 +200,7 @@ class Subscription(object):
             evfilter = events.get_filter_from_event_type(evtypes)
         return self._subscribe(sourcenode, ua.AttributeIds.EventNotifier, evfilter)
 
-    def _subscribe(self, nodes, attr, mfilter=None, queuesize=0):
+    def _subscribe(self, nodes, attr, mfilter=None, queuesize=0, sampling_interval=None):
         is_list = True
         if isinstance(nodes, collections.Iterable):
             nodes = list(nodes)
@@ -205,7 +209,7 @@ class Subscription(object):
             is_list = False
         mirs = []
         for node in nodes:
-            mir = self._make_monitored_item_request(node, attr, mfilter, queuesize)
+            mir = self._make_monitored_item_request(node, attr, mfilter, queuesize, sampling_interval)
             mirs.append(mir)
 
         mids = self.create_monitored_items(mirs)
@@ -215,7 +219,7 @@ class Subscription(object):
             mids[0].check()
         return mids[0]
 
-    def _make_monitored_item_request(self, node, attr, mfilter, queuesize):
+    def _make_monitored_item_request(self, node, attr, mfilter, queuesize, sampling_interval=None):
         rv = ua.ReadValueId()
         rv.NodeId = node.nodeid
         rv.AttributeId = attr
@@ -224,7 +228,9 @@ class Subscription(object):
         with self._lock:
             self._client_handle += 1
             mparams.ClientHandle = self._client_handle
-        mparams.SamplingInterval = self.parameters.RequestedPublishingInterval
+        if sampling_interval is None:
+            sampling_interval = self.parameters.RequestedPublishingInterval
+        mparams.SamplingInterval = sampling_interval
         mparams.QueueSize = queuesize
         mparams.DiscardOldest = True
         if mfilter:
@@ -67,6 +67,18 @@ class Buffer(object):
         # self.logger.debug("Returning: %s ", data)
         return data
 
+    def read_view(self, size):
+        """
+        read and pop number of bytes for buffer, returning a memoryview
+        on the underlying data instead of a copy
+        """
+        if size > self._size:
+            raise NotEnoughData("Not enough data left in buffer, request for {0}, we have {1}".format(size, self))
+        self._size -= size
+        pos = self._cur_pos
+        self._cur_pos += size
+        return memoryview(self._data)[pos:self._cur_pos]
+
     def copy(self, size=-1):
         """
         return a shadow copy, optionnaly only copy 'size' bytes
@@ -85,6 +97,47 @@ class Buffer(object):
         self._cur_pos += size
 
 
+class ReceiveBuffer(object):
+    """
+    accumulate data received from a stream in a growing bytearray and hand
+    out complete packets. Incoming data is appended in place and consumed
+    data is only discarded once it makes up half of the buffer, so partial
+    packets are never concatenated again on each read
+    """
+
+    def __init__(self):
+        self._data = bytearray()
+        self._pos = 0
+
+    def __len__(self):
+        return len(self._data) - self._pos
+
+    def feed(self, data):
+        self._data += data
+
+    def peek(self, size):
+        """
+        return up to size bytes without consuming them
+        """
+        return bytes(self._data[self._pos:self._pos + size])
+
+    def read(self, size):
+        """
+        consume size bytes and return them as bytes
+        """
+        if size > len(self):
+            raise NotEnoughData("Not enough data left in buffer, request for {0}, we have {1}".format(size, len(self)))
+        data = bytes(self._data[self._pos:self._pos + size])
+        self._pos += size
+        if self._pos == len(self._data):
+            del self._data[:]
+            self._pos = 0
+        elif self._pos > len(self._data) // 2:
+            del self._data[:self._pos]
+            self._pos = 0
+        return data
+
+
 class SocketWrapper(object):
     """
     wrapper to make it possible to have same api for
@@ -98,7 +151,7 @@ class SocketWrapper(object):
         """
         Receive up to size bytes from socket
         """
-        data = b''
+        chunks = []
         while size > 0:
             try:
                 chunk = self.socket.recv(size)
@@ -106,9 +159,11 @@ class SocketWrapper(object):
                 raise SocketClosedException("Server socket has closed", ex)
             if not chunk:
                 raise SocketClosedException("Server socket has closed")
-            data += chunk
+            chunks.append(chunk)
             size -= len(chunk)
-        return data
+        if len(chunks) == 1:
+            return chunks[0]
+        return b"".join(chunks)
 
     def write(self, data):
         self.socket.sendall(data)
@@ -143,8 +198,8 @@ class ThreadLoop(threading.Thread):
         self.loop.run_forever()
         self.logger.debug("subscription thread ended")
 
-    def create_server(self, proto, hostname, port):
-        return self.loop.create_server(proto, hostname, port)
+    def create_server(self, proto, hostname=None, port=None, sock=None):
+        return self.loop.create_server(proto, hostname, port, sock=sock)
 
     def stop(self):
         """
@@ -1,4 +1,4 @@
-from threading import RLock
+from threading import RLock, Lock
 import logging
 from datetime import datetime
 import collections
@@ -7,9 +7,15 @@ try:
     import cPickle as pickle
 except:
     import pickle
+try:
+    import asyncio
+except ImportError:
+    import trollius as asyncio
+from concurrent.futures import Future
 
 from opcua import ua
 from opcua.server.users import User
+from opcua.common.methods import CoroutineResult
 
 
 class AttributeValue(object):
@@ -24,8 +30,14 @@ class AttributeValue(object):
     __repr__ = __str__
 
 
+# guards building and updating the browse name index of every NodeData
+_references_index_lock = Lock()
+
+
 class NodeData(object):
 
+    _references_by_name = None  # built on first use, also for nodes unpickled from older dumps
+
     def __init__(self, nodeid):
         self.nodeid = nodeid
         self.attributes = {}
@@ -36,6 +48,48 @@ class NodeData(object):
         return "NodeData(id:{0}, attrs:{1}, refs:{2})".format(self.nodeid, self.attributes, self.references)
     __repr__ = __str__
 
+    def add_reference(self, rdesc):
+        """
+        add a ReferenceDescription to the node, keeping the browse name index up to date
+        """
+        with _references_index_lock:
+            self.references.append(rdesc)
+            if self._references_by_name is not None:
+                key = _bname_key(rdesc.BrowseName)
+                # lists are replaced, not modified, so lock free readers are safe
+                self._references_by_name[key] = self._references_by_name.get(key, []) + [rdesc]
+
+    def remove_reference(self, rdesc):
+        with _references_index_lock:
+            self.references.remove(rdesc)
+            if self._references_by_name is not None:
+                key = _bname_key(rdesc.BrowseName)
+                refs = [ref for ref in self._references_by_name.get(key, []) if ref is not rdesc]
+                if refs:
+                    self._references_by_name[key] = refs
+                else:
+                    self._references_by_name.pop(key, None)
+
+    def get_references_by_name(self, bname):
+        """
+        return list of references whose target has browse name bname
+        """
+        index = self._references_by_name
+        if index is None:
+            # built under the lock so a reference added meanwhile is not missed
+            with _references_index_lock:
+                if self._references_by_name is None:
+                    index = {}
+                    for ref in self.references:
+                        index.setdefault(_bname_key(ref.BrowseName), []).append(ref)
+                    self._references_by_name = index
+                index = self._references_by_name
+        return index.get(_bname_key(bname), [])
+
+
+def _bname_key(bname):
+    return bname.NamespaceIndex, bname.Name
+
 
 class AttributeService(object):
 
@@ -112,20 +166,7 @@ class ViewService(object):
             return False
         if ref1.Identifier == ref2.Identifier:
             return True
-        oktypes = self._get_sub_ref(ref1)
-        if not subtypes and ua.NodeId(ua.ObjectIds.HasSubtype) in oktypes:
-            oktypes.remove(ua.NodeId(ua.ObjectIds.HasSubtype))
-        return ref2 in oktypes
-
-    def _get_sub_ref(self, ref):
-        res = []
-        nodedata = self._aspace[ref]
-        if nodedata is not None:
-            for ref in nodedata.references:
-                if ref.ReferenceTypeId.Identifier == ua.ObjectIds.HasSubtype and ref.IsForward:
-                    res.append(ref.NodeId)
-                    res += self._get_sub_ref(ref.NodeId)
-        return res
+        return ref2 in self._aspace.get_subtypes(ref1)
 
     def _suitable_direction(self, desc, isforward):
         if desc == ua.BrowseDirection.Both:
@@ -164,13 +205,20 @@ class ViewService(object):
 
     def _find_element_in_node(self, el, nodeid):
         nodedata = self._aspace[nodeid]
-        for ref in nodedata.references:
-            # FIXME: here we should check other arguments!!
-            if ref.BrowseName == el.TargetName:
-                return ref.NodeId
+        for ref in nodedata.get_references_by_name(el.TargetName):
+            if ref.IsForward == el.IsInverse:
+                continue
+            if not el.ReferenceTypeId.is_null() and not self._suitable_element_reftype(el, ref.ReferenceTypeId):
+                continue
+            return ref.NodeId
         self.logger.info("element %s was not found in node %s", el, nodeid)
         return None
 
+    def _suitable_element_reftype(self, el, reftype):
+        if el.IncludeSubtypes:
+            return reftype in self._aspace.get_subtypes(el.ReferenceTypeId)
+        return reftype == el.ReferenceTypeId
+
 
 class NodeManagementService(object):
 
@@ -255,7 +303,8 @@ class NodeManagementService(object):
         desc.DisplayName = ua.LocalizedText(item.BrowseName.Name)
         desc.TypeDefinition = item.TypeDefinition
         desc.IsForward = True
-        self._aspace[item.ParentNodeId].references.append(desc)
+        self._aspace[item.ParentNodeId].add_reference(desc)
+        self._aspace.references_changed([desc.ReferenceTypeId])
 
     def _add_ref_to_parent(self, nodedata, item, user):
         addref = ua.AddReferencesItem()
@@ -291,13 +340,15 @@ class NodeManagementService(object):
 
         if item.DeleteTargetReferences:
             for elem in self._aspace.keys():
-                for rdesc in self._aspace[elem].references:
-                    if rdesc.NodeId == item.NodeId:
-                        self._aspace[elem].references.remove(rdesc)
+                refnode = self._aspace[elem]
+                for rdesc in [ref for ref in refnode.references if ref.NodeId == item.NodeId]:
+                    refnode.remove_reference(rdesc)
 
-        self._delete_node_callbacks(self._aspace[item.NodeId])
+        nodedata = self._aspace[item.NodeId]
+        self._delete_node_callbacks(nodedata)
 
         del(self._aspace[item.NodeId])
+        self._aspace.references_changed([ref.ReferenceTypeId for ref in nodedata.references])
 
         return ua.StatusCode()
 
@@ -334,7 +385,8 @@ class NodeManagementService(object):
         dname = self._aspace.get_attribute_value(addref.TargetNodeId, ua.AttributeIds.DisplayName).Value.Value
         if dname:
             rdesc.DisplayName = dname
-        self._aspace[addref.SourceNodeId].references.append(rdesc)
+        self._aspace[addref.SourceNodeId].add_reference(rdesc)
+        self._aspace.references_changed([rdesc.ReferenceTypeId])
         return ua.StatusCode()
 
     def delete_references(self, refs, user=User.Admin):
@@ -351,22 +403,19 @@ class NodeManagementService(object):
         if user != User.Admin:
             return ua.StatusCode(ua.StatusCodes.BadUserAccessDenied)
 
-        for rdesc in self._aspace[item.SourceNodeId].references:
-            if rdesc.NodeId is item.TargetNodeId:
-                if rdesc.RefrenceTypeId != item.RefrenceTypeId:
-                    return ua.StatusCode(ua.StatusCodes.BadReferenceTypeIdInvalid)
-                if rdesc.IsForward == item.IsForward or item.DeleteBidirectional:
-                    self._aspace[item.SourceNodeId].references.remove(rdesc)
-
-        for rdesc in self._aspace[item.TargetNodeId].references:
-            if rdesc.NodeId is item.SourceNodeId:
-                if rdesc.RefrenceTypeId != item.RefrenceTypeId:
-                    return ua.StatusCode(ua.StatusCodes.BadReferenceTypeIdInvalid)
-                if rdesc.IsForward == item.IsForward or item.DeleteBidirectional:
-                    self._aspace[item.SourceNodeId].references.remove(rdesc)
+        self._remove_references(item.SourceNodeId, item.TargetNodeId, item.ReferenceTypeId, item.IsForward)
+        if item.DeleteBidirectional:
+            self._remove_references(item.TargetNodeId, item.SourceNodeId, item.ReferenceTypeId, not item.IsForward)
 
+        self._aspace.references_changed([item.ReferenceTypeId])
         return ua.StatusCode()
 
+    def _remove_references(self, source, target, reftype, isforward):
+        nodedata = self._aspace[source]
+        for rdesc in [ref for ref in nodedata.references if ref.NodeId == target]:
+            if rdesc.ReferenceTypeId == reftype and rdesc.IsForward == isforward:
+                nodedata.remove_reference(rdesc)
+
     def _add_node_attr(self, item, nodedata, name, vtype=None):
         if item.SpecifiedAttributes & getattr(ua.NodeAttributesMask, name):
             dv = ua.DataValue(ua.Variant(getattr(item, name), vtype))
@@ -401,34 +450,132 @@ class NodeManagementService(object):
 
 
 class MethodService(object):
+    """
+    Call method callbacks.
+    Callbacks run inline unless an executor is set with set_executor(),
+    coroutine functions are run on the server event loop.
+    """
 
-    def __init__(self, aspace):
+    def __init__(self, aspace, loop=None):
         self.logger = logging.getLogger(__name__)
         self._aspace = aspace
+        self._loop = loop
+        self.executor = None
+
+    def set_executor(self, executor):
+        """
+        run method callbacks in executor, a concurrent.futures.Executor
+        (for example a ThreadPoolExecutor or a ProcessPoolExecutor),
+        so that slow callbacks do not block the server. None runs them inline.
+        With a ProcessPoolExecutor callbacks must be picklable, i.e. module level functions
+        """
+        self.executor = executor
 
     def call(self, methods):
-        results = []
-        for method in methods:
-            results.append(self._call(method))
-        return results
+        """
+        call methods and wait for their results
+        must not be called from the server event loop if callbacks are coroutines
+        """
+        return self.call_async(methods).result()
+
+    def call_async(self, methods):
+        """
+        call methods, returns a concurrent.futures.Future with the list of CallMethodResult
+        """
+        return _gather([self._call(method) for method in methods])
 
     def _call(self, method):
         res = ua.CallMethodResult()
         if method.ObjectId not in self._aspace or method.MethodId not in self._aspace:
             res.StatusCode = ua.StatusCode(ua.StatusCodes.BadNodeIdInvalid)
-        else:
-            node = self._aspace[method.MethodId]
-            if node.call is None:
-                res.StatusCode = ua.StatusCode(ua.StatusCodes.BadNothingToDo)
+            return _done(res)
+        node = self._aspace[method.MethodId]
+        if node.call is None:
+            res.StatusCode = ua.StatusCode(ua.StatusCodes.BadNothingToDo)
+            return _done(res)
+
+        result = Future()
+
+        def done(future):
+            try:
+                res.OutputArguments = future.result()
+                for _ in method.InputArguments:
+                    res.InputArgumentResults.append(ua.StatusCode())
+            except Exception:
+                self.logger.exception("Error executing method call %s, an exception was raised: ", method)
+                res.StatusCode = ua.StatusCode(ua.StatusCodes.BadUnexpectedError)
+            result.set_result(res)
+
+        try:
+            if self.executor is None or _is_coroutine_function(node.call):
+                output = _done(node.call(method.ObjectId, *method.InputArguments))
             else:
-                try:
-                    res.OutputArguments = node.call(method.ObjectId, *method.InputArguments)
-                    for _ in method.InputArguments:
-                        res.InputArgumentResults.append(ua.StatusCode())
-                except Exception:
-                    self.logger.exception("Error executing method call %s, an exception was raised: ", method)
-                    res.StatusCode = ua.StatusCode(ua.StatusCodes.BadUnexpectedError)
-        return res
+                output = self.executor.submit(node.call, method.ObjectId, *method.InputArguments)
+        except Exception as ex:
+            output = Future()
+            output.set_exception(ex)
+        self._resolve(output, done)
+        return result
+
+    def _resolve(self, future, callback):
+        """
+        call callback with future once it is done, if future resolves to a
+        coroutine, it is run on the server loop and callback gets its result
+        """
+        def coroutine_done(fut, convert):
+            result = Future()
+            try:
+                value = fut.result()
+                result.set_result(convert(value) if convert else value)
+            except Exception as ex:
+                result.set_exception(ex)
+            callback(result)
+
+        def done(fut):
+            value = None if fut.exception() else fut.result()
+            if asyncio.iscoroutine(value):
+                value = CoroutineResult(value, None)
+            if not isinstance(value, CoroutineResult):
+                callback(fut)
+                return
+            convert = value.convert
+            cfut = asyncio.run_coroutine_threadsafe(value.coroutine, self._loop.loop)
+            cfut.add_done_callback(lambda f: coroutine_done(f, convert))
+        future.add_done_callback(done)
+
+
+def _is_coroutine_function(func):
+    while hasattr(func, "__wrapped__"):
+        func = func.__wrapped__
+    return asyncio.iscoroutinefunction(func)
+
+
+def _done(value):
+    future = Future()
+    future.set_result(value)
+    return future
+
+
+def _gather(futures):
+    """
+    return a future with the list of results of futures
+    """
+    result = Future()
+    if not futures:
+        result.set_result([])
+        return result
+    pending = [len(futures)]
+    lock = Lock()
+
+    def done(_):
+        with lock:
+            pending[0] -= 1
+            if pending[0]:
+                return
+        result.set_result([fut.result() for fut in futures])
+    for fut in futures:
+        fut.add_done_callback(done)
+    return result
 
 
 class AddressSpace(object):
@@ -436,30 +583,32 @@ class AddressSpace(object):
     """
     The address space object stores all the nodes of the OPC-UA server
     and helper methods.
-    The methods are thread safe
+    The methods are thread safe: reads do not take any lock, they rely on
+    dict lookups and attribute assignments being atomic. Writers serialize
+    on a lock and never modify a value in place, they swap in a new one,
+    so readers always see either the old or the new value.
     """
 
     def __init__(self):
         self.logger = logging.getLogger(__name__)
         self._nodes = {}
-        self._lock = RLock()  # FIXME: should use multiple reader, one writter pattern
+        self._lock = RLock()  # taken by writers only
         self._datachange_callback_counter = 200
         self._handle_to_attribute_map = {}
         self._default_idx = 2
         self._nodeid_counter = {0: 20000, 1: 2000}
+        self._subtypes = {}  # cache of get_subtypes(), cleared when the type hierarchy changes
+        self.event_links_version = 0  # incremented when HasEventSource or HasNotifier references change
 
     def __getitem__(self, nodeid):
-        with self._lock:
-            if nodeid in self._nodes:
-                return self._nodes.__getitem__(nodeid)
+        return self._nodes.get(nodeid)
 
     def __setitem__(self, nodeid, value):
         with self._lock:
             return self._nodes.__setitem__(nodeid, value)
 
     def __contains__(self, nodeid):
-        with self._lock:
-            return self._nodes.__contains__(nodeid)
+        return self._nodes.__contains__(nodeid)
 
     def __delitem__(self, nodeid):
         with self._lock:
@@ -468,21 +617,68 @@ class AddressSpace(object):
     def generate_nodeid(self, idx=None):
         if idx is None:
             idx = self._default_idx
-        if idx in self._nodeid_counter:
-            self._nodeid_counter[idx] += 1
-        else:
-            self._nodeid_counter[idx] = 1
-        nodeid = ua.NodeId(self._nodeid_counter[idx], idx)
         with self._lock:  # OK since reentrant lock
+            if idx in self._nodeid_counter:
+                self._nodeid_counter[idx] += 1
+            else:
+                self._nodeid_counter[idx] = 1
+            nodeid = ua.NodeId(self._nodeid_counter[idx], idx)
             while True:
                 if nodeid in self._nodes:
                     nodeid = self.generate_nodeid(idx)
                 else:
                     return nodeid
 
+    def get_subtypes(self, nodeid):
+        """
+        return a frozenset of nodeid and all its direct and indirect subtypes
+        result is cached until invalidate_subtypes() is called
+        """
+        # a result computed while invalidate_subtypes() runs goes to the discarded dict
+        cache = self._subtypes
+        subtypes = cache.get(nodeid)
+        if subtypes is None:
+            subtypes = frozenset(self._find_subtypes(nodeid))
+            cache[nodeid] = subtypes
+        return subtypes
+
+    def _find_subtypes(self, nodeid):
+        found = set([nodeid])
+        tocheck = [nodeid]
+        while tocheck:
+            nodedata = self._nodes.get(tocheck.pop())
+            if nodedata is None:
+                continue
+            for ref in nodedata.references:
+                if ref.ReferenceTypeId.Identifier == ua.ObjectIds.HasSubtype and ref.IsForward and ref.NodeId not in found:
+                    found.add(ref.NodeId)
+                    tocheck.append(ref.NodeId)
+        return found
+
+    def invalidate_subtypes(self):
+        """
+        clear the subtype cache, must be called when HasSubtype references are added or removed
+        """
+        self._subtypes = {}
+        self.event_links_version += 1
+
+    def references_changed(self, reftypes):
+        """
+        clear what is cached about references of the given types,
+        must be called when such references are added or removed
+        """
+        if any(reftype.Identifier == ua.ObjectIds.HasSubtype for reftype in reftypes):
+            self.invalidate_subtypes()
+        event_reftypes = self.get_subtypes(ua.NodeId(ua.ObjectIds.HasEventSource))
+        if any(reftype in event_reftypes for reftype in reftypes):
+            self.event_links_version += 1
+
     def keys(self):
+        """
+        return a copy of the node ids, so that nodes may be added or deleted while iterating
+        """
         with self._lock:
-            return self._nodes.keys()
+            return list(self._nodes.keys())
 
     def empty(self):
         """
@@ -490,6 +686,7 @@ class AddressSpace(object):
         """
         with self._lock:
             self._nodes = {}
+            self.invalidate_subtypes()
 
     def dump(self, path):
         """
@@ -511,6 +708,7 @@ class AddressSpace(object):
         """
         with open(path, 'rb') as f:
             self._nodes = pickle.load(f)
+        self.invalidate_subtypes()
 
     def make_aspace_shelf(self, path):
         """
@@ -542,21 +740,27 @@ class AddressSpace(object):
             def __init__(self, source):
                 self.source = source  # python shelf
                 self.cache = {}  # internal dict
+                self._lock = Lock()  # the shelf is not thread safe
 
             def __getitem__(self, key):
                 # try to get the item (node) from the cache, if it isn't there get it from the shelf
                 try:
                     return self.cache[key]
                 except KeyError:
-                    node = self.cache[key] = self.source[key.to_string()]
-                    return node
+                    with self._lock:
+                        node = self.source[key.to_string()]
+                    # if another thread loaded the node meanwhile, keep its copy
+                    return self.cache.setdefault(key, node)
 
             def __setitem__(self, key, value):
                 # add a new item to the cache; if this item is in the shelf it is not updated
                 self.cache[key] = value
 
             def __contains__(self, key):
-                return key in self.cache or key.to_string() in self.source
+                if key in self.cache:
+                    return True
+                with self._lock:
+                    return key.to_string() in self.source
 
             def __delitem__(self, key):
                 # only deleting items from the cache is allowed
@@ -571,42 +775,47 @@ class AddressSpace(object):
                 return len(self.cache)
 
         self._nodes = LazyLoadingDict(shelve.open(path, "r"))
+        self.invalidate_subtypes()
 
     def get_attribute_value(self, nodeid, attr):
-        with self._lock:
-            self.logger.debug("get attr val: %s %s", nodeid, attr)
-            if nodeid not in self._nodes:
-                dv = ua.DataValue()
-                dv.StatusCode = ua.StatusCode(ua.StatusCodes.BadNodeIdUnknown)
-                return dv
-            node = self._nodes[nodeid]
-            if attr not in node.attributes:
-                dv = ua.DataValue()
-                dv.StatusCode = ua.StatusCode(ua.StatusCodes.BadAttributeIdInvalid)
-                return dv
-            attval = node.attributes[attr]
-            if attval.value_callback:
-                return attval.value_callback()
-            return attval.value
+        # lock free, see class docstring
+        self.logger.debug("get attr val: %s %s", nodeid, attr)
+        node = self._nodes.get(nodeid)
+        if node is None:
+            dv = ua.DataValue()
+            dv.StatusCode = ua.StatusCode(ua.StatusCodes.BadNodeIdUnknown)
+            return dv
+        attval = node.attributes.get(attr)
+        if attval is None:
+            dv = ua.DataValue()
+            dv.StatusCode = ua.StatusCode(ua.StatusCodes.BadAttributeIdInvalid)
+            return dv
+        if attval.value_callback:
+            return attval.value_callback()
+        return attval.value
 
     def set_attribute_value(self, nodeid, attr, value):
+        self.logger.debug("set attr val: %s %s %s", nodeid, attr, value)
+        # value is not visible to readers yet, complete it before taking the lock
+        if not value.SourceTimestamp or not value.ServerTimestamp:
+            now = datetime.utcnow()
+            if not value.SourceTimestamp:
+                value.SourceTimestamp = now
+            if not value.ServerTimestamp:
+                value.ServerTimestamp = now
         with self._lock:
-            self.logger.debug("set attr val: %s %s %s", nodeid, attr, value)
-            if nodeid not in self._nodes:
+            node = self._nodes.get(nodeid)
+            if node is None:
                 return ua.StatusCode(ua.StatusCodes.BadNodeIdUnknown)
-            node = self._nodes[nodeid]
-            if attr not in node.attributes:
+            attval = node.attributes.get(attr)
+            if attval is None:
                 return ua.StatusCode(ua.StatusCodes.BadAttributeIdInvalid)
-            if not value.SourceTimestamp:
-                value.SourceTimestamp = datetime.utcnow()
-            if not value.ServerTimestamp:
-                value.ServerTimestamp = datetime.utcnow()
-
-            attval = node.attributes[attr]
             old = attval.value
-            attval.value = value
+            attval.value = value  # atomic swap, readers get old or new value
             cbs = []
-            if old.Value != value.Value:  # only send call callback when a value change has happend
+            # only call callbacks when something changed, monitored items filter further
+            if old.Value != value.Value or old.StatusCode != value.StatusCode or \
+                    old.SourceTimestamp != value.SourceTimestamp:
                 cbs = list(attval.datachange_callbacks.items())
 
         for k, v in cbs:
@@ -2,6 +2,7 @@
 Socket server forwarding request to internal server
 """
 import logging
+import socket
 try:
     # we prefer to use bundles asyncio version, otherwise fallback to trollius
     import asyncio
@@ -17,10 +18,11 @@ logger = logging.getLogger(__name__)
 
 class BinaryServer(object):
 
-    def __init__(self, internal_server, hostname, port):
+    def __init__(self, internal_server, hostname, port, reuse_port=False):
         self.logger = logging.getLogger(__name__)
         self.hostname = hostname
         self.port = port
+        self.reuse_port = reuse_port
         self.iserver = internal_server
         self.loop = internal_server.loop
         self._server = None
@@ -51,7 +53,7 @@ class BinaryServer(object):
                 self.transport = transport
                 self.processor = UaProcessor(self.iserver, self.transport)
                 self.processor.set_policies(self.policies)
-                self.data = b""
+                self.data = ua.utils.ReceiveBuffer()
                 self.iserver.asyncio_transports.append(transport)
 
             def connection_lost(self, ex):
@@ -62,38 +64,37 @@ class BinaryServer(object):
 
             def data_received(self, data):
                 logger.debug("received %s bytes from socket", len(data))
-                if self.data:
-                    data = self.data + data
-                    self.data = b""
-                self._process_data(data)
+                self.data.feed(data)
+                self._process_data()
 
-            def _process_data(self, data):
-                buf = ua.utils.Buffer(data)
+            def _process_data(self):
                 while True:
                     try:
-                        backup_buf = buf.copy()
                         try:
-                            hdr = ua.Header.from_string(buf)
+                            hdr = ua.Header.from_string(ua.utils.Buffer(self.data.peek(ua.Header.max_size())))
                         except ua.utils.NotEnoughData:
                             logger.info("We did not receive enough data from client, waiting for more")
-                            self.data = backup_buf.read(len(backup_buf))
                             return
-                        if len(buf) < hdr.body_size:
+                        if len(self.data) < hdr.packet_size:
                             logger.info("We did not receive enough data from client, waiting for more")
-                            self.data = backup_buf.read(len(backup_buf))
                             return
+                        buf = ua.utils.Buffer(self.data.read(hdr.packet_size))
+                        hdr = ua.Header.from_string(buf)
                         ret = self.processor.process(hdr, buf)
                         if not ret:
                             logger.info("processor returned False, we close connection from %s", self.peername)
                             self.transport.close()
                             return
-                        if len(buf) == 0:
+                        if len(self.data) == 0:
                             return
                     except Exception:
                         logger.exception("Exception raised while parsing message from client, closing")
                         return
 
-        coro = self.loop.create_server(OPCUAProtocol, self.hostname, self.port)
+        if self.reuse_port:
+            coro = self.loop.create_server(OPCUAProtocol, sock=self._create_reuse_port_socket())
+        else:
+            coro = self.loop.create_server(OPCUAProtocol, self.hostname, self.port)
         self._server = self.loop.run_coro_and_wait(coro)
         # get the port and the hostname from the created server socket
         # only relevant for dynamic port asignment (when self.port == 0)
@@ -105,6 +106,27 @@ class BinaryServer(object):
             self.port = sockname[1]
         print('Listening on {0}:{1}'.format(self.hostname, self.port))
 
+    def _create_reuse_port_socket(self):
+        """
+        create a listening socket with SO_REUSEPORT set, so that several
+        processes can accept connections on the same port
+        """
+        if not hasattr(socket, "SO_REUSEPORT"):
+            raise ua.UaError("SO_REUSEPORT is not supported on this platform")
+        family, socktype, proto, _, sockaddr = socket.getaddrinfo(
+            self.hostname, self.port, 0, socket.SOCK_STREAM, 0, socket.AI_PASSIVE)[0]
+        sock = socket.socket(family, socktype, proto)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            sock.bind(sockaddr)
+            sock.listen(100)
+            sock.setblocking(False)
+        except Exception:
+            sock.close()
+            raise
+        return sock
+
     def stop(self):
         self.logger.info("Closing asyncio socket server")
         for transport in self.iserver.asyncio_transports:
@@ -5,6 +5,7 @@ from datetime import datetime
 from opcua import Subscription
 from opcua import ua
 from opcua.common import utils
+from opcua.server import history_aggregates
 
 
 class UaNodeAlreadyHistorizedError(ua.UaError):
@@ -43,6 +44,25 @@ class HistoryStorageInterface(object):
         """
         raise NotImplementedError
 
+    def read_node_aggregates(self, node_id, start, end, interval, aggregate, config):
+        """
+        Called when a client make a history read request for aggregates of a node
+        interval is the processing interval in ms and aggregate the NodeId of the aggregate function
+        Returns a list of DataValues, one for every interval
+        The default implementation computes them from the values returned by read_node_history,
+        backends can override it to compute them where the data is
+        """
+        bounds = history_aggregates.intervals(start, end, interval)
+        lo, hi = min(start, end), max(start, end)
+        # values around the intervals are needed for interpolation
+        before, _ = self.read_node_history(node_id, None, lo, 1)
+        values, _ = self.read_node_history(node_id, lo, hi, 0)
+        after, _ = self.read_node_history(node_id, hi, None, 1)
+        values = [dv for dv in before if dv.ServerTimestamp < lo] + values + \
+            [dv for dv in after if dv.ServerTimestamp > hi]
+        results = history_aggregates.compute_from_datavalues(aggregate, values, bounds, config)
+        return history_aggregates.in_request_order(results, start, end)
+
     def new_historized_event(self, source_id, evtypes, period, count=0):
         """
         Called when historization of events is enabled on server side
@@ -112,8 +132,10 @@ class HistoryDict(HistoryStorageInterface):
                 start = ua.get_win_epoch()
             if end is None:
                 end = ua.get_win_epoch()
-            if start == ua.get_win_epoch():
-                results = [dv for dv in reversed(self._datachanges[node_id]) if start <= dv.ServerTimestamp]
+            if start == ua.get_win_epoch() and end == ua.get_win_epoch():
+                results = list(reversed(self._datachanges[node_id]))
+            elif start == ua.get_win_epoch():
+                results = [dv for dv in reversed(self._datachanges[node_id]) if dv.ServerTimestamp <= end]
             elif end == ua.get_win_epoch():
                 results = [dv for dv in self._datachanges[node_id] if start <= dv.ServerTimestamp]
             elif start > end:
@@ -122,7 +144,7 @@ class HistoryDict(HistoryStorageInterface):
             else:
                 results = [dv for dv in self._datachanges[node_id] if start <= dv.ServerTimestamp <= end]
             if nb_values and len(results) > nb_values:
-                cont = results[nb_values + 1].ServerTimestamp
+                cont = results[nb_values].ServerTimestamp
                 results = results[:nb_values]
             return results, cont
 
@@ -153,8 +175,10 @@ class HistoryDict(HistoryStorageInterface):
                 start = ua.get_win_epoch()
             if end is None:
                 end = ua.get_win_epoch()
-            if start == ua.get_win_epoch():
-                results = [ev for ev in reversed(self._events[source_id]) if start <= ev.Time]
+            if start == ua.get_win_epoch() and end == ua.get_win_epoch():
+                results = list(reversed(self._events[source_id]))
+            elif start == ua.get_win_epoch():
+                results = [ev for ev in reversed(self._events[source_id]) if ev.Time <= end]
             elif end == ua.get_win_epoch():
                 results = [ev for ev in self._events[source_id] if start <= ev.Time]
             elif start > end:
@@ -163,7 +187,7 @@ class HistoryDict(HistoryStorageInterface):
             else:
                 results = [ev for ev in self._events[source_id] if start <= ev.Time <= end]
             if nb_values and len(results) > nb_values:
-                cont = results[nb_values + 1].Time
+                cont = results[nb_values].Time
                 results = results[:nb_values]
             return results, cont
 
@@ -215,7 +239,9 @@ class HistoryManager(object):
         if node in self._handlers:
             raise ua.UaError("Node {0} is already historized".format(node))
         self.storage.new_historized_node(node.nodeid, period, count)
-        handler = self._sub.subscribe_data_change(node)
+        # every change must be stored, not only samples
+        handler = self._sub.subscribe_data_change(
+            node, sampling_interval=0, queuesize=self.iserver.subscription_service.max_queue_size)
         self._handlers[node] = handler
 
     def historize_event(self, source, period=timedelta(days=7), count=0):
@@ -265,12 +291,20 @@ class HistoryManager(object):
         """
         results = []
 
-        for rv in params.NodesToRead:
-            res = self._read_history(params.HistoryReadDetails, rv)
+        details = params.HistoryReadDetails
+        if isinstance(details, ua.ReadProcessedDetails) and len(details.AggregateType) != len(params.NodesToRead):
+            for _ in params.NodesToRead:
+                result = ua.HistoryReadResult()
+                result.StatusCode = ua.StatusCode(ua.StatusCodes.BadAggregateListMismatch)
+                results.append(result)
+            return results
+
+        for idx, rv in enumerate(params.NodesToRead):
+            res = self._read_history(details, rv, idx)
             results.append(res)
         return results
 
-    def _read_history(self, details, rv):
+    def _read_history(self, details, rv, idx=0):
         """
         determine if the history read is for a data changes or events; then read the history for that node
         """
@@ -293,6 +327,11 @@ class HistoryManager(object):
             result.HistoryData.Events = ev
             result.ContinuationPoint = cont
 
+        elif isinstance(details, ua.ReadProcessedDetails):
+            result.HistoryData = ua.HistoryData()
+            result.StatusCode, result.HistoryData.DataValues = self._read_processed_history(
+                rv, details, details.AggregateType[idx])
+
         else:
             # we do not currently support the other types, clients can process data themselves
             result.StatusCode = ua.StatusCode(ua.StatusCodes.BadNotImplemented)
@@ -317,6 +356,29 @@ class HistoryManager(object):
         # rv.DataEncoding # xml or binary, seems spec say we can ignore that one
         return dv, cont
 
+    def _read_processed_history(self, rv, details, aggregate):
+        """
+        return status code and DataValues of aggregate for every processing interval,
+        all intervals are returned at once so there is no continuation point
+        """
+        if not history_aggregates.is_supported(aggregate):
+            return ua.StatusCode(ua.StatusCodes.BadAggregateNotSupported), []
+        if details.StartTime == details.EndTime:
+            return ua.StatusCode(ua.StatusCodes.BadInvalidArgument), []
+        if not 0 <= details.ProcessingInterval < float("inf"):
+            # also rejects NaN
+            return ua.StatusCode(ua.StatusCodes.BadAggregateInvalidInputs), []
+        try:
+            dvs = self.storage.read_node_aggregates(rv.NodeId,
+                                                    details.StartTime,
+                                                    details.EndTime,
+                                                    details.ProcessingInterval,
+                                                    aggregate,
+                                                    details.AggregateConfiguration)
+        except ua.UaStatusCodeError as ex:
+            return ua.StatusCode(ex.code), []
+        return ua.StatusCode(), dvs
+
     def _read_event_history(self, rv, details):
         starttime = details.StartTime
         if rv.ContinuationPoint:
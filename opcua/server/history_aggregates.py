@@ -0,0 +1,211 @@
+"""
+aggregates of history values requested with ReadProcessedDetails
+"""
+
+from bisect import bisect_left
+
+from opcua import ua
+from opcua.ua import ua_binary as uabin
+
+CALCULATED = 0x401  # Good, with DataValue info type and HistorianCalculated bit
+INTERPOLATED = 0x402  # Good, with DataValue info type and HistorianInterpolated bit
+MAX_INTERVALS = 100000  # processing intervals computed for one node
+
+_INTEGER_TYPES = (
+    ua.VariantType.SByte,
+    ua.VariantType.Byte,
+    ua.VariantType.Int16,
+    ua.VariantType.UInt16,
+    ua.VariantType.Int32,
+    ua.VariantType.UInt32,
+    ua.VariantType.Int64,
+    ua.VariantType.UInt64,
+)
+
+
+def is_supported(aggregate):
+    return aggregate.NamespaceIndex == 0 and aggregate.Identifier in _AGGREGATES
+
+
+def status_limit(config):
+    """
+    return the lowest status code value of the raw values to ignore.
+    uncertain values are ignored unless the client asks to use them
+    """
+    if config is None or config.UseServerCapabilitiesDefaults or config.TreatUncertainAsBad:
+        return 0x40000000
+    return 0x80000000
+
+
+def intervals(start, end, interval):
+    """
+    return the FILETIME bounds of the processing intervals between start and
+    end, oldest first. interval is in ms, 0 means one interval
+    """
+    lo = uabin.datetime_to_win_epoch(min(start, end))
+    hi = uabin.datetime_to_win_epoch(max(start, end))
+    step = int(interval * 10 ** 4) if interval else hi - lo
+    if step <= 0 or (hi - lo) // step >= MAX_INTERVALS:
+        raise ua.UaStatusCodeError(ua.StatusCodes.BadAggregateInvalidInputs)
+    bounds = []
+    while lo < hi:
+        bounds.append((lo, min(lo + step, hi)))
+        lo += step
+    return bounds
+
+
+def in_request_order(results, start, end):
+    if start > end:
+        results.reverse()
+    return results
+
+
+def make_datavalue(value, vtype, timestamp, status=CALCULATED):
+    """
+    return an aggregate DataValue, a value of None means no data in the interval
+    """
+    if value is None:
+        dv = ua.DataValue(ua.Variant(None), ua.StatusCode(ua.StatusCodes.BadNoData))
+    else:
+        if vtype == ua.VariantType.Boolean:
+            value = bool(value)
+        elif vtype in _INTEGER_TYPES:
+            value = int(value)
+        elif vtype not in (ua.VariantType.Float, ua.VariantType.Double):
+            vtype = ua.VariantType.Double
+            value = float(value)
+        dv = ua.DataValue(ua.Variant(value, vtype), ua.StatusCode(status))
+    dv.SourceTimestamp = uabin.win_epoch_to_datetime(timestamp)
+    dv.ServerTimestamp = dv.SourceTimestamp
+    return dv
+
+
+def compute(aggregate, times, values, bounds, vtype=ua.VariantType.Double):
+    """
+    compute aggregate for every interval of bounds.
+    times are the FILETIMEs of the values, sorted, and values are numbers.
+    The last value before and the first value after the intervals should be
+    included, they are used for interpolation.
+    Returns a list of DataValues, oldest first
+    """
+    func = _AGGREGATES[aggregate.Identifier]
+    results = []
+    for lo_time, hi_time in bounds:
+        lo = bisect_left(times, lo_time)
+        hi = bisect_left(times, hi_time)
+        results.append(func(times, values, lo, hi, lo_time, hi_time, vtype))
+    return results
+
+
+def compute_from_datavalues(aggregate, datavalues, bounds, config):
+    """
+    compute aggregate from raw DataValues, ignoring values of bad quality
+    and values which are not numbers
+    """
+    limit = status_limit(config)
+    times = []
+    values = []
+    vtype = ua.VariantType.Double
+    # backends like HistoryDict keep values in arrival order, bisect needs them sorted
+    for dv in sorted(datavalues, key=lambda dv: dv.ServerTimestamp):
+        value = dv.Value.Value
+        if dv.StatusCode.value >= limit or dv.Value.is_array or not isinstance(value, (int, float)):
+            continue
+        times.append(uabin.datetime_to_win_epoch(dv.ServerTimestamp))
+        values.append(value)
+        vtype = dv.Value.VariantType
+    return compute(aggregate, times, values, bounds, vtype)
+
+
+def _interpolate(times, values, time):
+    """
+    value at time, linearly interpolated between the raw values around it
+    """
+    idx = bisect_left(times, time)
+    if idx < len(times) and times[idx] == time:
+        return values[idx]
+    if idx == 0 or idx == len(times):
+        return None
+    t1, t2 = times[idx - 1], times[idx]
+    v1, v2 = values[idx - 1], values[idx]
+    return v1 + (v2 - v1) * (time - t1) / float(t2 - t1)
+
+
+def _average(times, values, lo, hi, lo_time, hi_time, vtype):
+    if lo == hi:
+        return make_datavalue(None, vtype, lo_time)
+    return make_datavalue(sum(values[lo:hi]) / float(hi - lo), ua.VariantType.Double, lo_time)
+
+
+def _count(times, values, lo, hi, lo_time, hi_time, vtype):
+    return make_datavalue(hi - lo, ua.VariantType.Int32, lo_time)
+
+
+def _extremum(select):
+    def extremum(times, values, lo, hi, lo_time, hi_time, vtype):
+        if lo == hi:
+            return make_datavalue(None, vtype, lo_time)
+        window = values[lo:hi]
+        value = select(window)
+        return make_datavalue(value, vtype, times[lo + window.index(value)])
+    return extremum
+
+
+def _start(times, values, lo, hi, lo_time, hi_time, vtype):
+    if lo == hi:
+        return make_datavalue(None, vtype, lo_time)
+    return make_datavalue(values[lo], vtype, times[lo])
+
+
+def _end(times, values, lo, hi, lo_time, hi_time, vtype):
+    if lo == hi:
+        return make_datavalue(None, vtype, lo_time)
+    return make_datavalue(values[hi - 1], vtype, times[hi - 1])
+
+
+def _delta(times, values, lo, hi, lo_time, hi_time, vtype):
+    if lo == hi:
+        return make_datavalue(None, vtype, lo_time)
+    return make_datavalue(values[hi - 1] - values[lo], ua.VariantType.Double, lo_time)
+
+
+def _interpolative(times, values, lo, hi, lo_time, hi_time, vtype):
+    value = _interpolate(times, values, lo_time)
+    return make_datavalue(value, ua.VariantType.Double, lo_time, INTERPOLATED)
+
+
+def _time_average(times, values, lo, hi, lo_time, hi_time, vtype):
+    """
+    integral of the values, linearly interpolated, divided by the duration
+    of the part of the interval with data
+    """
+    points = []
+    first = _interpolate(times, values, lo_time)
+    if first is not None:
+        points.append((lo_time, first))
+    points.extend(zip(times[lo:hi], values[lo:hi]))
+    last = _interpolate(times, values, hi_time)
+    if last is not None:
+        points.append((hi_time, last))
+    if not points:
+        return make_datavalue(None, vtype, lo_time)
+    duration = points[-1][0] - points[0][0]
+    if not duration:
+        return make_datavalue(points[0][1], ua.VariantType.Double, lo_time)
+    area = 0
+    for (t1, v1), (t2, v2) in zip(points, points[1:]):
+        area += (t2 - t1) * (v1 + v2) / 2.0
+    return make_datavalue(area / duration, ua.VariantType.Double, lo_time)
+
+
+_AGGREGATES = {
+    ua.ObjectIds.AggregateFunction_Interpolative: _interpolative,
+    ua.ObjectIds.AggregateFunction_Average: _average,
+    ua.ObjectIds.AggregateFunction_TimeAverage: _time_average,
+    ua.ObjectIds.AggregateFunction_Minimum: _extremum(min),
+    ua.ObjectIds.AggregateFunction_Maximum: _extremum(max),
+    ua.ObjectIds.AggregateFunction_Count: _count,
+    ua.ObjectIds.AggregateFunction_Start: _start,
+    ua.ObjectIds.AggregateFunction_End: _end,
+    ua.ObjectIds.AggregateFunction_Delta: _delta,
+}
@@ -0,0 +1,272 @@
+"""
+in memory history backend storing every node history as typed columns
+"""
+
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import compress
+from datetime import datetime, timedelta
+
+from opcua import ua
+from opcua.ua import ua_binary as uabin
+from opcua.server.history import HistoryStorageInterface, UaNodeAlreadyHistorizedError
+from opcua.server import history_aggregates
+
+# array typecode used to store scalar values of numeric variant types
+_TYPECODES = {
+    ua.VariantType.Boolean: 'b',
+    ua.VariantType.SByte: 'b',
+    ua.VariantType.Byte: 'B',
+    ua.VariantType.Int16: 'h',
+    ua.VariantType.UInt16: 'H',
+    ua.VariantType.Int32: 'i',
+    ua.VariantType.UInt32: 'I',
+    ua.VariantType.Int64: 'q',
+    ua.VariantType.UInt64: 'Q',
+    ua.VariantType.Float: 'f',
+    ua.VariantType.Double: 'd',
+}
+
+_NO_TIMESTAMP = -1
+_COMPACT_MIN = 1024  # do not compact columns for less trimmed rows
+
+
+def _to_filetime(dt):
+    if dt is None:
+        return _NO_TIMESTAMP
+    return uabin.datetime_to_win_epoch(dt)
+
+
+def _from_filetime(ft):
+    if ft == _NO_TIMESTAMP:
+        return None
+    return uabin.win_epoch_to_datetime(ft)
+
+
+class _Columns(object):
+    """
+    rows sorted by time, stored as parallel columns.
+    rows before start are trimmed and removed from the columns once they
+    are a large part of them, so trimming is amortized O(1)
+    """
+
+    def __init__(self, period, count):
+        self.period = period
+        self.count = count
+        self.start = 0
+        self.times = array('q')
+
+    def __len__(self):
+        return len(self.times) - self.start
+
+    def insert_position(self, time):
+        """
+        return where a row with timestamp time must be inserted to keep rows sorted
+        """
+        times = self.times
+        if not times or times[-1] <= time:
+            return len(times)
+        return bisect_right(times, time, self.start)
+
+    def trim(self):
+        """
+        apply period and count retention
+        """
+        if self.period:
+            limit = uabin.datetime_to_win_epoch(datetime.utcnow() - self.period)
+            self.start = max(self.start, bisect_left(self.times, limit, self.start))
+        if self.count and len(self) > self.count:
+            self.start = len(self.times) - self.count
+        if self.start > _COMPACT_MIN and self.start * 2 > len(self.times):
+            self.compact(self.start)
+            self.start = 0
+
+    def compact(self, end):
+        del self.times[:end]
+
+    def bounds(self, start, end, nb_values):
+        """
+        return the indexes of the rows to read, in read order, and the index of
+        the first row not returned, or None
+        """
+        order = 1
+        if start is None or start == ua.get_win_epoch():
+            order = -1
+            start = ua.get_win_epoch()
+        if end is None or end == ua.get_win_epoch():
+            end = datetime.utcnow() + timedelta(days=1)
+        if start > end:
+            order = -1
+            start, end = end, start
+        lo = bisect_left(self.times, uabin.datetime_to_win_epoch(start), self.start)
+        hi = bisect_right(self.times, uabin.datetime_to_win_epoch(end), lo)
+        indexes = range(lo, hi) if order == 1 else range(hi - 1, lo - 1, -1)
+        cont = None
+        if nb_values and len(indexes) > nb_values:
+            cont = indexes[nb_values]
+            indexes = indexes[:nb_values]
+        return indexes, cont
+
+
+class _ValueColumns(_Columns):
+    """
+    history of one node. Scalar numeric values of the same variant type are
+    stored in a typed array, other values as Variants in a list
+    """
+
+    def __init__(self, period, count):
+        _Columns.__init__(self, period, count)
+        self.source_times = array('q')
+        self.statuses = array('I')
+        self.variant_type = None  # type of the values in a typed array, None if values are Variants
+        self.values = []
+
+    def append(self, datavalue):
+        value = self._column_value(datavalue.Value)
+        time = _to_filetime(datavalue.ServerTimestamp)
+        pos = self.insert_position(time)
+        for column, val in ((self.values, value),
+                            (self.times, time),
+                            (self.source_times, _to_filetime(datavalue.SourceTimestamp)),
+                            (self.statuses, datavalue.StatusCode.value)):
+            if pos == len(column):
+                column.append(val)
+            else:
+                column.insert(pos, val)
+        self.trim()
+
+    def _column_value(self, variant):
+        """
+        return what to store in the values column for variant.
+        the column type is chosen with the first value and becomes a list of
+        Variants when a value of another type is saved
+        """
+        if self.variant_type is not None:
+            if variant.VariantType == self.variant_type and not variant.is_array:
+                return variant.Value
+            vtype = self.variant_type
+            self.variant_type = None
+            self.values = [self._variant(val, vtype) for val in self.values]
+        elif not self.times and variant.VariantType in _TYPECODES and not variant.is_array:
+            self.variant_type = variant.VariantType
+            self.values = array(_TYPECODES[variant.VariantType])
+            return variant.Value
+        return variant
+
+    @staticmethod
+    def _variant(val, vtype):
+        if vtype == ua.VariantType.Boolean:
+            val = bool(val)
+        return ua.Variant(val, vtype)
+
+    def compact(self, end):
+        _Columns.compact(self, end)
+        del self.source_times[:end]
+        del self.statuses[:end]
+        del self.values[:end]
+
+    def datavalue(self, idx):
+        val = self.values[idx]
+        if self.variant_type is not None:
+            val = self._variant(val, self.variant_type)
+        dv = ua.DataValue(val)
+        dv.ServerTimestamp = _from_filetime(self.times[idx])
+        dv.SourceTimestamp = _from_filetime(self.source_times[idx])
+        dv.StatusCode = ua.StatusCode(self.statuses[idx])
+        return dv
+
+
+class _EventColumns(_Columns):
+    """
+    events of one source, sorted by their Time field
+    """
+
+    def __init__(self, period, count):
+        _Columns.__init__(self, period, count)
+        self.events = []
+
+    def append(self, event):
+        time = _to_filetime(event.Time)
+        pos = self.insert_position(time)
+        if pos == len(self.times):
+            self.times.append(time)
+            self.events.append(event)
+        else:
+            self.times.insert(pos, time)
+            self.events.insert(pos, event)
+        self.trim()
+
+    def compact(self, end):
+        _Columns.compact(self, end)
+        del self.events[:end]
+
+
+class HistoryColumnar(HistoryStorageInterface):
+    """
+    history backend storing data in memory like HistoryDict, but with the
+    timestamps, status codes and numeric values of every node in typed arrays.
+    Reads find their bounds by binary search and only create DataValues
+    for the returned values.
+    """
+
+    def __init__(self):
+        self._datachanges = {}
+        self._events = {}
+
+    def new_historized_node(self, node_id, period, count=0):
+        if node_id in self._datachanges:
+            raise UaNodeAlreadyHistorizedError(node_id)
+        self._datachanges[node_id] = _ValueColumns(period, count)
+
+    def save_node_value(self, node_id, datavalue):
+        self._datachanges[node_id].append(datavalue)
+
+    def read_node_history(self, node_id, start, end, nb_values):
+        columns = self._datachanges.get(node_id)
+        if columns is None:
+            return [], None
+        indexes, cont = columns.bounds(start, end, nb_values)
+        results = [columns.datavalue(idx) for idx in indexes]
+        if cont is not None:
+            cont = _from_filetime(columns.times[cont])
+        return results, cont
+
+    def read_node_aggregates(self, node_id, start, end, interval, aggregate, config):
+        columns = self._datachanges.get(node_id)
+        if columns is None or columns.variant_type is None:
+            return HistoryStorageInterface.read_node_aggregates(self, node_id, start, end, interval, aggregate, config)
+        bounds = history_aggregates.intervals(start, end, interval)
+        # slice the columns once, with one value on each side for interpolation
+        lo = max(bisect_left(columns.times, bounds[0][0], columns.start) - 1, columns.start)
+        hi = min(bisect_right(columns.times, bounds[-1][1], lo) + 1, len(columns.times))
+        times = columns.times[lo:hi]
+        values = columns.values[lo:hi]
+        statuses = columns.statuses[lo:hi]
+        limit = history_aggregates.status_limit(config)
+        if statuses and max(statuses) >= limit:
+            keep = [status < limit for status in statuses]
+            times = array('q', compress(times, keep))
+            values = array(values.typecode, compress(values, keep))
+        results = history_aggregates.compute(aggregate, times, values, bounds, columns.variant_type)
+        return history_aggregates.in_request_order(results, start, end)
+
+    def new_historized_event(self, source_id, evtypes, period, count=0):
+        if source_id in self._events:
+            raise UaNodeAlreadyHistorizedError(source_id)
+        self._events[source_id] = _EventColumns(period, count)
+
+    def save_event(self, event):
+        self._events[event.SourceNode].append(event)
+
+    def read_event_history(self, source_id, start, end, nb_values, evfilter):
+        columns = self._events.get(source_id)
+        if columns is None:
+            return [], None
+        indexes, cont = columns.bounds(start, end, nb_values)
+        results = [columns.events[idx] for idx in indexes]
+        if cont is not None:
+            cont = _from_filetime(columns.times[cont])
+        return results, cont
+
+    def stop(self):
+        pass
@@ -0,0 +1,389 @@
+"""
+history backend appending values and events to memory mapped segment files
+"""
+
+import os
+import mmap
+import struct
+import logging
+import binascii
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from threading import Lock
+
+from opcua import ua
+from opcua.ua import ua_binary as uabin
+from opcua.common.utils import Buffer
+from opcua.common import events
+from opcua.server.history import HistoryStorageInterface
+
+# server timestamp, source timestamp, status code, offset and length of the data in the .dat file
+_RECORD = struct.Struct("<qqIQI")
+_NO_TIMESTAMP = -1
+_replace = getattr(os, "replace", os.rename)  # python 2 has no os.replace
+
+
+def _to_filetime(dt):
+    if dt is None:
+        return _NO_TIMESTAMP
+    return uabin.datetime_to_win_epoch(dt)
+
+
+def _from_filetime(ft):
+    if ft == _NO_TIMESTAMP:
+        return None
+    return uabin.win_epoch_to_datetime(ft)
+
+
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+
+
+class _Segment(object):
+    """
+    the records of one time slice: fixed size records in a .idx file and
+    the encoded variants they point to in a .dat file
+    """
+
+    def __init__(self, directory, start):
+        self.start = start
+        base = os.path.join(directory, "{0:020d}".format(start))
+        self.idx_path = base + ".idx"
+        self.dat_path = base + ".dat"
+
+    @property
+    def count(self):
+        try:
+            return os.path.getsize(self.idx_path) // _RECORD.size
+        except OSError:
+            return 0
+
+    def delete(self):
+        for path in (self.idx_path, self.dat_path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+class _SegmentLog(object):
+    """
+    log of one node or event source, split in segments of span FILETIME
+    units. Records are appended to the last segment, records older than the
+    last one are inserted in order in the segment covering them.
+    """
+
+    def __init__(self, directory, span, period, count):
+        self.directory = directory
+        self.span = span
+        self.period = period
+        self.count = count
+        self._idx = None
+        self._dat = None
+        self._dat_size = 0
+        self._last_time = None
+        _makedirs(directory)
+        starts = sorted(int(name[:-4]) for name in os.listdir(directory) if name.endswith(".idx"))
+        self.segments = [_Segment(directory, start) for start in starts]
+        if self.segments:
+            # repair the last segment and read its last timestamp, files are opened again on append
+            self._open(self.segments[-1])
+            self.close()
+        self.trim()
+
+    def _open(self, segment):
+        """
+        open segment for appending, dropping a record partially written before a crash.
+        data written without its record is left in the .dat file, no record points to it
+        """
+        self.close()
+        self._idx = open(segment.idx_path, "ab")
+        self._dat = open(segment.dat_path, "ab")
+        nb = self._idx.tell() // _RECORD.size
+        self._dat.seek(0, os.SEEK_END)
+        self._dat_size = self._dat.tell()
+        self._last_time = None
+        with open(segment.idx_path, "rb") as f:
+            while nb:
+                f.seek((nb - 1) * _RECORD.size)
+                last = _RECORD.unpack(f.read(_RECORD.size))
+                if last[3] + last[4] <= self._dat_size:
+                    self._last_time = last[0]
+                    break
+                nb -= 1
+        self._idx.truncate(nb * _RECORD.size)
+        self._idx.seek(0, os.SEEK_END)
+
+    def close(self):
+        for f in (self._idx, self._dat):
+            if f is not None:
+                f.close()
+        self._idx = None
+        self._dat = None
+
+    def flush(self):
+        if self._idx is not None:
+            self._dat.flush()
+            self._idx.flush()
+
+    def append(self, time, source_time, status, data):
+        if self._last_time is not None and time < self._last_time:
+            self._insert(time, source_time, status, data)
+            return
+        if not self.segments or time >= self.segments[-1].start + self.span:
+            start = time - time % self.span
+            if self.segments:
+                start = max(start, self.segments[-1].start + self.span)
+            self.segments.append(_Segment(self.directory, start))
+            self._open(self.segments[-1])
+            self.trim()
+        elif self._idx is None:
+            self._open(self.segments[-1])
+        self._dat.write(data)
+        self._idx.write(_RECORD.pack(time, source_time, status, self._dat_size, len(data)))
+        self._dat_size += len(data)
+        self._last_time = time
+
+    def _insert(self, time, source_time, status, data):
+        """
+        insert a record older than the last one in the segment covering it.
+        the data is appended to the .dat file and the .idx file is rewritten
+        with the record at its place, then renamed over the old one
+        """
+        self.flush()
+        idx = len(self.segments) - 1
+        while idx > 0 and self.segments[idx].start > time:
+            idx -= 1
+        segment = self.segments[idx]
+        if segment.start > time:
+            # older than every segment, start a new one before them
+            segment = _Segment(self.directory, time - time % self.span)
+            self.segments.insert(0, segment)
+        current = segment is self.segments[-1]
+        with open(segment.dat_path, "ab") as f:
+            f.seek(0, os.SEEK_END)
+            offset = f.tell()
+            f.write(data)
+        try:
+            with open(segment.idx_path, "rb") as f:
+                records = f.read()
+        except IOError:
+            records = b""
+        records = records[:len(records) - len(records) % _RECORD.size]
+        pos = self._search(records, time, 0, len(records) // _RECORD.size, True) * _RECORD.size
+        tmp_path = segment.idx_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(records[:pos])
+            f.write(_RECORD.pack(time, source_time, status, offset, len(data)))
+            f.write(records[pos:])
+        if current:
+            # the append handles must not point to the replaced file
+            self.close()
+        _replace(tmp_path, segment.idx_path)
+        self.trim()
+
+    def trim(self):
+        """
+        delete whole segments older than period, and segments not needed to keep count records
+        """
+        if self.period:
+            limit = uabin.datetime_to_win_epoch(datetime.utcnow() - self.period)
+            while len(self.segments) > 1 and self.segments[0].start + self.span <= limit:
+                self.segments.pop(0).delete()
+        if self.count:
+            counts = [segment.count for segment in self.segments]
+            total = sum(counts)
+            while len(self.segments) > 1 and total - counts[0] >= self.count:
+                total -= counts.pop(0)
+                self.segments.pop(0).delete()
+
+    def read(self, start, end, nb_values):
+        """
+        return (server timestamp, source timestamp, status, data) of records
+        between start and end in read order, at most nb_values + 1 of them
+        """
+        order = 1
+        if start is None or start == ua.get_win_epoch():
+            order = -1
+            start = ua.get_win_epoch()
+        if end is None or end == ua.get_win_epoch():
+            end = datetime.utcnow() + timedelta(days=1)
+        if start > end:
+            order = -1
+            start, end = end, start
+        start = uabin.datetime_to_win_epoch(start)
+        end = uabin.datetime_to_win_epoch(end)
+        self.flush()
+        segments = [seg for idx, seg in enumerate(self.segments)
+                    if seg.start <= end and (idx + 1 == len(self.segments) or self.segments[idx + 1].start > start)]
+        if order == -1:
+            segments.reverse()
+        results = []
+        for segment in segments:
+            limit = nb_values + 1 - len(results) if nb_values else 0
+            results.extend(self._read_segment(segment, start, end, order, limit))
+            if nb_values and len(results) > nb_values:
+                break
+        return results
+
+    def _read_segment(self, segment, start, end, order, limit):
+        nb = segment.count
+        if not nb:
+            return []
+        with open(segment.idx_path, "rb") as fidx, open(segment.dat_path, "rb") as fdat:
+            idx = mmap.mmap(fidx.fileno(), nb * _RECORD.size, access=mmap.ACCESS_READ)
+            try:
+                lo = self._search(idx, start, 0, nb, False)
+                hi = self._search(idx, end, lo, nb, True)
+                indexes = range(lo, hi) if order == 1 else range(hi - 1, lo - 1, -1)
+                if limit:
+                    indexes = indexes[:limit]
+                if not indexes:
+                    return []
+                records = [_RECORD.unpack_from(idx, i * _RECORD.size) for i in indexes]
+            finally:
+                idx.close()
+            size = max(rec[3] + rec[4] for rec in records)
+            dat = mmap.mmap(fdat.fileno(), size, access=mmap.ACCESS_READ) if size else b""
+            try:
+                return [(rec[0], rec[1], rec[2], dat[rec[3]:rec[3] + rec[4]]) for rec in records]
+            finally:
+                if size:
+                    dat.close()
+
+    @staticmethod
+    def _search(idx, time, lo, hi, after):
+        """
+        binary search the first record with a timestamp >= time, or > time if after is True
+        """
+        while lo < hi:
+            mid = (lo + hi) // 2
+            ts = _RECORD.unpack_from(idx, mid * _RECORD.size)[0]
+            if ts < time or (after and ts == time):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+
+def _event_to_binary(event):
+    fields = event.get_event_props_as_fields_dict()
+    packet = [uabin.Primitives.Int32.pack(len(fields))]
+    for name, variant in fields.items():
+        packet.append(uabin.Primitives.String.pack(name))
+        packet.append(variant.to_binary())
+    return b"".join(packet)
+
+
+def _event_from_binary(data):
+    data = Buffer(data)
+    fields = {}
+    for _ in range(uabin.Primitives.Int32.unpack(data)):
+        name = uabin.Primitives.String.unpack(data)
+        fields[name] = ua.Variant.from_binary(data)
+    return events.Event.from_field_dict(fields)
+
+
+class HistorySegments(HistoryStorageInterface):
+    """
+    history backend storing the history of every node, and the events of
+    every source, in a directory of segment files covering segment_duration
+    each.
+    Values are appended to the files. A value or event older than the last
+    one saved, for example after the clock of an event source stepped back,
+    is inserted in order by rewriting the index file of its segment, which
+    is slower than an append. Reads memory map the segments of the requested
+    time range and find their bounds by binary search. Retention deletes whole segments,
+    so up to one segment more than period or count is kept.
+    Files are reused when the server restarts.
+    Only the last max_open_logs nodes or sources written to keep their
+    files open for appending, the others are closed until their next write.
+    """
+
+    def __init__(self, path="history", segment_duration=timedelta(hours=1), max_open_logs=64):
+        self.logger = logging.getLogger(__name__)
+        self._path = path
+        self._span = int(segment_duration.total_seconds() * 10 ** 7)
+        self.max_open_logs = max_open_logs
+        self._open_logs = OrderedDict()  # logs whose files may be open, least recently written first
+        self._lock = Lock()
+        self._datachanges = {}
+        self._events = {}
+
+    def _directory(self, kind, node_id):
+        name = binascii.hexlify(node_id.to_binary()).decode("ascii")
+        return os.path.join(self._path, kind, name)
+
+    def _written(self, log):
+        """
+        mark log as the most recently written one and close the files of the least recent ones
+        """
+        self._open_logs.pop(log, None)
+        self._open_logs[log] = None
+        while len(self._open_logs) > self.max_open_logs:
+            self._open_logs.popitem(last=False)[0].close()
+
+    def new_historized_node(self, node_id, period, count=0):
+        with self._lock:
+            self._datachanges[node_id] = _SegmentLog(self._directory("values", node_id), self._span, period, count)
+
+    def save_node_value(self, node_id, datavalue):
+        with self._lock:
+            log = self._datachanges[node_id]
+            log.append(_to_filetime(datavalue.ServerTimestamp),
+                       _to_filetime(datavalue.SourceTimestamp),
+                       datavalue.StatusCode.value,
+                       datavalue.Value.to_binary())
+            self._written(log)
+
+    def read_node_history(self, node_id, start, end, nb_values):
+        with self._lock:
+            log = self._datachanges.get(node_id)
+            if log is None:
+                return [], None
+            records = log.read(start, end, nb_values)
+        results = []
+        for server_time, source_time, status, data in records:
+            dv = ua.DataValue(ua.Variant.from_binary(Buffer(data)))
+            dv.ServerTimestamp = _from_filetime(server_time)
+            dv.SourceTimestamp = _from_filetime(source_time)
+            dv.StatusCode = ua.StatusCode(status)
+            results.append(dv)
+        cont = None
+        if nb_values and len(results) > nb_values:
+            cont = results[nb_values].ServerTimestamp
+            results = results[:nb_values]
+        return results, cont
+
+    def new_historized_event(self, source_id, evtypes, period, count=0):
+        with self._lock:
+            self._events[source_id] = _SegmentLog(self._directory("events", source_id), self._span, period, count)
+
+    def save_event(self, event):
+        with self._lock:
+            log = self._events[event.SourceNode]
+            log.append(_to_filetime(event.Time), _NO_TIMESTAMP, 0, _event_to_binary(event))
+            self._written(log)
+
+    def read_event_history(self, source_id, start, end, nb_values, evfilter):
+        with self._lock:
+            log = self._events.get(source_id)
+            if log is None:
+                return [], None
+            records = log.read(start, end, nb_values)
+        cont = None
+        if nb_values and len(records) > nb_values:
+            cont = _from_filetime(records[nb_values][0])
+            records = records[:nb_values]
+        return [_event_from_binary(record[3]) for record in records], cont
+
+    def stop(self):
+        with self._lock:
+            for log in list(self._datachanges.values()) + list(self._events.values()):
+                log.close()
+            self._open_logs.clear()
+            self.logger.info('Historizing segment files closed')
@@ -1,13 +1,67 @@
 import logging
 from datetime import timedelta
 from datetime import datetime
-from threading import Lock
+from threading import Lock, Thread, Event
+from collections import OrderedDict
+import time
 import sqlite3
 
 from opcua import ua
+from opcua.ua import ua_binary as uabin
 from opcua.common.utils import Buffer
 from opcua.common import events
 from opcua.server.history import HistoryStorageInterface
+from opcua.server import history_aggregates
+
+SCHEMA_VERSION = 1  # 1: timestamps stored as FILETIME integers
+
+# aggregates computed by SQLite, selecting value, timestamp and the stored variant for every interval.
+# aggregates returning a raw value return the stored variant so integers keep their precision
+_SQL_AGGREGATES = {
+    ua.ObjectIds.AggregateFunction_Average: 'AVG({v}), NULL, NULL',
+    ua.ObjectIds.AggregateFunction_Count: 'COUNT(*), NULL, NULL',
+    # SQLite takes the other columns from the row holding the MIN or MAX
+    ua.ObjectIds.AggregateFunction_Minimum: 'MIN({v}), ServerTimestamp, VariantBinary',
+    ua.ObjectIds.AggregateFunction_Maximum: 'MAX({v}), ServerTimestamp, VariantBinary',
+    ua.ObjectIds.AggregateFunction_Start: 'NULL, MIN(ServerTimestamp), VariantBinary',
+    ua.ObjectIds.AggregateFunction_End: 'NULL, MAX(ServerTimestamp), VariantBinary',
+}
+# integers are compared as integers so large Int64 values keep their precision,
+# UInt64 values may not fit in an SQLite integer
+_SQL_NUMBER = ("CASE WHEN VariantType = 'Boolean' THEN Value = 'True'"
+               " WHEN VariantType IN ('Float', 'Double', 'UInt64') THEN CAST(Value AS REAL)"
+               " ELSE CAST(Value AS INTEGER) END")
+_SQL_NUMBER_TYPES = ', '.join("'{0}'".format(vtype.name) for vtype in (
+    ua.VariantType.Boolean, ua.VariantType.SByte, ua.VariantType.Byte, ua.VariantType.Int16,
+    ua.VariantType.UInt16, ua.VariantType.Int32, ua.VariantType.UInt32, ua.VariantType.Int64,
+    ua.VariantType.UInt64, ua.VariantType.Float, ua.VariantType.Double))
+# the encoding mask of an array variant, its first byte, has the 0x80 bit set
+_SQL_NOT_ARRAY = "hex(substr(VariantBinary, 1, 1)) < '80'"
+
+
+def _to_filetime(dt):
+    if dt is None:
+        return None
+    return uabin.datetime_to_win_epoch(dt)
+
+
+def _from_filetime(ft):
+    if ft is None:
+        return None
+    return uabin.win_epoch_to_datetime(ft)
+
+
+def _text_to_filetime(text):
+    """
+    convert a timestamp stored as text by schema version 0
+    """
+    if text is None:
+        return None
+    try:
+        fmt = "%Y-%m-%d %H:%M:%S.%f" if "." in text else "%Y-%m-%d %H:%M:%S"
+        return _to_filetime(datetime.strptime(text, fmt))
+    except ValueError:
+        return None
 
 
 class HistorySQLite(HistoryStorageInterface):
@@ -15,17 +69,43 @@ class HistorySQLite(HistoryStorageInterface):
     history backend which stores data values and object events in a SQLite database
     this backend is intended to only be accessed via OPC UA, therefore all UA Variants saved in
     the history database are in binary format (SQLite BLOBs)
-    note that PARSE_DECLTYPES is active so certain data types (such as datetime) will not be BLOBs
+    timestamps are stored as FILETIME integers, as in the binary protocol, with an index
+    so reads of a time range do not scan the table. Databases created by older versions are
+    converted when opened
+
+    by default every value and event is written in its own transaction. max_batch and flush_interval
+    (in seconds) enable write-behind: rows are buffered in memory and written in one transaction when
+    max_batch rows are buffered or every flush_interval. Reads always see buffered rows, rows not yet
+    written are lost if the process dies.
+    rows older than period or beyond count are deleted every cleanup_interval seconds
     """
 
-    def __init__(self, path="history.db"):
+    def __init__(self, path="history.db", max_batch=0, flush_interval=0, cleanup_interval=60):
         self.logger = logging.getLogger(__name__)
         self._datachanges_period = {}
+        self._events_period = {}
         self._db_file = path
         self._lock = Lock()
         self._event_fields = {}
+        self.max_batch = max_batch
+        self.cleanup_interval = cleanup_interval
+        self._write_behind = bool(max_batch or flush_interval)
+        self._pending = OrderedDict()  # insert statement -> list of parameters
+        self._pending_rows = 0
+        self._last_cleanup = 0
 
         self._conn = sqlite3.connect(self._db_file, detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False)
+        # with WAL a commit only appends to the log and readers do not block writers
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._migrate()
+
+        self._stopped = Event()
+        self._flusher = None
+        if flush_interval:
+            self._flusher = Thread(target=self._flush_loop, args=(flush_interval,))
+            self._flusher.daemon = True
+            self._flusher.start()
 
     def new_historized_node(self, node_id, period, count=0):
         with self._lock:
@@ -39,8 +119,8 @@ class HistorySQLite(HistoryStorageInterface):
             # note: Value/VariantType TEXT is only for human reading, the actual data is stored in VariantBinary column
             try:
                 _c_new.execute('CREATE TABLE "{tn}" (_Id INTEGER PRIMARY KEY NOT NULL,'
-                               ' ServerTimestamp TIMESTAMP,'
-                               ' SourceTimestamp TIMESTAMP,'
+                               ' ServerTimestamp INTEGER,'
+                               ' SourceTimestamp INTEGER,'
                                ' StatusCode INTEGER,'
                                ' Value TEXT,'
                                ' VariantType TEXT,'
@@ -49,56 +129,26 @@ class HistorySQLite(HistoryStorageInterface):
             except sqlite3.Error as e:
                 self.logger.info('Historizing SQL Table Creation Error for %s: %s', node_id, e)
 
+            self._create_time_index(table, 'ServerTimestamp')
             self._conn.commit()
 
     def save_node_value(self, node_id, datavalue):
         with self._lock:
-            _c_sub = self._conn.cursor()
-
             table = self._get_table_name(node_id)
-
-            # insert the data change into the database
-            try:
-                _c_sub.execute('INSERT INTO "{tn}" VALUES (NULL, ?, ?, ?, ?, ?, ?)'.format(tn=table),
-                               (
-                                   datavalue.ServerTimestamp,
-                                   datavalue.SourceTimestamp,
-                                   datavalue.StatusCode.value,
-                                   str(datavalue.Value.Value),
-                                   datavalue.Value.VariantType.name,
-                                   sqlite3.Binary(datavalue.Value.to_binary())
-                               )
-                              )
-            except sqlite3.Error as e:
-                self.logger.error('Historizing SQL Insert Error for %s: %s', node_id, e)
-
-            self._conn.commit()
-
-            # get this node's period from the period dict and calculate the limit
-            period, count = self._datachanges_period[node_id]
-
-            def execute_sql_delete(condition, args):
-                query = ('DELETE FROM "{tn}" WHERE ' + condition).format(tn=table)
-
-                try:
-                    _c_sub.execute(query, args)
-                except sqlite3.Error as e:
-                    self.logger.error('Historizing SQL Delete Old Data Error for %s: %s', node_id, e)
-
-                self._conn.commit()
-
-            if period:
-                # after the insert, if a period was specified delete all records older than period
-                date_limit = datetime.utcnow() - period
-                execute_sql_delete('ServerTimestamp < ?', (date_limit,))
-
-            if count:
-                # ensure that no more than count records are stored for the specified node
-                execute_sql_delete('ServerTimestamp = (SELECT CASE WHEN COUNT(*) > ? '
-                                   'THEN MIN(ServerTimestamp) ELSE NULL END FROM "{tn}")', (count,))
+            self._queue('INSERT INTO "{tn}" VALUES (NULL, ?, ?, ?, ?, ?, ?)'.format(tn=table),
+                        (
+                            _to_filetime(datavalue.ServerTimestamp),
+                            _to_filetime(datavalue.SourceTimestamp),
+                            datavalue.StatusCode.value,
+                            str(datavalue.Value.Value),
+                            datavalue.Value.VariantType.name,
+                            sqlite3.Binary(datavalue.Value.to_binary())
+                        )
+                       )
 
     def read_node_history(self, node_id, start, end, nb_values):
         with self._lock:
+            self._flush()
             _c_read = self._conn.cursor()
 
             table = self._get_table_name(node_id)
@@ -109,15 +159,16 @@ class HistorySQLite(HistoryStorageInterface):
 
             # select values from the database; recreate UA Variant from binary
             try:
-                for row in _c_read.execute('SELECT * FROM "{tn}" WHERE "ServerTimestamp" BETWEEN ? AND ? '
-                                           'ORDER BY "_Id" {dir} LIMIT ?'.format(tn=table, dir=order),
-                                           (start_time, end_time, limit,)):
+                for row in _c_read.execute('SELECT ServerTimestamp, SourceTimestamp, StatusCode, VariantBinary'
+                                           ' FROM "{tn}" WHERE "ServerTimestamp" BETWEEN ? AND ? '
+                                           'ORDER BY "ServerTimestamp" {dir}, "_Id" {dir} LIMIT ?'
+                                           .format(tn=table, dir=order), (start_time, end_time, limit,)):
 
                     # rebuild the data value object
-                    dv = ua.DataValue(ua.Variant.from_binary(Buffer(row[6])))
-                    dv.ServerTimestamp = row[1]
-                    dv.SourceTimestamp = row[2]
-                    dv.StatusCode = ua.StatusCode(row[3])
+                    dv = ua.DataValue(ua.Variant.from_binary(Buffer(row[3])))
+                    dv.ServerTimestamp = _from_filetime(row[0])
+                    dv.SourceTimestamp = _from_filetime(row[1])
+                    dv.StatusCode = ua.StatusCode(row[2])
 
                     results.append(dv)
 
@@ -132,6 +183,58 @@ class HistorySQLite(HistoryStorageInterface):
 
             return results, cont
 
+    def read_node_aggregates(self, node_id, start, end, interval, aggregate, config):
+        if aggregate.Identifier == ua.ObjectIds.AggregateFunction_Delta:
+            first = self.read_node_aggregates(node_id, start, end, interval, ua.NodeId(
+                ua.ObjectIds.AggregateFunction_Start), config)
+            last = self.read_node_aggregates(node_id, start, end, interval, ua.NodeId(
+                ua.ObjectIds.AggregateFunction_End), config)
+            bounds = history_aggregates.in_request_order(history_aggregates.intervals(start, end, interval), start, end)
+            results = []
+            for dv_first, dv_last, (lo_time, _) in zip(first, last, bounds):
+                value = None
+                if dv_first.StatusCode.is_good():
+                    value = dv_last.Value.Value - dv_first.Value.Value
+                results.append(history_aggregates.make_datavalue(value, ua.VariantType.Double, lo_time))
+            return results
+        if aggregate.Identifier not in _SQL_AGGREGATES:
+            return HistoryStorageInterface.read_node_aggregates(self, node_id, start, end, interval, aggregate, config)
+
+        bounds = history_aggregates.intervals(start, end, interval)
+        with self._lock:
+            self._flush()
+            _c_read = self._conn.cursor()
+
+            table = self._get_table_name(node_id)
+            lo_time, hi_time = bounds[0][0], bounds[-1][1]
+            step = bounds[0][1] - bounds[0][0]
+
+            buckets = {}
+            try:
+                for row in _c_read.execute('SELECT ("ServerTimestamp" - ?) / ? AS _Bucket, {cols} FROM "{tn}"'
+                                           ' WHERE "ServerTimestamp" >= ? AND "ServerTimestamp" < ?'
+                                           ' AND StatusCode < ? AND VariantType IN ({types}) AND {scalar}'
+                                           ' GROUP BY _Bucket'
+                                           .format(cols=_SQL_AGGREGATES[aggregate.Identifier].format(v=_SQL_NUMBER),
+                                                   tn=table, types=_SQL_NUMBER_TYPES, scalar=_SQL_NOT_ARRAY),
+                                           (lo_time, step, lo_time, hi_time, history_aggregates.status_limit(config))):
+                    buckets[row[0]] = row[1:]
+
+            except sqlite3.Error as e:
+                self.logger.error('Historizing SQL Aggregate Error for %s: %s', node_id, e)
+
+        results = []
+        for idx, (lo_time, _) in enumerate(bounds):
+            value, timestamp, binary = buckets.get(idx, (None, None, None))
+            if aggregate.Identifier == ua.ObjectIds.AggregateFunction_Count:
+                results.append(history_aggregates.make_datavalue(value or 0, ua.VariantType.Int32, lo_time))
+            elif timestamp is None:
+                results.append(history_aggregates.make_datavalue(value, ua.VariantType.Double, lo_time))
+            else:
+                variant = ua.Variant.from_binary(Buffer(binary))
+                results.append(history_aggregates.make_datavalue(variant.Value, variant.VariantType, timestamp))
+        return history_aggregates.in_request_order(results, start, end)
+
     def new_historized_event(self, source_id, evtypes, period, count=0):
         with self._lock:
             _c_new = self._conn.cursor()
@@ -139,7 +242,7 @@ class HistorySQLite(HistoryStorageInterface):
             # get all fields for the event type nodes
             ev_fields = self._get_event_fields(evtypes)
 
-            self._datachanges_period[source_id] = period
+            self._events_period[source_id] = period
             self._event_fields[source_id] = ev_fields
 
             table = self._get_table_name(source_id)
@@ -150,51 +253,95 @@ class HistorySQLite(HistoryStorageInterface):
             # properties with these names
             try:
                 _c_new.execute(
-                    'CREATE TABLE "{tn}" (_Id INTEGER PRIMARY KEY NOT NULL, _Timestamp TIMESTAMP, _EventTypeName TEXT, {co})'
+                    'CREATE TABLE "{tn}" (_Id INTEGER PRIMARY KEY NOT NULL, _Timestamp INTEGER, _EventTypeName TEXT, {co})'
                     .format(tn=table, co=columns))
 
             except sqlite3.Error as e:
                 self.logger.info('Historizing SQL Table Creation Error for events from %s: %s', source_id, e)
 
+            self._create_time_index(table, '_Timestamp')
             self._conn.commit()
 
     def save_event(self, event):
         with self._lock:
-            _c_sub = self._conn.cursor()
-
             table = self._get_table_name(event.SourceNode)
             columns, placeholders, evtup = self._format_event(event)
             event_type = event.EventType  # useful for troubleshooting database
 
-            # insert the event into the database
-            try:
-                _c_sub.execute(
-                    'INSERT INTO "{tn}" ("_Id", "_Timestamp", "_EventTypeName", {co}) VALUES (NULL, "{ts}", "{et}", {pl})'
-                    .format(tn=table, co=columns, ts=event.Time, et=event_type, pl=placeholders), evtup)
+            self._queue('INSERT INTO "{tn}" ("_Id", "_Timestamp", "_EventTypeName", {co}) VALUES (NULL, ?, ?, {pl})'
+                        .format(tn=table, co=columns, pl=placeholders), (_to_filetime(event.Time), str(event_type)) + evtup)
 
-            except sqlite3.Error as e:
-                self.logger.error('Historizing SQL Insert Error for events from %s: %s', event.SourceNode, e)
+    def _queue(self, query, args):
+        """
+        buffer one insert, and write the buffer unless write-behind is enabled and it is not full
+        """
+        self._pending.setdefault(query, []).append(args)
+        self._pending_rows += 1
+        if not self._write_behind or (self.max_batch and self._pending_rows >= self.max_batch):
+            self._flush()
 
+    def _flush(self):
+        """
+        write buffered rows in one transaction, and delete old rows if cleanup_interval elapsed.
+        must be called with the lock held
+        """
+        if self._pending:
+            pending = self._pending
+            self._pending = OrderedDict()
+            self._pending_rows = 0
+            _c_sub = self._conn.cursor()
+            for query, rows in pending.items():
+                try:
+                    _c_sub.executemany(query, rows)
+                except sqlite3.Error as e:
+                    self.logger.error('Historizing SQL Insert Error for %s rows: %s', len(rows), e)
             self._conn.commit()
 
-            # get this node's period from the period dict and calculate the limit
-            period = self._datachanges_period[event.SourceNode]
+        if time.time() - self._last_cleanup >= self.cleanup_interval:
+            self._cleanup()
+
+    def _cleanup(self):
+        self._last_cleanup = time.time()
+        _c_sub = self._conn.cursor()
+
+        def execute_sql_delete(table, condition, args):
+            query = ('DELETE FROM "{tn}" WHERE ' + condition).format(tn=table)
+
+            try:
+                _c_sub.execute(query, args)
+            except sqlite3.Error as e:
+                self.logger.error('Historizing SQL Delete Old Data Error for %s: %s', table, e)
+
+        for node_id, (period, count) in self._datachanges_period.items():
+            table = self._get_table_name(node_id)
+            if period:
+                # delete all records older than period
+                date_limit = datetime.utcnow() - period
+                execute_sql_delete(table, 'ServerTimestamp < ?', (_to_filetime(date_limit),))
+
+            if count:
+                # ensure that no more than count records are stored for the specified node
+                execute_sql_delete(table, '_Id <= (SELECT _Id FROM "{tn}" ORDER BY _Id DESC LIMIT 1 OFFSET ?)',
+                                   (count,))
 
+        for source_id, period in self._events_period.items():
             if period:
-                # after the insert, if a period was specified delete all records older than period
                 date_limit = datetime.utcnow() - period
+                execute_sql_delete(self._get_table_name(source_id), '_Timestamp < ?', (_to_filetime(date_limit),))
+
+        self._conn.commit()
 
+    def _flush_loop(self, interval):
+        while not self._stopped.wait(interval):
+            with self._lock:
                 try:
-                    _c_sub.execute('DELETE FROM "{tn}" WHERE Time < ?'.format(tn=table),
-                                   (date_limit.isoformat(' '),))
+                    self._flush()
                 except sqlite3.Error as e:
-                    self.logger.error('Historizing SQL Delete Old Data Error for events from %s: %s',
-                                      event.SourceNode, e)
-
-                self._conn.commit()
+                    self.logger.error('Historizing SQL Flush Error: %s', e)
 
     def read_event_history(self, source_id, start, end, nb_values, evfilter):
         with self._lock:
+            self._flush()
             _c_read = self._conn.cursor()
 
             table = self._get_table_name(source_id)
@@ -208,11 +355,12 @@ class HistorySQLite(HistoryStorageInterface):
             # select events from the database; SQL select clause is built from EventFilter and available fields
             try:
                 for row in _c_read.execute(
-                        'SELECT "_Timestamp", {cl} FROM "{tn}" WHERE "_Timestamp" BETWEEN ? AND ? ORDER BY "_Id" {dir} LIMIT ?'
+                        'SELECT "_Timestamp", {cl} FROM "{tn}" WHERE "_Timestamp" BETWEEN ? AND ? '
+                        'ORDER BY "_Timestamp" {dir}, "_Id" {dir} LIMIT ?'
                         .format(cl=clauses_str, tn=table, dir=order), (start_time, end_time, limit)):
 
                     fdict = {}
-                    cont_timestamps.append(row[0])
+                    cont_timestamps.append(_from_filetime(row[0]))
                     for i, field in enumerate(row[1:]):
                         if field is not None:
                             fdict[clauses[i]] = ua.Variant.from_binary(Buffer(field))
@@ -232,6 +380,53 @@ class HistorySQLite(HistoryStorageInterface):
 
             return results, cont
 
+    def _create_time_index(self, table, column):
+        # the rowid is part of every index, so the index also gives the order of rows with the same timestamp
+        try:
+            self._conn.execute('CREATE INDEX IF NOT EXISTS "{tn}_{co}" ON "{tn}" ("{co}")'.format(tn=table, co=column))
+        except sqlite3.Error as e:
+            self.logger.error('Historizing SQL Index Creation Error for %s: %s', table, e)
+
+    def _migrate(self):
+        """
+        convert the tables of a database created by an older version of this backend
+        """
+        version = self._conn.execute('PRAGMA user_version').fetchone()[0]
+        if version >= SCHEMA_VERSION:
+            return
+        tables = [row[0] for row in self._conn.execute("SELECT name FROM sqlite_master WHERE type='table'")]
+        self._conn.create_function('text_to_filetime', 1, _text_to_filetime)
+        for table in tables:
+            self._migrate_table(table)
+        self._conn.execute('PRAGMA user_version = {0}'.format(SCHEMA_VERSION))
+        self._conn.commit()
+
+    def _migrate_table(self, table):
+        """
+        copy a table with TIMESTAMP columns to a new one with FILETIME integers
+        """
+        columns = [(row[1], row[2]) for row in self._conn.execute('PRAGMA table_info("{tn}")'.format(tn=table))]
+        if not any(ctype == 'TIMESTAMP' for _, ctype in columns):
+            return
+        self.logger.info('Historizing SQL converting timestamps of table %s', table)
+        old = table + '_old'
+        definitions = []
+        values = []
+        for name, ctype in columns:
+            if ctype == 'TIMESTAMP':
+                definitions.append('"{0}" INTEGER'.format(name))
+                values.append('text_to_filetime("{0}")'.format(name))
+            else:
+                definitions.append('"{0}" {1}'.format(name, ctype))
+                values.append('"{0}"'.format(name))
+        definitions[0] += ' PRIMARY KEY NOT NULL'  # _Id
+        self._conn.execute('ALTER TABLE "{tn}" RENAME TO "{old}"'.format(tn=table, old=old))
+        self._conn.execute('CREATE TABLE "{tn}" ({de})'.format(tn=table, de=', '.join(definitions)))
+        self._conn.execute('INSERT INTO "{tn}" SELECT {va} FROM "{old}"'.format(tn=table, va=', '.join(values), old=old))
+        self._conn.execute('DROP TABLE "{old}"'.format(old=old))
+        time_column = '_Timestamp' if columns[1][0] == '_Timestamp' else 'ServerTimestamp'
+        self._create_time_index(table, time_column)
+
     def _get_table_name(self, node_id):
         return str(node_id.NamespaceIndex) + '_' + str(node_id.Identifier)
 
@@ -266,12 +461,12 @@ class HistorySQLite(HistoryStorageInterface):
             end = datetime.utcnow() + timedelta(days=1)
 
         if start < end:
-            start_time = start.isoformat(' ')
-            end_time = end.isoformat(' ')
+            start_time = _to_filetime(start)
+            end_time = _to_filetime(end)
         else:
             order = "DESC"
-            start_time = end.isoformat(' ')
-            end_time = start.isoformat(' ')
+            start_time = _to_filetime(end)
+            end_time = _to_filetime(start)
 
         if nb_values:
             limit = nb_values + 1  # add 1 to the number of values for retrieving a continuation point
@@ -340,6 +535,10 @@ class HistorySQLite(HistoryStorageInterface):
         return sql_str[:-2]  # remove trailing space and comma for SQL syntax
 
     def stop(self):
+        self._stopped.set()
+        if self._flusher is not None:
+            self._flusher.join()
         with self._lock:
+            self._flush()
             self._conn.close()
             self.logger.info('Historizing SQL connection closed')
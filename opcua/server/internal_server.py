@@ -28,6 +28,7 @@ from opcua.server.address_space import ViewService
 from opcua.server.address_space import NodeManagementService
 from opcua.server.address_space import MethodService
 from opcua.server.subscription_service import SubscriptionService
+from opcua.server.uaprocessor import UaProcessor
 from opcua.server.standard_address_space import standard_address_space
 from opcua.server.users import User
 from opcua.common import xmlimporter
@@ -58,20 +59,24 @@ class InternalServer(object):
         self.disabled_clock = False  # for debugging we may want to disable clock that writes too much in log
         self._known_servers = {}  # used if we are a discovery server
 
+        self.loop = utils.ThreadLoop()
+
         self.aspace = AddressSpace()
         self.attribute_service = AttributeService(self.aspace)
         self.view_service = ViewService(self.aspace)
-        self.method_service = MethodService(self.aspace)
+        self.method_service = MethodService(self.aspace, self.loop)
         self.node_mgt_service = NodeManagementService(self.aspace)
 
         self.load_standard_address_space(shelffile)
 
-        self.loop = utils.ThreadLoop()
         self.asyncio_transports = []
         self.subscription_service = SubscriptionService(self.loop, self.aspace)
 
         self.history_manager = HistoryManager(self)
 
+        # request handlers of the connections to this server, see register_service
+        self.services = dict(UaProcessor.services)
+
         # create a session to use on server side
         self.isession = InternalSession(self, self.aspace, self.subscription_service, "Internal", user=User.Admin)
 
@@ -241,6 +246,66 @@ class InternalServer(object):
         """
         self.server_callback_dispatcher.removeListener(event, handle)
 
+    def register_service(self, typeid, handler):
+        """
+        register handler for requests whose binary encoding id is typeid
+        (a NodeId or an ObjectIds integer). An existing handler is replaced.
+        handler is called as handler(processor, requesthdr, algohdr, seqhdr, body)
+        with body positioned after the request header. It must send its answer
+        with processor.send_response() and may return False to close the connection.
+        Raising utils.ServiceError sends a ServiceFault to the client.
+        Registration only applies to this server.
+        """
+        self.services[_service_key(typeid)] = handler
+
+    def unregister_service(self, typeid):
+        """
+        remove handler for typeid, requests of that type will then be answered with BadNotImplemented
+        """
+        self.services.pop(_service_key(typeid), None)
+
+    def get_service(self, typeid):
+        """
+        return handler registered for typeid or None
+        """
+        return self.services.get(_service_key(typeid))
+
+    def wrap_service(self, typeid, middleware):
+        """
+        wrap handler of typeid with middleware.
+        middleware is called with current handler and must return
+        a new handler with the same signature, for example
+        to time, log or authorize requests:
+
+        def timed(handler):
+            def wrapper(processor, requesthdr, algohdr, seqhdr, body):
+                start = time.time()
+                try:
+                    return handler(processor, requesthdr, algohdr, seqhdr, body)
+                finally:
+                    print("request took", time.time() - start)
+            return wrapper
+        server.wrap_service(ua.ObjectIds.ReadRequest_Encoding_DefaultBinary, timed)
+        """
+        key = _service_key(typeid)
+        handler = self.services.get(key)
+        if handler is None:
+            raise ua.UaError("No service registered for {0}".format(typeid))
+        self.services[key] = middleware(handler)
+
+    def wrap_services(self, middleware):
+        """
+        wrap all registered handlers with middleware, see wrap_service
+        """
+        for key, handler in list(self.services.items()):
+            self.services[key] = middleware(handler)
+
+
+def _service_key(typeid):
+    if isinstance(typeid, ua.NodeId):
+        return typeid
+    return ua.NodeId(typeid)
+
 
 class InternalSession(object):
     _counter = 10
@@ -347,8 +412,11 @@ class InternalSession(object):
     def call(self, params):
         return self.iserver.method_service.call(params)
 
-    def create_subscription(self, params, callback):
-        result = self.subscription_service.create_subscription(params, callback)
+    def call_async(self, params):
+        return self.iserver.method_service.call_async(params)
+
+    def create_subscription(self, params, callback, max_message_size=0):
+        result = self.subscription_service.create_subscription(params, callback, max_message_size)
         with self._lock:
             self.subscriptions.append(result.SubscriptionId)
         return result
@@ -384,4 +452,6 @@ class InternalSession(object):
     def publish(self, acks=None):
         if acks is None:
             acks = []
-        return self.subscription_service.publish(acks)
+        with self._lock:
+            subscriptions = list(self.subscriptions)
+        return self.subscription_service.publish(acks, subscriptions)
@@ -3,11 +3,30 @@ server side implementation of a subscription object
 """
 
 from threading import RLock
+from array import array as array_type
+import operator as _operator
+import copy
+import re
+from collections import deque, OrderedDict
 import logging
 # import copy
 # import traceback
 
 from opcua import ua
+from opcua.ua import ua_binary as uabin
+from opcua.common import utils
+
+try:
+    import numpy
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+
+# InfoType DataValue and Overflow bits of a StatusCode
+OVERFLOW_INFOBITS = 0x480
+
+# bytes of a PublishResponse not used by notifications: headers, sequence numbers, security
+PUBLISH_OVERHEAD = 1024
 
 
 class MonitoredItemData(object):
@@ -15,29 +34,17 @@ class MonitoredItemData(object):
     def __init__(self):
         self.client_handle = None
         self.callback_handle = None
+        self.sampler_handle = None
+        self.sampling_interval = 0
+        self.item_to_monitor = None
         self.monitored_item_id = None
         self.mode = None
         self.filter = None
-        self.mvalue = MonitoredItemValues()
+        self.datachange_filter = None
         self.where_clause_evaluator = None
+        self.event_projection = None
         self.queue_size = 0
-
-
-class MonitoredItemValues(object):
-
-    def __init__(self):
-        self.current_value = None
-        self.old_value = None
-
-    def set_current_value(self, cur_val):
-        self.old_value = self.current_value
-        self.current_value = cur_val
-
-    def get_current_value(self):
-        return self.current_value
-
-    def get_old_value(self):
-        return self.old_value
+        self.discard_oldest = True
 
 
 class MonitoredItemService(object):
@@ -52,8 +59,8 @@ class MonitoredItemService(object):
         self.aspace = aspace
         self._lock = RLock()
         self._monitored_items = {}
-        self._monitored_events = {}
         self._monitored_datachange = {}
+        self._monitored_sampled = {}
         self._monitored_item_counter = 111
 
     def delete_all_monitored_items(self):
@@ -83,19 +90,90 @@ class MonitoredItemService(object):
 
     def _modify_monitored_item(self, params):
         with self._lock:
-            for mdata in self._monitored_items.values():
-                result = ua.MonitoredItemModifyResult()
-                if mdata.monitored_item_id == params.MonitoredItemId:
-                    result.RevisedSamplingInterval = params.RequestedParameters.SamplingInterval
-                    result.RevisedQueueSize = params.RequestedParameters.QueueSize
-                    if params.RequestedParameters.Filter is not None:
-                        mdata.filter = params.RequestedParameters.Filter
-                    mdata.queue_size = params.RequestedParameters.QueueSize
-                    return result
             result = ua.MonitoredItemModifyResult()
-            result.StatusCode(ua.StatusCodes.BadMonitoredItemIdInvalid)
+            mdata = self._monitored_items.get(params.MonitoredItemId)
+            if mdata is None:
+                result.StatusCode = ua.StatusCode(ua.StatusCodes.BadMonitoredItemIdInvalid)
+                return result
+            result.RevisedSamplingInterval = mdata.sampling_interval
+            flt = params.RequestedParameters.Filter
+            timestamps = _watch_timestamps(mdata.datachange_filter)
+            if flt is not None and mdata.datachange_filter is not None:
+                result.StatusCode, evaluator = self._make_datachange_filter(mdata.item_to_monitor, flt)
+                if not result.StatusCode.is_good():
+                    return result
+                # deadband is relative to the last reported value, not to a new start
+                evaluator.last = mdata.datachange_filter.last
+                mdata.datachange_filter = evaluator
+            if flt is not None:
+                mdata.filter = flt
+            if mdata.sampler_handle is not None or mdata.callback_handle is not None:
+                interval = self._revise_sampling_interval(mdata.item_to_monitor, params.RequestedParameters)
+                if interval != mdata.sampling_interval or \
+                        (interval and timestamps != _watch_timestamps(mdata.datachange_filter)):
+                    # watch with the new interval first, the item keeps the old one if that fails
+                    status, handle = self._watch_item(mdata, interval)
+                    if status.is_good():
+                        self._unwatch_item(mdata)
+                        self._set_watch_handle(mdata, interval, handle)
+                    result.RevisedSamplingInterval = mdata.sampling_interval
+            mdata.queue_size = self._revise_queue_size(mdata.item_to_monitor, params.RequestedParameters)
+            mdata.discard_oldest = params.RequestedParameters.DiscardOldest
+            result.RevisedQueueSize = mdata.queue_size
             return result
 
+    @property
+    def sampler(self):
+        return self.isub.subservice.sampler
+
+    def _revise_sampling_interval(self, item, params):
+        requested = params.SamplingInterval
+        if requested < 0:
+            # spec says -1 means same rate as the publishing interval
+            requested = self.isub.data.RevisedPublishingInterval
+        return self.sampler.revise_interval(item.NodeId, item.AttributeId, requested)
+
+    def _revise_queue_size(self, item, params):
+        subservice = self.isub.subservice
+        size = params.QueueSize
+        if size == 0 and item.AttributeId == ua.AttributeIds.EventNotifier:
+            size = subservice.default_event_queue_size
+        # 0 and 1 both mean we only keep the last value of data changes
+        return min(max(size, 1), subservice.max_queue_size)
+
+    def _make_datachange_filter(self, item, flt):
+        """
+        return status code and evaluator for the filter of a data change item
+        """
+        if flt is None:
+            return ua.StatusCode(), DataChangeFilterEvaluator()
+        if not isinstance(flt, ua.DataChangeFilter):
+            return ua.StatusCode(ua.StatusCodes.BadMonitoredItemFilterUnsupported), None
+        eurange = None
+        if flt.DeadbandType == ua.DeadbandType.Percent:
+            eurange = self._get_eurange(item.NodeId)
+            if eurange is None:
+                return ua.StatusCode(ua.StatusCodes.BadFilterNotAllowed), None
+        elif flt.DeadbandType not in (ua.DeadbandType.None_, ua.DeadbandType.Absolute):
+            return ua.StatusCode(ua.StatusCodes.BadDeadbandFilterInvalid), None
+        if flt.DeadbandType != ua.DeadbandType.None_ and flt.DeadbandValue < 0:
+            return ua.StatusCode(ua.StatusCodes.BadDeadbandFilterInvalid), None
+        return ua.StatusCode(), DataChangeFilterEvaluator(flt, eurange)
+
+    def _get_eurange(self, nodeid):
+        """
+        return the value of the EURange property of an analog item, or None
+        """
+        nodedata = self.aspace[nodeid]
+        if nodedata is None:
+            return None
+        for ref in nodedata.get_references_by_name(ua.QualifiedName("EURange", 0)):
+            if ref.IsForward and ref.ReferenceTypeId == ua.NodeId(ua.ObjectIds.HasProperty):
+                eurange = self.aspace.get_attribute_value(ref.NodeId, ua.AttributeIds.Value).Value.Value
+                if isinstance(eurange, ua.Range) and eurange.High > eurange.Low:
+                    return eurange
+        return None
+
     def _commit_monitored_item(self, result, mdata):
         if result.StatusCode.is_good():
             self._monitored_items[result.MonitoredItemId] = mdata
@@ -104,7 +182,6 @@ class MonitoredItemService(object):
     def _make_monitored_item_common(self, params):
         result = ua.MonitoredItemCreateResult()
         result.RevisedSamplingInterval = self.isub.data.RevisedPublishingInterval
-        result.RevisedQueueSize = params.RequestedParameters.QueueSize
         self._monitored_item_counter += 1
         result.MonitoredItemId = self._monitored_item_counter
         self.logger.debug("Creating MonitoredItem with id %s", result.MonitoredItemId)
@@ -113,8 +190,11 @@ class MonitoredItemService(object):
         mdata.mode = params.MonitoringMode
         mdata.client_handle = params.RequestedParameters.ClientHandle
         mdata.monitored_item_id = result.MonitoredItemId
-        mdata.queue_size = params.RequestedParameters.QueueSize
+        mdata.item_to_monitor = params.ItemToMonitor
+        mdata.queue_size = self._revise_queue_size(params.ItemToMonitor, params.RequestedParameters)
+        mdata.discard_oldest = params.RequestedParameters.DiscardOldest
         mdata.filter = params.RequestedParameters.Filter
+        result.RevisedQueueSize = mdata.queue_size
 
         return result, mdata
 
@@ -130,12 +210,19 @@ class MonitoredItemService(object):
         if ev_notify_byte is None or not ua.ua_binary.test_bit(ev_notify_byte, ua.EventNotifier.SubscribeToEvents):
             result.StatusCode = ua.StatusCode(ua.StatusCodes.BadServiceUnsupported)
             return result
+        if not isinstance(mdata.filter, ua.EventFilter):
+            result.StatusCode = ua.StatusCode(ua.StatusCodes.BadEventFilterInvalid)
+            return result
         # result.FilterResult = ua.EventFilterResult()  # spec says we can ignore if not error
-        mdata.where_clause_evaluator = WhereClauseEvaluator(self.logger, self.aspace, mdata.filter.WhereClause)
+        try:
+            mdata.where_clause_evaluator = WhereClauseEvaluator(self.logger, self.aspace, mdata.filter.WhereClause)
+        except ua.UaStatusCodeError as ex:
+            self.logger.warning("Invalid WhereClause %s: %s", mdata.filter.WhereClause, ex)
+            result.StatusCode = ua.StatusCode(ex.code)
+            return result
+        mdata.event_projection = self.isub.subservice.get_event_projection(mdata.filter.SelectClauses)
         self._commit_monitored_item(result, mdata)
-        if params.ItemToMonitor.NodeId not in self._monitored_events:
-            self._monitored_events[params.ItemToMonitor.NodeId] = []
-        self._monitored_events[params.ItemToMonitor.NodeId].append(result.MonitoredItemId)
+        self.isub.subservice.add_event_route(params.ItemToMonitor.NodeId, self, result.MonitoredItemId)
         return result
 
     def _create_data_change_monitored_item(self, params):
@@ -144,19 +231,53 @@ class MonitoredItemService(object):
                          params.ItemToMonitor.AttributeId)
 
         result, mdata = self._make_monitored_item_common(params)
-        result.FilterResult = params.RequestedParameters.Filter
-        result.StatusCode, handle = self.aspace.add_datachange_callback(
-            params.ItemToMonitor.NodeId, params.ItemToMonitor.AttributeId, self.datachange_callback)
+        result.StatusCode, mdata.datachange_filter = self._make_datachange_filter(params.ItemToMonitor, mdata.filter)
+        if not result.StatusCode.is_good():
+            return result
+        interval = self._revise_sampling_interval(params.ItemToMonitor, params.RequestedParameters)
+        result.RevisedSamplingInterval = interval
+        result.StatusCode, handle = self._watch_item(mdata, interval)
 
         self.logger.debug("adding callback return status %s and handle %s", result.StatusCode, handle)
-        mdata.callback_handle = handle
         self._commit_monitored_item(result, mdata)
         if result.StatusCode.is_good():
-            self._monitored_datachange[handle] = result.MonitoredItemId
+            self._set_watch_handle(mdata, interval, handle)
             # force data change event generation
-            self.trigger_datachange(handle, params.ItemToMonitor.NodeId, params.ItemToMonitor.AttributeId)
+            variant = self.aspace.get_attribute_value(params.ItemToMonitor.NodeId, params.ItemToMonitor.AttributeId)
+            self._datachange(result.MonitoredItemId, variant)
         return result
 
+    def _watch_item(self, mdata, interval):
+        """
+        sample the item every interval ms, or notify every write if interval is 0.
+        returns a status code and the handle to give to _set_watch_handle
+        """
+        item = mdata.item_to_monitor
+        if interval == 0:
+            # exception based, notify every write
+            return self.aspace.add_datachange_callback(item.NodeId, item.AttributeId, self.datachange_callback)
+        return self.sampler.add_item(item.NodeId, item.AttributeId, interval, self.sampled_callback,
+                                     _watch_timestamps(mdata.datachange_filter))
+
+    def _set_watch_handle(self, mdata, interval, handle):
+        mdata.sampling_interval = interval
+        if interval == 0:
+            mdata.callback_handle = handle
+            self._monitored_datachange[handle] = mdata.monitored_item_id
+        else:
+            mdata.sampler_handle = handle
+            self._monitored_sampled[handle] = mdata.monitored_item_id
+
+    def _unwatch_item(self, mdata):
+        if mdata.callback_handle is not None and mdata.callback_handle in self._monitored_datachange:
+            self.aspace.delete_datachange_callback(mdata.callback_handle)
+            self._monitored_datachange.pop(mdata.callback_handle)
+        if mdata.sampler_handle is not None and mdata.sampler_handle in self._monitored_sampled:
+            self.sampler.delete_item(mdata.sampler_handle)
+            self._monitored_sampled.pop(mdata.sampler_handle)
+        mdata.callback_handle = None
+        mdata.sampler_handle = None
+
     def delete_monitored_items(self, ids):
         self.logger.debug("delete monitored items %s", ids)
         with self._lock:
@@ -168,18 +289,10 @@ class MonitoredItemService(object):
     def _delete_monitored_items(self, mid):
         if mid not in self._monitored_items:
             return ua.StatusCode(ua.StatusCodes.BadMonitoredItemIdInvalid)
-        for k, v in self._monitored_events.items():
-            if mid in v:
-                v.remove(mid)
-                if not v:
-                    self._monitored_events.pop(k)
-                break
-        for k, v in self._monitored_datachange.items():
-            if v == mid:
-                self.aspace.delete_datachange_callback(k)
-                self._monitored_datachange.pop(k)
-                break
-        self._monitored_items.pop(mid)
+        mdata = self._monitored_items.pop(mid)
+        if mdata.where_clause_evaluator is not None:
+            self.isub.subservice.delete_event_route(mdata.item_to_monitor.NodeId, self, mid)
+        self._unwatch_item(mdata)
         return ua.StatusCode()
 
     def datachange_callback(self, handle, value, error=None):
@@ -190,58 +303,56 @@ class MonitoredItemService(object):
         else:
             self.logger.info("subscription %s: datachange callback called with handle '%s' and value '%s'", self,
                              handle, value.Value)
-            event = ua.MonitoredItemNotification()
             with self._lock:
-                mid = self._monitored_datachange[handle]
-                mdata = self._monitored_items[mid]
-                mdata.mvalue.set_current_value(value.Value.Value)
-                if mdata.filter is not None:
-                    deadband_flag_pass = self.deadband_callback(mdata.mvalue, mdata.filter)
-                else:
-                    deadband_flag_pass = True
-                if deadband_flag_pass:
-                    event.ClientHandle = mdata.client_handle
-                    event.Value = value
-                    self.isub.enqueue_datachange_event(mid, event, mdata.queue_size)
-
-    def deadband_callback(self, values, flt):
-        ua.DeadbandType.None_
-        if flt.DeadbandType == ua.DeadbandType.None_ or values.get_old_value() is None:
-            return True
-        elif flt.DeadbandType == ua.DeadbandType.Absolute and \
-                ((abs(values.get_current_value() - values.get_old_value())) > flt.DeadbandValue):
-            return True
-        elif flt.DeadbandType == ua.DeadbandType.Percent:
-            self.logger.warn("DeadbandType Percent is not implemented !")
-            return True
-        else:
-            return False
+                mid = self._monitored_datachange.get(handle)
+            if mid is not None:
+                self._datachange(mid, value)
 
-    def trigger_event(self, event):
+    def sampled_callback(self, handle, value):
         with self._lock:
-            if event.SourceNode not in self._monitored_events:
-                self.logger.debug("%s has no subscription for events %s from node: %s",
-                                  self, event, event.SourceNode)
-                return False
-            self.logger.debug("%s has subscription for events %s from node: %s",
-                              self, event, event.SourceNode)
-            mids = self._monitored_events[event.SourceNode]
-            for mid in mids:
-                self._trigger_event(event, mid)
+            mid = self._monitored_sampled.get(handle)
+        if mid is not None:
+            self._datachange(mid, value)
 
-    def _trigger_event(self, event, mid):
-        if mid not in self._monitored_items:
+    def _datachange(self, mid, value):
+        with self._lock:
+            mdata = self._monitored_items.get(mid)
+            if mdata is None:
+                return
+            if not mdata.datachange_filter.is_reported(value):
+                return
+            item = mdata.item_to_monitor
+            event = _SharedMonitoredItemNotification()
+            event.ClientHandle = mdata.client_handle
+            event.Value = value
+            event._shared = self.isub.subservice.get_shared_value(item.NodeId, item.AttributeId, value)
+            self.isub.enqueue_datachange_event(mid, event, mdata.queue_size, mdata.discard_oldest)
+
+    def trigger_event(self, event, mid, projected=None):
+        """
+        called by subscription service for events routed to monitored item mid.
+        projected caches the fields of the event for every projection, so
+        items selecting the same fields share them and their encoding
+        """
+        mdata = self._monitored_items.get(mid)
+        if mdata is None:
             self.logger.debug("Could not find monitored items for id %s for event %s in subscription %s",
                               mid, event, self)
             return
-        mdata = self._monitored_items[mid]
         if not mdata.where_clause_evaluator.eval(event):
-            self.logger.info("%s, %s, Event %s does not fit WhereClause, not generating event", self, mid, event)
+            self.logger.debug("%s, %s, Event %s does not fit WhereClause, not generating event", self, mid, event)
             return
-        fieldlist = ua.EventFieldList()
+        projection = mdata.event_projection
+        fields = None if projected is None else projected.get(projection)
+        if fields is None:
+            fields = projection.project(event)
+            if projected is not None:
+                projected[projection] = fields
+        fieldlist = _ProjectedEventFieldList()
         fieldlist.ClientHandle = mdata.client_handle
-        fieldlist.EventFields = event.to_event_fields(mdata.filter.SelectClauses)
-        self.isub.enqueue_event(mid, fieldlist, mdata.queue_size)
+        fieldlist.EventFields = fields.variants
+        fieldlist._fields = fields
+        self.isub.enqueue_event(mid, fieldlist, mdata.queue_size, mdata.discard_oldest)
 
     def trigger_statuschange(self, code):
         self.isub.enqueue_statuschange(code)
@@ -261,8 +372,12 @@ class InternalSubscription(object):
         self._triggered_datachanges = {}
         self._triggered_events = {}
         self._triggered_statuschanges = []
+        self.max_notifications = 0  # MaxNotificationsPerPublish requested by client
+        self.max_message_size = 0
+        self._more_notifications = False
         self._notification_seq = 1
-        self._not_acknowledged_results = {}
+        self._retransmission_queue = RetransmissionQueue(subservice.max_retransmission_count,
+                                                         subservice.max_retransmission_bytes)
         self._startup = True
         self._keep_alive_count = 0
         self._publish_cycles_count = 0
@@ -279,6 +394,12 @@ class InternalSubscription(object):
         self.logger.debug("stopping subscription %s", self.data.SubscriptionId)
         self._stopev = True
         self.monitored_item_srv.delete_all_monitored_items()
+        with self._lock:
+            queued = sum(len(items) for items in self._triggered_datachanges.values())
+            queued += sum(len(items) for items in self._triggered_events.values())
+            self._triggered_datachanges = {}
+            self._triggered_events = {}
+        self.subservice.release_notifications(queued)
 
     def _subscription_loop(self):
         if not self._stopev:
@@ -292,7 +413,8 @@ class InternalSubscription(object):
 
     def has_published_results(self):
         with self._lock:
-            if self._startup or self._triggered_datachanges or self._triggered_events:
+            if self._startup or self._triggered_datachanges or self._triggered_events or \
+                    self._triggered_statuschanges:
                 return True
             if self._keep_alive_count > self.data.RevisedMaxKeepAliveCount:
                 self.logger.debug("keep alive count %s is > than max keep alive count %s, sending publish event",
@@ -320,34 +442,63 @@ class InternalSubscription(object):
     def _pop_publish_result(self):
         result = ua.PublishResult()
         result.SubscriptionId = self.data.SubscriptionId
-        self._pop_triggered_datachanges(result)
-        self._pop_triggered_events(result)
+        result.NotificationMessage = _EncodedNotificationMessage()
+        count = self.subservice.max_notifications_per_publish
+        if self.max_notifications and (not count or self.max_notifications < count):
+            count = self.max_notifications
+        budget = _PublishBudget(count, self.max_message_size)
+        self._pop_triggered_datachanges(result, budget)
+        self._pop_triggered_events(result, budget)
         self._pop_triggered_statuschanges(result)
+        self._more_notifications = bool(self._triggered_datachanges or self._triggered_events)
         self._keep_alive_count = 0
         self._startup = False
         result.NotificationMessage.SequenceNumber = self._notification_seq
         if len(result.NotificationMessage.NotificationData) != 0:
             self._notification_seq += 1
-            self._not_acknowledged_results[result.NotificationMessage.SequenceNumber] = result
-        result.MoreNotifications = False
-        result.AvailableSequenceNumbers = list(self._not_acknowledged_results.keys())
+            self._retransmission_queue.add(result.NotificationMessage.SequenceNumber,
+                                           result.NotificationMessage.encode())
+        result.MoreNotifications = self._more_notifications
+        result.AvailableSequenceNumbers = self._retransmission_queue.sequence_numbers()
         return result
 
-    def _pop_triggered_datachanges(self, result):
+    def _pop_triggered_datachanges(self, result, budget):
         if self._triggered_datachanges:
             notif = ua.DataChangeNotification()
-            notif.MonitoredItems = [item for sublist in self._triggered_datachanges.values() for item in sublist]
-            self._triggered_datachanges = {}
-            self.logger.debug("sending datachanges notification with %s events", len(notif.MonitoredItems))
-            result.NotificationMessage.NotificationData.append(notif)
+            notif.MonitoredItems = self._pop_notifications(self._triggered_datachanges, budget)
+            if notif.MonitoredItems:
+                self.logger.debug("sending datachanges notification with %s events", len(notif.MonitoredItems))
+                result.NotificationMessage.NotificationData.append(notif)
 
-    def _pop_triggered_events(self, result):
+    def _pop_triggered_events(self, result, budget):
         if self._triggered_events:
             notif = ua.EventNotificationList()
-            notif.Events = [item for sublist in self._triggered_events.values() for item in sublist]
-            self._triggered_events = {}
-            result.NotificationMessage.NotificationData.append(notif)
-            self.logger.debug("sending event notification with %s events", len(notif.Events))
+            notif.Events = self._pop_notifications(self._triggered_events, budget)
+            if notif.Events:
+                result.NotificationMessage.NotificationData.append(notif)
+                self.logger.debug("sending event notification with %s events", len(notif.Events))
+
+    def _pop_notifications(self, queue, budget):
+        """
+        pop notifications from the queues of monitored items, oldest first
+        for every item, as long as they fit in budget.
+        The rest stays queued for next publish
+        """
+        if budget.count is None and budget.size is None:
+            items = [item for sublist in queue.values() for item in sublist]
+            queue.clear()
+        else:
+            items = []
+            for mid in list(queue.keys()):
+                pending = queue[mid]
+                while pending and budget.take(pending[0]):
+                    items.append(pending.popleft())
+                if not pending:
+                    del queue[mid]
+                if budget.full:
+                    break
+        self.subservice.release_notifications(len(items))
+        return items
 
     def _pop_triggered_statuschanges(self, result):
         if self._triggered_statuschanges:
@@ -361,120 +512,623 @@ class InternalSubscription(object):
         with self._lock:
             self._publish_cycles_count = 0
             for nb in acks:
-                if nb in self._not_acknowledged_results:
-                    self._not_acknowledged_results.pop(nb)
+                self._retransmission_queue.acknowledge(nb)
+            result = None
+            if self._more_notifications and not self._stopev:
+                # client is ready for the next part, do not wait for publishing interval
+                result = self._pop_publish_result()
+        if result is not None:
+            self.callback(result)
 
     def republish(self, nb):
         self.logger.info("re-publish request for ack %s in subscription %s", nb, self)
         with self._lock:
-            if nb in self._not_acknowledged_results:
-                self.logger.info("re-publishing ack %s in subscription %s", nb, self)
-                return self._not_acknowledged_results[nb].NotificationMessage
-            else:
-                self.logger.info("Error request to re-published non existing ack %s in subscription %s", nb, self)
-                return ua.NotificationMessage()
+            data = self._retransmission_queue.get(nb)
+        if data is None:
+            self.logger.info("Error request to re-published non existing ack %s in subscription %s", nb, self)
+            raise utils.ServiceError(ua.StatusCodes.BadMessageNotAvailable)
+        self.logger.info("re-publishing ack %s in subscription %s", nb, self)
+        return data
 
-    def enqueue_datachange_event(self, mid, eventdata, maxsize):
-        self._enqueue_event(mid, eventdata, maxsize, self._triggered_datachanges)
+    def enqueue_datachange_event(self, mid, eventdata, maxsize, discard_oldest=True):
+        self._enqueue_event(mid, eventdata, maxsize, self._triggered_datachanges, discard_oldest, _set_overflow_bit)
 
-    def enqueue_event(self, mid, eventdata, maxsize):
-        self._enqueue_event(mid, eventdata, maxsize, self._triggered_events)
+    def enqueue_event(self, mid, eventdata, maxsize, discard_oldest=True):
+        self._enqueue_event(mid, eventdata, maxsize, self._triggered_events, discard_oldest)
 
     def enqueue_statuschange(self, code):
         self._triggered_statuschanges.append(code)
 
-    def _enqueue_event(self, mid, eventdata, size, queue):
-        if mid not in queue:
-            queue[mid] = [eventdata]
-            return
-        if size != 0:
-            if len(queue[mid]) >= size:
-                queue[mid].pop(0)
-        queue[mid].append(eventdata)
+    def _enqueue_event(self, mid, eventdata, size, queue, discard_oldest, overflow=None):
+        """
+        add a notification to the bounded queue of a monitored item.
+        When the queue is full, or when the server wide limit of queued
+        notifications is reached, the oldest or the newest notification of the
+        item is discarded and overflow is called on the one next to the gap
+        """
+        with self._lock:
+            items = queue.get(mid)
+            if items is None:
+                items = queue[mid] = deque(maxlen=size)
+            elif items.maxlen != size:
+                # queue size was modified, keep the newest notifications
+                resized = deque(items, maxlen=size)
+                self.subservice.release_notifications(len(items) - len(resized))
+                items = queue[mid] = resized
+            if len(items) < size and self.subservice.reserve_notification():
+                items.append(eventdata)
+                return
+            if not items:
+                self.logger.warning("Too many queued notifications in server, discarding notification for %s", mid)
+                return
+            if discard_oldest:
+                items.popleft()
+                items.append(eventdata)
+                flagged = 0
+            else:
+                items[-1] = eventdata
+                flagged = -1
+            if overflow is not None and size > 1:
+                overflow(items[flagged])
+
+
+class DataChangeFilterEvaluator(object):
+    """
+    decide if a new value of a data change item is reported to client, by
+    comparing it to the last reported value according to the trigger and
+    deadband of a DataChangeFilter. Deadbands apply to every element of arrays.
+    Without filter, changes of status or value are reported
+    """
+
+    def __init__(self, flt=None, eurange=None):
+        self.trigger = ua.DataChangeTrigger.StatusValue
+        self.deadband = None
+        if flt is not None:
+            self.trigger = flt.Trigger
+            if flt.DeadbandType == ua.DeadbandType.Absolute:
+                self.deadband = flt.DeadbandValue
+            elif flt.DeadbandType == ua.DeadbandType.Percent:
+                self.deadband = flt.DeadbandValue / 100.0 * (eurange.High - eurange.Low)
+        self.last = None
+
+    def is_reported(self, value):
+        last = self.last
+        if last is None or value.StatusCode != last.StatusCode:
+            reported = True
+        elif self.trigger == ua.DataChangeTrigger.Status:
+            reported = False
+        elif self._value_changed(value.Value, last.Value):
+            reported = True
+        else:
+            reported = (self.trigger == ua.DataChangeTrigger.StatusValueTimestamp and
+                        value.SourceTimestamp != last.SourceTimestamp)
+        if reported:
+            self.last = value
+        return reported
+
+    def _value_changed(self, variant, last):
+        if self.deadband is None or variant.VariantType != last.VariantType:
+            return variant != last
+        try:
+            return _exceeds_deadband(variant.Value, last.Value, self.deadband)
+        except TypeError:
+            # not a numeric value, spec says deadband is ignored
+            return variant != last
+
+
+def _exceeds_deadband(value, last, deadband):
+    if value is None or last is None:
+        return value is not last
+    if NUMPY_AVAILABLE and isinstance(value, numpy.ndarray):
+        if not isinstance(last, numpy.ndarray) or value.shape != last.shape:
+            return True
+        return bool((numpy.abs(value - last) > deadband).any())
+    if isinstance(value, (list, tuple, array_type, memoryview)):
+        if len(value) != len(last):
+            return True
+        if value and isinstance(value[0], (list, tuple)):
+            return any(_exceeds_deadband(val, old, deadband) for val, old in zip(value, last))
+        return any(abs(val - old) > deadband for val, old in zip(value, last))
+    return abs(value - last) > deadband
+
+
+def _watch_timestamps(evaluator):
+    return evaluator.trigger == ua.DataChangeTrigger.StatusValueTimestamp
+
+
+def select_clause_names(select_clauses):
+    """
+    return the names of the event properties selected by select clauses
+    """
+    names = []
+    for sattr in select_clauses:
+        if not sattr.BrowsePath:
+            names.append(ua.AttributeIds(sattr.AttributeId).name)
+        else:
+            names.append(sattr.BrowsePath[0].Name)
+    return tuple(names)
+
+
+class EventProjection(object):
+    """
+    select clauses of an EventFilter resolved to the names of the event
+    properties they select, see SubscriptionService.get_event_projection
+    """
+
+    def __init__(self, names):
+        self.names = names
+
+    def project(self, event):
+        """
+        return the selected fields of event, values are copied since
+        event objects are reused by event generators
+        """
+        data_types = event.data_types
+        variants = []
+        for name in self.names:
+            try:
+                val = getattr(event, name)
+            except AttributeError:
+                variants.append(ua.Variant(None))
+            else:
+                variants.append(ua.Variant(copy.deepcopy(val), data_types.get(name)))
+        return _ProjectedFields(variants)
+
+
+class _ProjectedFields(object):
+    """
+    fields of one event for one projection, encoded once for all monitored items
+    """
+
+    def __init__(self, variants):
+        self.variants = variants
+        self._binary = None
+
+    def to_binary(self):
+        if self._binary is None:
+            self._binary = uabin.Primitives.Int32.pack(len(self.variants)) + \
+                b"".join([variant.to_binary() for variant in self.variants])
+        return self._binary
+
+
+class _ProjectedEventFieldList(ua.EventFieldList):
+    """
+    EventFieldList sharing the encoded fields of other monitored items
+    """
+
+    _fields = None
+
+    def to_binary(self):
+        return uabin.Primitives.UInt32.pack(self.ClientHandle) + self._fields.to_binary()
+
+
+class SharedDataValue(object):
+    """
+    a DataValue reported to monitored items of several subscriptions,
+    encoded only once, see SubscriptionService.get_shared_value
+    """
+
+    def __init__(self, value):
+        self.value = value
+        self._binary = None
+
+    def to_binary(self):
+        if self._binary is None:
+            self._binary = self.value.to_binary()
+        return self._binary
+
+
+class _SharedMonitoredItemNotification(ua.MonitoredItemNotification):
+    """
+    MonitoredItemNotification reusing the encoded value of other monitored items
+    """
+
+    _shared = None
+
+    def to_binary(self):
+        if self._shared is None:
+            return ua.MonitoredItemNotification.to_binary(self)
+        return uabin.Primitives.UInt32.pack(self.ClientHandle) + self._shared.to_binary()
+
+
+class RetransmissionQueue(object):
+    """
+    encoded NotificationMessages sent to client and not acknowledged yet.
+    The oldest messages are discarded when there are more than max_count of
+    them or when they use more than max_bytes, the newest one is always kept
+    """
+
+    def __init__(self, max_count, max_bytes):
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self._messages = OrderedDict()  # sequence numbers are increasing, oldest first
+        self._bytes = 0
+        self._sequence_numbers = []
+
+    def __len__(self):
+        return len(self._messages)
+
+    def add(self, seq, data):
+        self._messages[seq] = data
+        self._bytes += len(data)
+        while len(self._messages) > 1 and (len(self._messages) > self.max_count or self._bytes > self.max_bytes):
+            _, old = self._messages.popitem(last=False)
+            self._bytes -= len(old)
+        self._sequence_numbers = None
+
+    def acknowledge(self, seq):
+        """
+        return False if message is unknown, already acknowledged or discarded
+        """
+        data = self._messages.pop(seq, None)
+        if data is None:
+            return False
+        self._bytes -= len(data)
+        self._sequence_numbers = None
+        return True
+
+    def get(self, seq):
+        return self._messages.get(seq)
+
+    def sequence_numbers(self):
+        if self._sequence_numbers is None:
+            self._sequence_numbers = list(self._messages.keys())
+        return list(self._sequence_numbers)
+
+
+class _EncodedNotificationMessage(ua.NotificationMessage):
+    """
+    NotificationMessage encoded once when it is queued for retransmission,
+    the same bytes are used to encode the PublishResponse
+    """
+
+    _binary = None
+
+    def encode(self):
+        self._binary = ua.NotificationMessage.to_binary(self)
+        return self._binary
+
+    def to_binary(self):
+        if self._binary is None:
+            return ua.NotificationMessage.to_binary(self)
+        return self._binary
+
+
+class _PublishBudget(object):
+    """
+    room left in a NotificationMessage, in notifications and in bytes.
+    0 means no limit
+    """
+
+    def __init__(self, count, max_message_size):
+        self.count = count or None
+        self.size = max(max_message_size - PUBLISH_OVERHEAD, 1) if max_message_size else None
+        self._empty = True
+
+    @property
+    def full(self):
+        return self.count == 0 or self.size == 0
+
+    def take(self, notification):
+        """
+        return True and account for notification if it fits in message.
+        a notification bigger than the limit is sent alone
+        """
+        if self.count == 0:
+            return False
+        if self.size is not None:
+            nbytes = len(notification.to_binary())
+            if nbytes > self.size and not self._empty:
+                self.size = 0
+                return False
+            self.size = max(self.size - nbytes, 0)
+        if self.count is not None:
+            self.count -= 1
+        self._empty = False
+        return True
+
+
+def _set_overflow_bit(notification):
+    """
+    flag a data change notification to tell client that values were lost.
+    the DataValue may be shared with the address space so it is copied
+    """
+    value = notification.Value
+    flagged = ua.DataValue(value.Value, ua.StatusCode(value.StatusCode.value | OVERFLOW_INFOBITS))
+    flagged.SourceTimestamp = value.SourceTimestamp
+    flagged.SourcePicoseconds = value.SourcePicoseconds
+    flagged.ServerTimestamp = value.ServerTimestamp
+    flagged.ServerPicoseconds = value.ServerPicoseconds
+    notification.Value = flagged
+    if isinstance(notification, _SharedMonitoredItemNotification):
+        notification._shared = None
 
 
 class WhereClauseEvaluator(object):
+    """
+    Evaluate the WhereClause of an EventFilter.
+    The ContentFilter is compiled once into a tree of closures, so evaluating
+    it for an event is only a few function calls. Filters using unsupported
+    operators or invalid operands raise a UaStatusCodeError when compiled
+    """
+
     def __init__(self, logger, aspace, whereclause):
         self.logger = logger
         self.elements = whereclause.Elements
         self._aspace = aspace
+        self._compiled = {}
+        self._func = self._compile_el(0) if self.elements else None
 
     def eval(self, event):
-        if not self.elements:
+        if self._func is None:
             return True
         # spec says we should only evaluate first element, which may use other elements
         try:
-            res = self._eval_el(0, event)
+            return bool(self._func(event))
         except Exception as ex:
             self.logger.exception("Exception while evaluating WhereClause %s for event %s: %s",
                                   self.elements, event, ex)
             return False
-        return res
 
-    def _eval_el(self, index, event):
+    def _compile_el(self, index, parents=()):
+        if index in self._compiled:
+            return self._compiled[index]
+        if index >= len(self.elements) or index in parents:
+            raise ua.UaStatusCodeError(ua.StatusCodes.BadFilterElementInvalid)
         el = self.elements[index]
-        # ops = [self._eval_op(op, event) for op in el.FilterOperands]
-        ops = el.FilterOperands  # just to make code more readable
-        if el.FilterOperator == ua.FilterOperator.Equals:
-            return self._eval_op(ops[0], event) == self._eval_el(ops[1], event)
-        elif el.FilterOperator == ua.FilterOperator.IsNull:
-            return self._eval_op(ops[0], event) is None  # FIXME: might be too strict
-        elif el.FilterOperator == ua.FilterOperator.GreaterThan:
-            return self._eval_op(ops[0], event) > self._eval_el(ops[1], event)
-        elif el.FilterOperator == ua.FilterOperator.LessThan:
-            return self._eval_op(ops[0], event) < self._eval_el(ops[1], event)
-        elif el.FilterOperator == ua.FilterOperator.GreaterThanOrEqual:
-            return self._eval_op(ops[0], event) >= self._eval_el(ops[1], event)
-        elif el.FilterOperator == ua.FilterOperator.LessThanOrEqual:
-            return self._eval_op(ops[0], event) <= self._eval_el(ops[1], event)
-        elif el.FilterOperator == ua.FilterOperator.Like:
-            return self._likeoperator(self._eval_op(ops[0], event), self._eval_el(ops[1], event))
-        elif el.FilterOperator == ua.FilterOperator.Not:
-            return not self._eval_op(ops[0], event)
-        elif el.FilterOperator == ua.FilterOperator.Between:
-            return self._eval_el(ops[2], event) >= self._eval_op(ops[0], event) >= self._eval_el(ops[1], event)
-        elif el.FilterOperator == ua.FilterOperator.InList:
-            return self._eval_op(ops[0], event) in [self._eval_op(op, event) for op in ops[1:]]
-        elif el.FilterOperator == ua.FilterOperator.And:
-            self.elements(ops[0].Index)
-            return self._eval_op(ops[0], event) and self._eval_op(ops[1], event)
-        elif el.FilterOperator == ua.FilterOperator.Or:
-            return self._eval_op(ops[0], event) or self._eval_el(ops[1], event)
-        elif el.FilterOperator == ua.FilterOperator.Cast:
-            self.logger.warn("Cast operand not implemented, assuming True")
-            return True
-        elif el.FilterOperator == ua.FilterOperator.OfType:
-            return event.EventType == self._eval_op(ops[0], event)
-        else:
-            # TODO: implement missing operators
-            self.logger.warning("WhereClause not implemented for element: %s", el)
-            raise NotImplementedError
-
-    def _like_operator(self, string, pattern):
-        raise NotImplementedError
-
-    def _eval_op(self, op, event):
-        # seems spec says we should return Null if issues
-        if type(op) is ua.ElementOperand:
-            return self._eval_el(op.Index, event)
-        elif type(op) is ua.AttributeOperand:
-            if op.BrowsePath:
-                return getattr(event, op.BrowsePath.Elements[0].TargetName.Name)
-            else:
-                return self._aspace.get_attribute_value(event.EventType, op.AttributeId).Value.Value
-            # FIXME: check, this is probably broken
-        elif type(op) is ua.SimpleAttributeOperand:
+        try:
+            operator = ua.FilterOperator(el.FilterOperator)
+        except ValueError:
+            raise ua.UaStatusCodeError(ua.StatusCodes.BadFilterOperatorInvalid)
+        compiler = self._operators.get(operator)
+        if compiler is None:
+            self.logger.warning("WhereClause operator %s is not supported", operator)
+            raise ua.UaStatusCodeError(ua.StatusCodes.BadFilterOperatorUnsupported)
+        nb_operands, compiler = compiler
+        if nb_operands is not None and len(el.FilterOperands) != nb_operands or \
+                nb_operands is None and len(el.FilterOperands) < 2:
+            raise ua.UaStatusCodeError(ua.StatusCodes.BadFilterOperandCountMismatch)
+        ops = [self._compile_op(op, parents + (index,)) for op in el.FilterOperands]
+        func = compiler(self, el.FilterOperands, ops)
+        self._compiled[index] = func
+        return func
+
+    def _compile_op(self, op, parents):
+        """
+        return a function returning the value of operand op for an event
+        """
+        if isinstance(op, ua.ElementOperand):
+            return self._compile_el(op.Index, parents)
+        elif isinstance(op, ua.LiteralOperand):
+            value = op.Value.Value
+            return lambda event: value
+        elif isinstance(op, ua.SimpleAttributeOperand):
             if op.BrowsePath:
-                # we only support depth of 1
-                return getattr(event, op.BrowsePath[0].Name)
-            else:
-                # TODO: write code for index range.... but doe it make any sense
-                return self._aspace.get_attribute_value(event.EventType, op.AttributeId).Value.Value
-        elif type(op) is ua.LiteralOperand:
-            return op.Value.Value
+                # event properties are stored flat, nested ones under their path joined with /
+                name = "/".join(qname.Name for qname in op.BrowsePath)
+                return lambda event: getattr(event, name, None)
+            return self._compile_type_attribute(op.AttributeId)
+        elif isinstance(op, ua.AttributeOperand):
+            if op.BrowsePath.Elements:
+                name = "/".join(el.TargetName.Name for el in op.BrowsePath.Elements)
+                return lambda event: getattr(event, name, None)
+            return self._compile_type_attribute(op.AttributeId)
+        self.logger.warning("Where clause operand %s is not of a known type", op)
+        raise ua.UaStatusCodeError(ua.StatusCodes.BadFilterOperandInvalid)
+
+    def _compile_type_attribute(self, attr):
+        aspace = self._aspace
+
+        def get_attribute(event):
+            return aspace.get_attribute_value(event.EventType, attr).Value.Value
+        return get_attribute
+
+    def _like(self, operands, ops):
+        value, pattern = ops
+        if isinstance(operands[1], ua.LiteralOperand):
+            pat = _like_string(pattern(None))
+            if pat is None:
+                return lambda event: False
+            regex = _like_to_regex(pat)
+
+            def func(event):
+                val = _like_string(value(event))
+                return val is not None and regex.match(val) is not None
         else:
-            self.logger.warning("Where clause element % is not of a known type", op)
-            raise NotImplementedError
+            def func(event):
+                val = _like_string(value(event))
+                pat = _like_string(pattern(event))
+                return val is not None and pat is not None and _like_to_regex(pat).match(val) is not None
+        return func
+
+    def _not(self, operands, ops):
+        value = ops[0]
+
+        def func(event):
+            val = value(event)
+            return None if val is None else not val
+        return func
+
+    def _between(self, operands, ops):
+        value, low, high = ops
+
+        def func(event):
+            val = value(event)
+            lo = low(event)
+            hi = high(event)
+            if val is None or lo is None or hi is None:
+                return False
+            try:
+                return lo <= val <= hi
+            except TypeError:
+                return False
+        return func
+
+    def _in_list(self, operands, ops):
+        value = ops[0]
+        if all(isinstance(op, ua.LiteralOperand) for op in operands[1:]):
+            candidates = [op(None) for op in ops[1:]]
+            return lambda event: value(event) in candidates
+        items = ops[1:]
+        return lambda event: value(event) in [item(event) for item in items]
+
+    def _and(self, operands, ops):
+        first, second = ops
+        return lambda event: bool(first(event)) and bool(second(event))
+
+    def _or(self, operands, ops):
+        first, second = ops
+        return lambda event: bool(first(event)) or bool(second(event))
+
+    def _cast(self, operands, ops):
+        value, datatype = ops
+
+        def func(event):
+            return _cast(value(event), datatype(event))
+        return func
+
+    def _of_type(self, operands, ops):
+        typeid = ops[0]
+        aspace = self._aspace
+
+        def func(event):
+            return event.EventType in aspace.get_subtypes(typeid(event))
+        return func
 
 
+def _comparison(compare):
+    def compile_comparison(self, operands, ops):
+        first, second = ops
 
+        def func(event):
+            val1 = first(event)
+            val2 = second(event)
+            if val1 is None or val2 is None:
+                return False
+            try:
+                return compare(val1, val2)
+            except TypeError:
+                return False
+        return func
+    return compile_comparison
+
+
+def _bitwise(operator):
+    def compile_bitwise(self, operands, ops):
+        first, second = ops
+
+        def func(event):
+            val1 = first(event)
+            val2 = second(event)
+            if val1 is None or val2 is None:
+                return None
+            return operator(val1, val2)
+        return func
+    return compile_bitwise
+
+
+def _is_null(self, operands, ops):
+    value = ops[0]
+    return lambda event: value(event) is None
+
+
+# FilterOperator -> (number of operands or None for 2 and more, compiler)
+WhereClauseEvaluator._operators = {
+    ua.FilterOperator.Equals: (2, _comparison(_operator.eq)),
+    ua.FilterOperator.IsNull: (1, _is_null),
+    ua.FilterOperator.GreaterThan: (2, _comparison(_operator.gt)),
+    ua.FilterOperator.LessThan: (2, _comparison(_operator.lt)),
+    ua.FilterOperator.GreaterThanOrEqual: (2, _comparison(_operator.ge)),
+    ua.FilterOperator.LessThanOrEqual: (2, _comparison(_operator.le)),
+    ua.FilterOperator.Like: (2, WhereClauseEvaluator._like),
+    ua.FilterOperator.Not: (1, WhereClauseEvaluator._not),
+    ua.FilterOperator.Between: (3, WhereClauseEvaluator._between),
+    ua.FilterOperator.InList: (None, WhereClauseEvaluator._in_list),
+    ua.FilterOperator.And: (2, WhereClauseEvaluator._and),
+    ua.FilterOperator.Or: (2, WhereClauseEvaluator._or),
+    ua.FilterOperator.Cast: (2, WhereClauseEvaluator._cast),
+    ua.FilterOperator.OfType: (1, WhereClauseEvaluator._of_type),
+    ua.FilterOperator.BitwiseAnd: (2, _bitwise(_operator.and_)),
+    ua.FilterOperator.BitwiseOr: (2, _bitwise(_operator.or_)),
+}
+
+
+def _like_string(val):
+    """
+    return the string a Like operator compares for val, the text of a
+    LocalizedText and the name of a QualifiedName, None if there is none
+    """
+    if isinstance(val, ua.LocalizedText):
+        val = val.Text
+    elif isinstance(val, ua.QualifiedName):
+        val = val.Name
+    if val is None:
+        return None
+    if isinstance(val, bytes):
+        return val.decode("utf-8", "replace")
+    return str(val)
+
+
+def _like_to_regex(pattern):
+    """
+    translate the pattern of a Like operator to a compiled regular expression.
+    % matches any string, _ any character, [] a character from a list or
+    range, [^] a character not in it and \ escapes the next character
+    """
+    regex = []
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if char == "\\" and i + 1 < len(pattern):
+            i += 1
+            regex.append(re.escape(pattern[i]))
+        elif char == "%":
+            regex.append(".*")
+        elif char == "_":
+            regex.append(".")
+        elif char == "[":
+            end = pattern.find("]", i + 1)
+            if end == -1:
+                regex.append(re.escape(char))
+            else:
+                content = pattern[i + 1:end]
+                negate = content.startswith("^")
+                if negate:
+                    content = content[1:]
+                regex.append("[" + ("^" if negate else "") + content.replace("\\", "\\\\") + "]")
+                i = end
+        else:
+            regex.append(re.escape(char))
+        i += 1
+    return re.compile("".join(regex) + r"\Z", re.DOTALL)
+
+
+# python conversion of the value for the builtin data types supported by Cast
+_CASTS = {
+    ua.ObjectIds.Boolean: bool,
+    ua.ObjectIds.SByte: int,
+    ua.ObjectIds.Byte: int,
+    ua.ObjectIds.Int16: int,
+    ua.ObjectIds.UInt16: int,
+    ua.ObjectIds.Int32: int,
+    ua.ObjectIds.UInt32: int,
+    ua.ObjectIds.Int64: int,
+    ua.ObjectIds.UInt64: int,
+    ua.ObjectIds.Float: float,
+    ua.ObjectIds.Double: float,
+    ua.ObjectIds.String: str,
+}
+
+
+def _cast(value, datatype):
+    if value is None:
+        return None
+    if isinstance(datatype, ua.NodeId) and datatype.NamespaceIndex == 0:
+        datatype = datatype.Identifier
+    conv = _CASTS.get(datatype)
+    if conv is None:
+        return None
+    try:
+        return conv(value)
+    except (TypeError, ValueError):
+        return None
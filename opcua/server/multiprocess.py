@@ -0,0 +1,216 @@
+"""
+Run an OPC-UA server in several processes listening on the same port
+
+Every worker process builds its own complete Server by calling the same setup
+function, so the address space is replicated in all workers. The listening
+sockets are opened with SO_REUSEPORT and the kernel spreads incoming
+connections between the workers. A client connection, with its sessions and
+subscriptions, lives in exactly one worker.
+
+Attribute writes on nodes outside namespace 0 and triggered events are
+propagated to the other workers through pipes to the parent process, which
+relays them. Namespace 0 holds the per process server state (ServerStatus,
+diagnostics) and is not replicated, neither are nodes added or deleted at
+runtime. History is stored by each worker.
+
+Requires a platform supporting fork and SO_REUSEPORT (Linux, BSD).
+"""
+
+import os
+import logging
+import multiprocessing
+from multiprocessing.connection import wait
+from threading import Thread, Lock
+
+from opcua import ua
+from opcua.common import utils
+from opcua.server.server import Server
+
+logger = logging.getLogger(__name__)
+
+
+class _Replicator(object):
+    """
+    hook into the address space and the subscription service of a worker
+    to send local writes and events to the other workers, and apply the ones
+    received from them
+    """
+
+    def __init__(self, server, conn):
+        self.logger = logging.getLogger(__name__)
+        self.aspace = server.iserver.aspace
+        self.subscription_service = server.iserver.subscription_service
+        self._conn = conn
+        self._sendlock = Lock()
+        self._set_attribute_value = self.aspace.set_attribute_value
+        self._trigger_event = self.subscription_service.trigger_event
+
+    def install(self):
+        self.aspace.set_attribute_value = self.set_attribute_value
+        self.subscription_service.trigger_event = self.trigger_event
+
+    def set_attribute_value(self, nodeid, attr, value):
+        result = self._set_attribute_value(nodeid, attr, value)
+        if result.is_good() and nodeid.NamespaceIndex != 0:
+            self.send(("write", nodeid.to_binary(), attr, value.to_binary()))
+        return result
+
+    def trigger_event(self, event):
+        self._trigger_event(event)
+        self.send(("event", event))
+
+    def send(self, msg):
+        with self._sendlock:
+            try:
+                self._conn.send(msg)
+            except (EOFError, OSError):
+                self.logger.warning("Could not propagate %s to other workers", msg[0])
+
+    def run(self):
+        """
+        apply changes from other workers until the parent asks us to stop
+        """
+        while True:
+            try:
+                msg = self._conn.recv()
+            except EOFError:
+                return
+            if msg[0] == "stop":
+                return
+            try:
+                if msg[0] == "write":
+                    nodeid = ua.NodeId.from_binary(utils.Buffer(msg[1]))
+                    value = ua.DataValue.from_binary(utils.Buffer(msg[3]))
+                    self._set_attribute_value(nodeid, msg[2], value)
+                elif msg[0] == "event":
+                    self._trigger_event(msg[1])
+            except Exception:
+                self.logger.exception("Error applying %s from other worker", msg[0])
+
+
+def _worker_main(index, conn, endpoint, setup):
+    server = Server()
+    server.set_endpoint(endpoint)
+    server.set_reuse_port(True)
+    setup(server)
+    replicator = _Replicator(server, conn)
+    replicator.install()
+    try:
+        server.start()
+    except Exception as ex:
+        conn.send(("failed", index, str(ex)))
+        server.iserver.stop()
+        raise
+    try:
+        conn.send(("started", index))
+        replicator.run()
+    finally:
+        server.stop()
+
+
+class MultiProcessServer(object):
+    """
+    Start a server in several worker processes sharing the same endpoint.
+
+    setup is called with a fresh Server instance in every worker, before it
+    is started, and must create the same nodes in all of them, for example:
+
+    def setup(server):
+        idx = server.register_namespace("http://examples.freeopcua.github.io")
+        server.get_objects_node().add_variable(ua.NodeId("MyVariable", idx), "MyVariable", 6.7)
+
+    mserver = MultiProcessServer(setup, "opc.tcp://0.0.0.0:4840/freeopcua/server/", workers=4)
+    mserver.start()
+    ...
+    mserver.stop()
+
+    The endpoint must use an explicit port. setup runs in the forked
+    workers, nodes created or modified in the parent process are not seen by clients.
+    """
+
+    def __init__(self, setup, endpoint, workers=None):
+        self.logger = logging.getLogger(__name__)
+        self.setup = setup
+        self.endpoint = endpoint
+        self.workers = workers or os.cpu_count() or 1
+        self._processes = []
+        self._conns = []
+        self._locks = []
+        self._relay_thread = None
+
+    def start(self):
+        if not hasattr(os, "fork"):
+            raise ua.UaError("MultiProcessServer requires a platform supporting fork")
+        ctx = multiprocessing.get_context("fork")
+        for idx in range(self.workers):
+            conn, child_conn = ctx.Pipe()
+            proc = ctx.Process(target=_worker_main, args=(idx, child_conn, self.endpoint, self.setup))
+            proc.daemon = True
+            proc.start()
+            child_conn.close()
+            self._processes.append(proc)
+            self._conns.append(conn)
+            self._locks.append(Lock())
+        pending = []
+        for idx, conn in enumerate(self._conns):
+            # wait until every worker listens on its socket, a worker may already
+            # send writes and events, they are relayed once all workers started
+            while True:
+                try:
+                    msg = conn.recv()
+                except (EOFError, OSError):
+                    msg = ("failed", idx, "worker exited")
+                if msg[0] == "started":
+                    break
+                if msg[0] == "failed":
+                    self.stop()
+                    raise ua.UaError("Worker {0} failed to start: {1}".format(idx, msg[2]))
+                pending.append((idx, msg))
+        for source, msg in pending:
+            self._forward(source, msg)
+        self._relay_thread = Thread(target=self._relay)
+        self._relay_thread.daemon = True
+        self._relay_thread.start()
+        self.logger.info("Started %s server workers on %s", self.workers, self.endpoint)
+
+    def _send(self, idx, msg):
+        with self._locks[idx]:
+            try:
+                self._conns[idx].send(msg)
+            except (EOFError, OSError):
+                self.logger.warning("Could not send %s to worker %s", msg[0], idx)
+
+    def _relay(self):
+        """
+        forward changes from every worker to all others
+        """
+        conns = list(self._conns)
+        while conns:
+            for conn in wait(conns):
+                try:
+                    msg = conn.recv()
+                except (EOFError, OSError):
+                    conns.remove(conn)
+                    continue
+                self._forward(self._conns.index(conn), msg)
+
+    def _forward(self, source, msg):
+        for idx in range(len(self._conns)):
+            if idx != source:
+                self._send(idx, msg)
+
+    def stop(self, timeout=5):
+        for idx in range(len(self._conns)):
+            self._send(idx, ("stop",))
+        for proc in self._processes:
+            proc.join(timeout)
+            if proc.is_alive():
+                self.logger.warning("Worker %s did not stop, terminating it", proc.pid)
+                proc.terminate()
+        if self._relay_thread is not None:
+            self._relay_thread.join(timeout)
+        for conn in self._conns:
+            conn.close()
+        self._processes = []
+        self._conns = []
+        self._locks = []
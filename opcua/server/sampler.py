@@ -0,0 +1,133 @@
+"""
+sample attribute values of data change monitored items
+"""
+
+from threading import RLock
+import logging
+import time
+
+from opcua import ua
+
+
+class _SampledAttribute(object):
+    """
+    one node attribute sampled at one rate, shared by all monitored items watching it
+    """
+
+    def __init__(self, nodeid, attr):
+        self.nodeid = nodeid
+        self.attr = attr
+        self.last = None
+        self.callbacks = {}
+
+
+class _SamplingGroup(object):
+    """
+    all attributes sampled at the same interval, read in one batch per tick
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.attributes = {}  # (nodeid, attr) -> _SampledAttribute
+        self.deadline = None
+
+
+class Sampler(object):
+    """
+    Sample attribute values at the sampling interval of monitored items.
+    Items are grouped by interval and every group is read in one batch on the
+    server loop. Items watching the same attribute at the same interval share
+    one read per tick, their callback is only called when the value or the
+    status code of the attribute changed since the previous sample.
+    """
+
+    def __init__(self, loop, aspace):
+        self.logger = logging.getLogger(__name__)
+        self.loop = loop
+        self.aspace = aspace
+        self.min_interval = 0  # fastest sampling interval in ms supported by the server
+        self._lock = RLock()
+        self._groups = {}
+        self._handles = {}
+        self._handle_counter = 0
+
+    def revise_interval(self, nodeid, attr, requested):
+        """
+        return sampling interval in ms the server will use for requested interval.
+        0 means the item is not sampled but notified on every write
+        """
+        interval = max(requested, self.min_interval)
+        if attr == ua.AttributeIds.Value:
+            minimum = self.aspace.get_attribute_value(nodeid, ua.AttributeIds.MinimumSamplingInterval).Value.Value
+            if minimum is not None and minimum > 0:
+                interval = max(interval, minimum)
+        return interval
+
+    def add_item(self, nodeid, attr, interval, callback, timestamps=False):
+        """
+        sample attribute attr of nodeid every interval ms and call
+        callback(handle, datavalue) when it changed. If timestamps is True a
+        new source timestamp is also a change.
+        returns a status code and a handle for delete_item
+        """
+        if nodeid not in self.aspace:
+            return ua.StatusCode(ua.StatusCodes.BadNodeIdUnknown), 0
+        if not self.aspace.get_attribute_value(nodeid, attr).StatusCode.is_good():
+            return ua.StatusCode(ua.StatusCodes.BadAttributeIdInvalid), 0
+        with self._lock:
+            group = self._groups.get(interval)
+            if group is None:
+                group = self._groups[interval] = _SamplingGroup(interval)
+                group.deadline = time.time()
+                self.loop.call_later(interval / 1000.0, lambda: self._tick(group))
+            key = (nodeid, attr)
+            sampled = group.attributes.get(key)
+            if sampled is None:
+                sampled = group.attributes[key] = _SampledAttribute(nodeid, attr)
+                sampled.last = self.aspace.get_attribute_value(nodeid, attr)
+            self._handle_counter += 1
+            handle = self._handle_counter
+            sampled.callbacks[handle] = (callback, timestamps)
+            self._handles[handle] = (interval, key)
+            return ua.StatusCode(), handle
+
+    def delete_item(self, handle):
+        with self._lock:
+            interval, key = self._handles.pop(handle)
+            group = self._groups[interval]
+            sampled = group.attributes[key]
+            sampled.callbacks.pop(handle)
+            if not sampled.callbacks:
+                del group.attributes[key]
+            if not group.attributes:
+                # the pending tick will notice the group is gone
+                del self._groups[interval]
+
+    def _tick(self, group):
+        with self._lock:
+            if self._groups.get(group.interval) is not group:
+                return
+            period = group.interval / 1000.0
+            now = time.time()
+            group.deadline += period
+            if group.deadline < now:
+                # we are late, do not try to catch up missed samples
+                group.deadline = now
+            self.loop.call_later(group.deadline + period - now, lambda: self._tick(group))
+            attributes = list(group.attributes.values())
+        for sampled in attributes:
+            value = self.aspace.get_attribute_value(sampled.nodeid, sampled.attr)
+            if value is sampled.last:
+                continue
+            last = sampled.last
+            sampled.last = value
+            changed = last is None or value.Value != last.Value or value.StatusCode != last.StatusCode
+            if not changed and value.SourceTimestamp == last.SourceTimestamp:
+                continue
+            for handle, (callback, timestamps) in list(sampled.callbacks.items()):
+                if not changed and not timestamps:
+                    continue
+                try:
+                    callback(handle, value)
+                except Exception as ex:
+                    self.logger.exception("Error calling sampling callback %s, %s, %s", handle, callback, ex)
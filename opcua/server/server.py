@@ -93,6 +93,7 @@ class Server(object):
         self.certificate = None
         self.private_key = None
         self._policies = []
+        self._reuse_port = False
         self.nodes = Shortcuts(self.iserver.isession)
 
         # setup some expected values
@@ -123,6 +124,21 @@ class Server(object):
         """
         self.iserver.disabled_clock = val
 
+    def set_reuse_port(self, val=True):
+        """
+        Set SO_REUSEPORT on the listening socket so that several server
+        processes can listen on the same endpoint, see opcua.server.multiprocess
+        """
+        self._reuse_port = val
+
+    def set_method_executor(self, executor):
+        """
+        Run method callbacks in executor, a concurrent.futures.Executor,
+        instead of the server event loop, so slow methods do not block other clients.
+        Coroutine functions are always awaited on the server event loop.
+        """
+        self.iserver.method_service.set_executor(executor)
+
     def set_application_uri(self, uri):
         """
         Set application/server URI.
@@ -272,7 +288,7 @@ class Server(object):
         """
         self._setup_server_nodes()
         self.iserver.start()
-        self.bserver = BinaryServer(self.iserver, self.endpoint.hostname, self.endpoint.port)
+        self.bserver = BinaryServer(self.iserver, self.endpoint.hostname, self.endpoint.port, self._reuse_port)
         self.bserver.set_policies(self._policies)
         self.bserver.start()
 
@@ -506,6 +522,29 @@ class Server(object):
     def unsubscribe_server_callback(self, event, handle):
         self.iserver.unsubscribe_server_callback(event, handle)
 
+    def register_service(self, typeid, handler):
+        """
+        Handle requests whose binary encoding id is typeid with handler,
+        see InternalServer.register_service
+        """
+        self.iserver.register_service(typeid, handler)
+
+    def unregister_service(self, typeid):
+        self.iserver.unregister_service(typeid)
+
+    def get_service(self, typeid):
+        return self.iserver.get_service(typeid)
+
+    def wrap_service(self, typeid, middleware):
+        """
+        Wrap the handler of typeid with middleware, for example to time,
+        log or authorize requests, see InternalServer.wrap_service
+        """
+        self.iserver.wrap_service(typeid, middleware)
+
+    def wrap_services(self, middleware):
+        self.iserver.wrap_services(middleware)
+
     def link_method(self, node, callback):
         """
         Link a python function to a UA method in the address space; required when a UA method has been imported
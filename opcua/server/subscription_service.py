@@ -2,11 +2,15 @@
 server side implementation of subscription service
 """
 
-from threading import RLock
+from threading import RLock, Lock
 import logging
+import weakref
 
 from opcua import ua
-from opcua.server.internal_subscription import InternalSubscription
+from opcua.common import utils
+from opcua.server.internal_subscription import InternalSubscription, EventProjection, select_clause_names
+from opcua.server.internal_subscription import SharedDataValue
+from opcua.server.sampler import Sampler
 
 
 class SubscriptionService(object):
@@ -15,11 +19,49 @@ class SubscriptionService(object):
         self.logger = logging.getLogger(__name__)
         self.loop = loop
         self.aspace = aspace
+        self.sampler = Sampler(loop, aspace)
         self.subscriptions = {}
         self._sub_id_counter = 77
         self._lock = RLock()
+        self.max_queue_size = 10000  # largest queue size of a monitored item
+        self.default_event_queue_size = 1000  # queue size of event monitored items requesting 0
+        self.max_queued_notifications = 100000  # for all subscriptions of the server
+        self.max_notifications_per_publish = 10000  # used when client requests 0 or more
+        self.max_retransmission_count = 10  # unacknowledged messages kept per subscription
+        self.max_retransmission_bytes = 256 * 1024
+        self.max_publish_requests = 10  # PublishRequests queued per session
+        # results waiting for a PublishRequest per session, not more than the
+        # retransmission queue so a dropped message can usually be republished
+        self.max_pending_publish_results = 10
+        self._queued_notifications = 0
+        self._queued_lock = Lock()
+        self._event_routes = {}  # notifier nodeid -> tuple of (MonitoredItemService, monitored item id)
+        self._source_index = None  # event source nodeid -> routes, built from _event_routes when needed
+        self._source_index_version = None
+        self._routes_lock = Lock()
+        self._event_projections = weakref.WeakValueDictionary()
+        self._shared_values = weakref.WeakValueDictionary()
 
-    def create_subscription(self, params, callback):
+    def reserve_notification(self):
+        """
+        account for one more queued notification.
+        return False if the server wide limit is reached
+        """
+        with self._queued_lock:
+            if self._queued_notifications >= self.max_queued_notifications:
+                return False
+            self._queued_notifications += 1
+            return True
+
+    def release_notifications(self, count):
+        with self._queued_lock:
+            self._queued_notifications -= count
+
+    def create_subscription(self, params, callback, max_message_size=0):
+        """
+        max_message_size is the largest response the client accepts in bytes,
+        NotificationMessages are split to fit in it. 0 means no limit
+        """
         self.logger.info("create subscription with callback: %s", callback)
         result = ua.CreateSubscriptionResult()
         result.RevisedPublishingInterval = params.RequestedPublishingInterval
@@ -30,6 +72,8 @@ class SubscriptionService(object):
             result.SubscriptionId = self._sub_id_counter
 
             sub = InternalSubscription(self, result, self.aspace, callback)
+            sub.max_notifications = params.MaxNotificationsPerPublish
+            sub.max_message_size = max_message_size
             sub.start()
             self.subscriptions[result.SubscriptionId] = sub
 
@@ -48,11 +92,19 @@ class SubscriptionService(object):
                     res.append(ua.StatusCode())
         return res
 
-    def publish(self, acks):
+    def publish(self, acks, subscription_ids=None):
+        """
+        handle a PublishRequest of the session owning subscription_ids,
+        None means all subscriptions
+        """
         self.logger.info("publish request with acks %s", acks)
         with self._lock:
-            for subid, sub in self.subscriptions.items():
-                sub.publish([ack.SequenceNumber for ack in acks if ack.SubscriptionId == subid])
+            if subscription_ids is None:
+                subs = list(self.subscriptions.items())
+            else:
+                subs = [(subid, self.subscriptions[subid]) for subid in subscription_ids if subid in self.subscriptions]
+        for subid, sub in subs:
+            sub.publish([ack.SequenceNumber for ack in acks if ack.SubscriptionId == subid])
 
     def create_monitored_items(self, params):
         self.logger.info("create monitored items")
@@ -90,13 +142,92 @@ class SubscriptionService(object):
                 params.MonitoredItemIds)
 
     def republish(self, params):
+        """
+        return the encoded NotificationMessage to send again
+        """
         with self._lock:
-            if params.SubscriptionId not in self.subscriptions:
-                # TODO: what should I do?
-                return ua.NotificationMessage()
-            return self.subscriptions[params.SubscriptionId].republish(params.RetransmitSequenceNumber)
+            sub = self.subscriptions.get(params.SubscriptionId)
+        if sub is None:
+            raise utils.ServiceError(ua.StatusCodes.BadSubscriptionIdInvalid)
+        return sub.republish(params.RetransmitSequenceNumber)
+
+    def add_event_route(self, notifier, misrv, mid):
+        """
+        deliver events of notifier, and of the nodes it is a notifier of, to monitored item mid
+        """
+        with self._routes_lock:
+            self._event_routes[notifier] = self._event_routes.get(notifier, ()) + ((misrv, mid),)
+            self._source_index = None
+
+    def delete_event_route(self, notifier, misrv, mid):
+        with self._routes_lock:
+            routes = tuple(route for route in self._event_routes.get(notifier, ()) if route != (misrv, mid))
+            if routes:
+                self._event_routes[notifier] = routes
+            else:
+                self._event_routes.pop(notifier, None)
+            self._source_index = None
+
+    def get_event_projection(self, select_clauses):
+        """
+        return the EventProjection of select clauses, shared by all
+        monitored items selecting the same event fields
+        """
+        names = select_clause_names(select_clauses)
+        with self._routes_lock:
+            projection = self._event_projections.get(names)
+            if projection is None:
+                projection = EventProjection(names)
+                self._event_projections[names] = projection
+            return projection
+
+    def get_shared_value(self, nodeid, attr, value):
+        """
+        return the SharedDataValue of the current value of an attribute.
+        all monitored items notified of the same value change get the same
+        object, so the value is encoded once whatever the number of sessions.
+        entries disappear once no queued notification holds them
+        """
+        key = (nodeid, attr)
+        shared = self._shared_values.get(key)
+        if shared is None or shared.value is not value:
+            with self._routes_lock:
+                shared = self._shared_values.get(key)
+                if shared is None or shared.value is not value:
+                    shared = SharedDataValue(value)
+                    self._shared_values[key] = shared
+        return shared
 
     def trigger_event(self, event):
-        with self._lock:
-            for sub in self.subscriptions.values():
-                sub.monitored_item_srv.trigger_event(event)
+        index = self._source_index
+        if index is None or self._source_index_version != self.aspace.event_links_version:
+            index = self._build_source_index()
+        projected = {}
+        for misrv, mid in index.get(event.SourceNode, ()):
+            misrv.trigger_event(event, mid, projected)
+
+    def _build_source_index(self):
+        """
+        map every event source to the monitored items of its notifiers,
+        following HasEventSource and HasNotifier references down from the
+        monitored notifiers
+        """
+        with self._routes_lock:
+            version = self.aspace.event_links_version
+            reftypes = self.aspace.get_subtypes(ua.NodeId(ua.ObjectIds.HasEventSource))
+            index = {}
+            for notifier, routes in self._event_routes.items():
+                sources = [notifier]
+                seen = set(sources)
+                for nodeid in sources:
+                    index[nodeid] = index.get(nodeid, ()) + routes
+                    nodedata = self.aspace[nodeid]
+                    if nodedata is None:
+                        continue
+                    for ref in nodedata.references:
+                        if ref.IsForward and ref.ReferenceTypeId in reftypes and ref.NodeId not in seen:
+                            seen.add(ref.NodeId)
+                            sources.append(ref.NodeId)
+            self._source_index = index
+            self._source_index_version = version
+            return index
@@ -1,6 +1,9 @@
 
 import logging
 from threading import RLock, Lock
+from collections import deque
+import heapq
+import itertools
 import time
 
 from opcua import ua
@@ -15,9 +18,134 @@ class PublishRequestData(object):
         self.seqhdr = None
         self.timestamp = time.time()
 
+    def expired(self, now):
+        """
+        True if the TimeoutHint of the request has elapsed, 0 means no timeout
+        """
+        hint = self.requesthdr.TimeoutHint
+        return bool(hint) and now - self.timestamp >= hint / 1000.0
+
+
+class PublishScheduler(object):
+    """
+    Match the PublishRequests of a session with the PublishResults of its
+    subscriptions.
+    Queued requests are answered with BadTimeout as soon as their TimeoutHint
+    elapses, and the oldest one with BadTooManyPublishRequests when more than
+    max_requests are queued.
+    Results produced while no request is queued wait for the next one, highest
+    subscription Priority first, then the subscription waiting the longest.
+    At most max_results wait, the oldest of the lowest priority is dropped
+    beyond and send_overflow is called with its subscription id so the client
+    can be told. Its NotificationMessage can only be republished while it is
+    still in the retransmission queue of the subscription.
+    """
+
+    def __init__(self, loop, send_result, send_fault, max_requests=0, max_results=0, send_overflow=None):
+        self.logger = logging.getLogger(__name__)
+        self.loop = loop
+        self.max_requests = max_requests
+        self.max_results = max_results
+        self._send_result = send_result
+        self._send_fault = send_fault
+        self._send_overflow = send_overflow
+        self._lock = RLock()
+        self._requests = deque()
+        self._results = []  # heap of (-priority, counter, result)
+        self._counter = itertools.count()
+        self._priorities = {}
+        self._closed = False
+
+    def set_priority(self, subscription_id, priority):
+        with self._lock:
+            self._priorities[subscription_id] = priority
+
+    def remove_subscription(self, subscription_id):
+        with self._lock:
+            self._priorities.pop(subscription_id, None)
+            self._results = [entry for entry in self._results if entry[2].SubscriptionId != subscription_id]
+            heapq.heapify(self._results)
+
+    def add_request(self, data):
+        with self._lock:
+            if self._closed:
+                return
+            self.expire_requests()
+            if self._results:
+                self._send_result(data, heapq.heappop(self._results)[2])
+                return
+            if self.max_requests and len(self._requests) >= self.max_requests:
+                self.logger.info("Too many publish requests queued, rejecting oldest one")
+                self._send_fault(self._requests.popleft(), ua.StatusCodes.BadTooManyPublishRequests)
+            self._requests.append(data)
+        hint = data.requesthdr.TimeoutHint
+        if hint:
+            self.loop.call_later(hint / 1000.0, self.expire_requests)
+
+    def add_result(self, result):
+        with self._lock:
+            if self._closed:
+                return
+            data = self._pop_request()
+            if data is not None:
+                self._send_result(data, result)
+                return
+            subid = result.SubscriptionId
+            if not result.NotificationMessage.NotificationData and \
+                    any(entry[2].SubscriptionId == subid for entry in self._results):
+                # a waiting result of the subscription already tells client it is alive
+                return
+            if self.max_results and len(self._results) >= self.max_results:
+                dropped = max(self._results, key=lambda entry: (entry[0], -entry[1]))
+                self._results.remove(dropped)
+                heapq.heapify(self._results)
+                self.logger.warning("Too many publish results waiting for a publish request, dropping message %s"
+                                    " of subscription %s", dropped[2].NotificationMessage.SequenceNumber,
+                                    dropped[2].SubscriptionId)
+                if self._send_overflow is not None:
+                    self._send_overflow(dropped[2].SubscriptionId)
+            priority = self._priorities.get(subid, 0)
+            heapq.heappush(self._results, (-priority, next(self._counter), result))
+            self.logger.info("No publish request available, %s results waiting", len(self._results))
+
+    def _pop_request(self):
+        now = time.time()
+        while self._requests:
+            data = self._requests.popleft()
+            if not data.expired(now):
+                return data
+            self._send_fault(data, ua.StatusCodes.BadTimeout)
+        return None
+
+    def expire_requests(self):
+        """
+        answer queued requests whose timeout elapsed with BadTimeout
+        """
+        with self._lock:
+            if self._closed:
+                return
+            now = time.time()
+            pending = deque()
+            for data in self._requests:
+                if data.expired(now):
+                    self._send_fault(data, ua.StatusCodes.BadTimeout)
+                else:
+                    pending.append(data)
+            self._requests = pending
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            self._requests.clear()
+            self._results = []
+
 
 class UaProcessor(object):
 
+    # binary encoding NodeId of requests -> handler, filled at end of module.
+    # every InternalServer starts with a copy of it, see InternalServer.register_service
+    services = {}
+
     def __init__(self, internal_server, socket):
         self.logger = logging.getLogger(__name__)
         self.iserver = internal_server
@@ -25,20 +153,27 @@ class UaProcessor(object):
         self.sockname = socket.get_extra_info('sockname')
         self.session = None
         self.socket = socket
+        self.services = internal_server.services
         self._socketlock = Lock()
-        self._datalock = RLock()
-        self._publishdata_queue = []
-        self._publish_result_queue = []  # used when we need to wait for PublishRequest
+        subservice = internal_server.subscription_service
+        self._publish_scheduler = PublishScheduler(internal_server.loop, self._send_publish_result,
+                                                   self._send_publish_fault, subservice.max_publish_requests,
+                                                   subservice.max_pending_publish_results,
+                                                   self._send_publish_overflow)
+        self._max_message_size = 0  # announced by client in Hello, 0 means no limit
         self._connection = ua.SecureConnection(ua.SecurityPolicy())
 
     def set_policies(self, policies):
         self._connection.set_policy_factories(policies)
 
     def send_response(self, requesthandle, algohdr, seqhdr, response, msgtype=ua.MessageType.SecureMessage):
+        response.ResponseHeader.RequestHandle = requesthandle
+        self.send_encoded_response(response.to_binary(), algohdr, seqhdr, msgtype)
+
+    def send_encoded_response(self, body, algohdr, seqhdr, msgtype=ua.MessageType.SecureMessage):
         with self._socketlock:
-            response.ResponseHeader.RequestHandle = requesthandle
             data = self._connection.message_to_binary(
-                response.to_binary(), message_type=msgtype, request_id=seqhdr.RequestId, algohdr=algohdr)
+                body, message_type=msgtype, request_id=seqhdr.RequestId, algohdr=algohdr)
 
             self.socket.write(data)
 
@@ -56,23 +191,29 @@ class UaProcessor(object):
 
     def forward_publish_response(self, result):
         self.logger.info("forward publish response %s", result)
-        with self._datalock:
-            while True:
-                if len(self._publishdata_queue) == 0:
-                    self._publish_result_queue.append(result)
-                    self.logger.info("Server wants to send publish answer but no publish request is available,"
-                                     "enqueing notification, length of result queue is %s",
-                                     len(self._publish_result_queue))
-                    return
-                requestdata = self._publishdata_queue.pop(0)
-                if time.time() - requestdata.timestamp < requestdata.requesthdr.TimeoutHint / 1000:
-                    break
+        self._publish_scheduler.add_result(result)
 
+    def _send_publish_result(self, requestdata, result):
         response = ua.PublishResponse()
         response.Parameters = result
 
         self.send_response(requestdata.requesthdr.RequestHandle, requestdata.algohdr, requestdata.seqhdr, response)
 
+    def _send_publish_fault(self, requestdata, code):
+        response = ua.ServiceFault()
+        response.ResponseHeader.ServiceResult = ua.StatusCode(code)
+        self.logger.info("answering publish request with %s", response.ResponseHeader.ServiceResult.name)
+        self.send_response(requestdata.requesthdr.RequestHandle, requestdata.algohdr, requestdata.seqhdr, response)
+
+    def _send_publish_overflow(self, subscription_id):
+        """
+        a result of the subscription was dropped, tell the client with a
+        StatusChangeNotification in the next message of the subscription
+        """
+        sub = self.iserver.subscription_service.subscriptions.get(subscription_id)
+        if sub is not None:
+            sub.enqueue_statuschange(ua.StatusCode(ua.StatusCodes.BadTooManyPublishRequests))
+
     def process(self, header, body):
         msg = self._connection.receive_from_header_and_body(header, body)
         if isinstance(msg, ua.Message):
@@ -86,6 +227,7 @@ class UaProcessor(object):
             elif header.MessageType == ua.MessageType.SecureMessage:
                 return self.process_message(msg.SecurityHeader(), msg.SequenceHeader(), msg.body())
         elif isinstance(msg, ua.Hello):
+            self._max_message_size = msg.MaxMessageSize
             ack = ua.Acknowledge()
             ack.ReceiveBufferSize = msg.ReceiveBufferSize
             ack.SendBufferSize = msg.SendBufferSize
@@ -114,338 +256,342 @@ class UaProcessor(object):
             return True
 
     def _process_message(self, typeid, requesthdr, algohdr, seqhdr, body):
-        if typeid == ua.NodeId(ua.ObjectIds.CreateSessionRequest_Encoding_DefaultBinary):
-            self.logger.info("Create session request")
-            params = ua.CreateSessionParameters.from_binary(body)
-
-            # create the session on server
-            self.session = self.iserver.create_session(self.name, external=True)
-            # get a session creation result to send back
-            sessiondata = self.session.create_session(params, sockname=self.sockname)
-
-            response = ua.CreateSessionResponse()
-            response.Parameters = sessiondata
-            response.Parameters.ServerCertificate = self._connection._security_policy.client_certificate
-            if self._connection._security_policy.server_certificate is None:
-                data = params.ClientNonce
-            else:
-                data = self._connection._security_policy.server_certificate + params.ClientNonce
-            response.Parameters.ServerSignature.Signature = \
-                self._connection._security_policy.asymmetric_cryptography.signature(data)
-
-            response.Parameters.ServerSignature.Algorithm = "http://www.w3.org/2000/09/xmldsig#rsa-sha1"
-
-            self.logger.info("sending create sesssion response")
-            self.send_response(requesthdr.RequestHandle, algohdr, seqhdr, response)
-
-        elif typeid == ua.NodeId(ua.ObjectIds.CloseSessionRequest_Encoding_DefaultBinary):
-            self.logger.info("Close session request")
-            deletesubs = ua.ua_binary.Primitives.Boolean.unpack(body)
+        handler = self.services.get(typeid)
+        if handler is None:
+            self.logger.warning("Unknown message received %s", typeid)
+            raise utils.ServiceError(ua.StatusCodes.BadNotImplemented)
+        return handler(self, requesthdr, algohdr, seqhdr, body) is not False
+
+    def _process_create_session(self, requesthdr, algohdr, seqhdr, body):
+        self.logger.info("Create session request")
+        params = ua.CreateSessionParameters.from_binary(body)
+
+        # create the session on server
+        self.session = self.iserver.create_session(self.name, external=True)
+        # get a session creation result to send back
+        sessiondata = self.session.create_session(params, sockname=self.sockname)
+
+        response = ua.CreateSessionResponse()
+        response.Parameters = sessiondata
+        response.Parameters.ServerCertificate = self._connection._security_policy.client_certificate
+        if self._connection._security_policy.server_certificate is None:
+            data = params.ClientNonce
+        else:
+            data = self._connection._security_policy.server_certificate + params.ClientNonce
+        response.Parameters.ServerSignature.Signature = \
+            self._connection._security_policy.asymmetric_cryptography.signature(data)
 
-            self.session.close_session(deletesubs)
+        response.Parameters.ServerSignature.Algorithm = "http://www.w3.org/2000/09/xmldsig#rsa-sha1"
 
-            response = ua.CloseSessionResponse()
-            self.logger.info("sending close sesssion response")
-            self.send_response(requesthdr.RequestHandle, algohdr, seqhdr, response)
+        self.logger.info("sending create sesssion response")
+        self.send_response(requesthdr.RequestHandle, algohdr, seqhdr, response)
 
-        elif typeid == ua.NodeId(ua.ObjectIds.ActivateSessionRequest_Encoding_DefaultBinary):
-            self.logger.info("Activate session request")
-            params = ua.ActivateSessionParameters.from_binary(body)
+    def _process_close_session(self, requesthdr, algohdr, seqhdr, body):
+        self.logger.info("Close session request")
+        deletesubs = ua.ua_binary.Primitives.Boolean.unpack(body)
 
-            if not self.session:
-                self.logger.info("request to activate non-existing session")
-                raise utils.ServiceError(ua.StatusCodes.BadSessionIdInvalid)
+        self.session.close_session(deletesubs)
 
-            if self._connection._security_policy.client_certificate is None:
-                data = self.session.nonce
-            else:
-                data = self._connection._security_policy.client_certificate + self.session.nonce
-            self._connection._security_policy.asymmetric_cryptography.verify(data, params.ClientSignature.Signature)
+        response = ua.CloseSessionResponse()
+        self.logger.info("sending close sesssion response")
+        self.send_response(requesthdr.RequestHandle, algohdr, seqhdr, response)
 
-            result = self.session.activate_session(params)
+    def _process_activate_session(self, requesthdr, algohdr, seqhdr, body):
+        self.logger.info("Activate session request")
+        params = ua.ActivateSessionParameters.from_binary(body)
 
-            response = ua.ActivateSessionResponse()
-            response.Parameters = result
+        if not self.session:
+            self.logger.info("request to activate non-existing session")
+            raise utils.ServiceError(ua.StatusCodes.BadSessionIdInvalid)
 
-            self.logger.info("sending read response")
-            self.send_response(requesthdr.RequestHandle, algohdr, seqhdr, response)
+        if self._connection._security_policy.client_certificate is None:
+            data = self.session.nonce
+        else:
+            data = self._connection._security_policy.client_certificate + self.session.nonce
+        self._connection._security_policy.asymmetric_cryptography.verify(data, params.ClientSignature.Signature)
 
-        elif typeid == ua.NodeId(ua.ObjectIds.ReadRequest_Encoding_DefaultBinary):
-            self.logger.info("Read request")
-            params = ua.ReadParameters.from_binary(body)
+        result = self.session.activate_session(params)
 
-            results = self.session.read(params)
+        response = ua.ActivateSessionResponse()
+        response.Parameters = result
 
-            response = ua.ReadResponse()
-            response.Results = results
+        self.logger.info("sending read response")
+        self.send_response(requesthdr.RequestHandle, algohdr, seqhdr, response)
 
-            self.logger.info("sending read response")
-            self.send_response(requesthdr.RequestHandle, algohdr, seqhdr, response)
+    def _process_read(self, requesthdr, algohdr, seqhdr, body):
+        self.logger.info("Read request")
+        params = ua.ReadParameters.from_binary(body)
 
-        elif typeid == ua.NodeId(ua.ObjectIds.WriteRequest_Encoding_DefaultBinary):
-            self.logger.info("Write request")
-            params = ua.WriteParameters.from_binary(body)
+        results = self.session.read(params)
 
-            results = self.session.write(params)
+        response = ua.ReadResponse()
+        response.Results = results
 
-            response = ua.WriteResponse()
-            response.Results = results
+        self.logger.info("sending read response")
+        self.send_response(requesthdr.RequestHandle, algohdr, seqhdr, response)
 
-            self.logger.info("sending write response")
-            self.send_response(requesthdr.RequestHandle, algohdr, seqhdr, response)
+    def _process_write(self, requesthdr, algohdr, seqhdr, body):
+        self.logger.info("Write request")
+        params = ua.WriteParameters.from_binary(body)
 
-        elif typeid == ua.NodeId(ua.ObjectIds.BrowseRequest_Encoding_DefaultBinary):
-            self.logger.info("Browse request")
-            params = ua.BrowseParameters.from_binary(body)
+        results = self.session.write(params)
 
-            results = self.session.browse(params)
+        response = ua.WriteResponse()
+        response.Results = results
 
-            response = ua.BrowseResponse()
-            response.Results = results
+        self.logger.info("sending write response")
+        self.send_response(requesthdr.RequestHandle, algohdr, seqhdr, response)
 
-            self.logger.info("sending browse response")
-            self.send_response(requesthdr.RequestHandle, algohdr, seqhdr, response)
+    def _process_browse(self, requesthdr, algohdr, seqhdr, body):
+        self.logger.info("Browse request")
+        params = ua.BrowseParameters.from_binary(body)
 
-        elif typeid == ua.NodeId(ua.ObjectIds.GetEndpointsRequest_Encoding_DefaultBinary):
-            self.logger.info("get endpoints request")
-            params = ua.GetEndpointsParameters.from_binary(body)
+        results = self.session.browse(params)
 
-            endpoints = self.iserver.get_endpoints(params, sockname=self.sockname)
+        response = ua.BrowseResponse()
+        response.Results = results
 
-            response = ua.GetEndpointsResponse()
-            response.Endpoints = endpoints
+        self.logger.info("sending browse response")
+        self.send_response(requesthdr.RequestHandle, algohdr, seqhdr, response)
 
-            self.logger.info("sending get endpoints response")
-            self.send_response(requesthdr.RequestHandle, algohdr, seqhdr, response)
+    def _process_get_endpoints(self, requesthdr, algohdr, seqhdr, body):
+        self.logger.info("get endpoints request")
+        params = ua.GetEndpointsParameters.from_binary(body)
 
-        elif typeid == ua.NodeId(ua.ObjectIds.FindServersRequest_Encoding_DefaultBinary):
-            self.logger.info("find servers request")
-            params = ua.FindServersParameters.from_binary(body)
+        endpoints = self.iserver.get_endpoints(params, sockname=self.sockname)
 
-            servers = self.iserver.find_servers(params)
+        response = ua.GetEndpointsResponse()
+        response.Endpoints = endpoints
 
-            response = ua.FindServersResponse()
-            response.Servers = servers
+        self.logger.info("sending get endpoints response")
+        self.send_response(requesthdr.RequestHandle, algohdr, seqhdr, response)
 
-            self.logger.info("sending find servers response")
-            self.send_response(requesthdr.RequestHandle, algohdr, seqhdr, response)
+    def _process_find_servers(self, requesthdr, algohdr, seqhdr, body):
+        self.logger.info("find servers request")
+        params = ua.FindServersParameters.from_binary(body)
 
-        elif typeid == ua.NodeId(ua.ObjectIds.RegisterServerRequest_Encoding_DefaultBinary):
-            self.logger.info("register server request")
-            serv = ua.RegisteredServer.from_binary(body)
+        servers = self.iserver.find_servers(params)
 
-            self.iserver.register_server(serv)
+        response = ua.FindServersResponse()
+        response.Servers = servers
 
-            response = ua.RegisterServerResponse()
+        self.logger.info("sending find servers response")
+        self.send_response(requesthdr.RequestHandle, algohdr, seqhdr, response)
 
-            self.logger.info("sending register server response")
-            self.send_response(requesthdr.RequestHandle, algohdr, seqhdr, response)
+    def _process_register_server(self, requesthdr, algohdr, seqhdr, body):
+        self.logger.info("register server request")
+        serv = ua.RegisteredServer.from_binary(body)
 
-        elif typeid == ua.NodeId(ua.ObjectIds.RegisterServer2Request_Encoding_DefaultBinary):
-            self.logger.info("register server 2 request")
-            params = ua.RegisterServer2Parameters.from_binary(body)
+        self.iserver.register_server(serv)
 
-            results = self.iserver.register_server2(params)
+        response = ua.RegisterServerResponse()
 
-            response = ua.RegisterServer2Response()
-            response.ConfigurationResults = results
+        self.logger.info("sending register server response")
+        self.send_response(requesthdr.RequestHandle, algohdr, seqhdr, response)
 
-            self.logger.info("sending register server 2 response")
-            self.send_response(requesthdr.RequestHandle, algohdr, seqhdr, response)
+    def _process_register_server2(self, requesthdr, algohdr, seqhdr, body):
+        self.logger.info("register server 2 request")
+        params = ua.RegisterServer2Parameters.from_binary(body)
 
-        elif typeid == ua.NodeId(ua.ObjectIds.TranslateBrowsePathsToNodeIdsRequest_Encoding_DefaultBinary):
-            self.logger.info("translate browsepaths to nodeids request")
-            params = ua.TranslateBrowsePathsToNodeIdsParameters.from_binary(body)
+        results = self.iserver.register_server2(params)
 
-            paths = self.session.translate_browsepaths_to_nodeids(params.BrowsePaths)
+        response = ua.RegisterServer2Response()
+        response.ConfigurationResults = results
 
-            response = ua.TranslateBrowsePathsToNodeIdsResponse()
-            response.Results = paths
+        self.logger.info("sending register server 2 response")
+        self.send_response(requesthdr.RequestHandle, algohdr, seqhdr, response)
 
-            self.logger.info("sending translate browsepaths to nodeids response")
-            self.send_response(requesthdr.RequestHandle, algohdr, seqhdr, response)
+    def _process_translate_browsepaths_to_nodeids(self, requesthdr, algohdr, seqhdr, body):
+        self.logger.info("translate browsepaths to nodeids request")
+        params = ua.TranslateBrowsePathsToNodeIdsParameters.from_binary(body)
 
-        elif typeid == ua.NodeId(ua.ObjectIds.AddNodesRequest_Encoding_DefaultBinary):
-            self.logger.info("add nodes request")
-            params = ua.AddNodesParameters.from_binary(body)
+        paths = self.session.translate_browsepaths_to_nodeids(params.BrowsePaths)
 
-            results = self.session.add_nodes(params.NodesToAdd)
+        response = ua.TranslateBrowsePathsToNodeIdsResponse()
+        response.Results = paths
 
-            response = ua.AddNodesResponse()
-            response.Results = results
+        self.logger.info("sending translate browsepaths to nodeids response")
+        self.send_response(requesthdr.RequestHandle, algohdr, seqhdr, response)
 
-            self.logger.info("sending add node response")
-            self.send_response(requesthdr.RequestHandle, algohdr, seqhdr, response)
+    def _process_add_nodes(self, requesthdr, algohdr, seqhdr, body):
+        self.logger.info("add nodes request")
+        params = ua.AddNodesParameters.from_binary(body)
 
-        elif typeid == ua.NodeId(ua.ObjectIds.DeleteNodesRequest_Encoding_DefaultBinary):
-            self.logger.info("delete nodes request")
-            params = ua.DeleteNodesParameters.from_binary(body)
+        results = self.session.add_nodes(params.NodesToAdd)
 
-            results = self.session.delete_nodes(params)
+        response = ua.AddNodesResponse()
+        response.Results = results
 
-            response = ua.DeleteNodesResponse()
-            response.Results = results
+        self.logger.info("sending add node response")
+        self.send_response(requesthdr.RequestHandle, algohdr, seqhdr, response)
 
-            self.logger.info("sending delete node response")
-            self.send_response(requesthdr.RequestHandle, algohdr, seqhdr, response)
+    def _process_delete_nodes(self, requesthdr, algohdr, seqhdr, body):
+        self.logger.info("delete nodes request")
+        params = ua.DeleteNodesParameters.from_binary(body)
 
-        elif typeid == ua.NodeId(ua.ObjectIds.AddReferencesRequest_Encoding_DefaultBinary):
-            self.logger.info("add references request")
-            params = ua.AddReferencesParameters.from_binary(body)
+        results = self.session.delete_nodes(params)
 
-            results = self.session.add_references(params.ReferencesToAdd)
+        response = ua.DeleteNodesResponse()
+        response.Results = results
 
-            response = ua.AddReferencesResponse()
-            response.Results = results
+        self.logger.info("sending delete node response")
+        self.send_response(requesthdr.RequestHandle, algohdr, seqhdr, response)
 
-            self.logger.info("sending add references response")
-            self.send_response(requesthdr.RequestHandle, algohdr, seqhdr, response)
+    def _process_add_references(self, requesthdr, algohdr, seqhdr, body):
+        self.logger.info("add references request")
+        params = ua.AddReferencesParameters.from_binary(body)
 
-        elif typeid == ua.NodeId(ua.ObjectIds.CreateSubscriptionRequest_Encoding_DefaultBinary):
-            self.logger.info("create subscription request")
-            params = ua.CreateSubscriptionParameters.from_binary(body)
+        results = self.session.add_references(params.ReferencesToAdd)
 
-            result = self.session.create_subscription(params, self.forward_publish_response)
+        response = ua.AddReferencesResponse()
+        response.Results = results
 
-            response = ua.CreateSubscriptionResponse()
-            response.Parameters = result
+        self.logger.info("sending add references response")
+        self.send_response(requesthdr.RequestHandle, algohdr, seqhdr, response)
 
-            self.logger.info("sending create subscription response")
-            self.send_response(requesthdr.RequestHandle, algohdr, seqhdr, response)
+    def _process_create_subscription(self, requesthdr, algohdr, seqhdr, body):
+        self.logger.info("create subscription request")
+        params = ua.CreateSubscriptionParameters.from_binary(body)
 
-        elif typeid == ua.NodeId(ua.ObjectIds.DeleteSubscriptionsRequest_Encoding_DefaultBinary):
-            self.logger.info("delete subscriptions request")
-            params = ua.DeleteSubscriptionsParameters.from_binary(body)
+        result = self.session.create_subscription(params, self.forward_publish_response, self._max_message_size)
+        self._publish_scheduler.set_priority(result.SubscriptionId, params.Priority)
 
-            results = self.session.delete_subscriptions(params.SubscriptionIds)
+        response = ua.CreateSubscriptionResponse()
+        response.Parameters = result
 
-            response = ua.DeleteSubscriptionsResponse()
-            response.Results = results
+        self.logger.info("sending create subscription response")
+        self.send_response(requesthdr.RequestHandle, algohdr, seqhdr, response)
 
-            self.logger.info("sending delte subscription response")
-            self.send_response(requesthdr.RequestHandle, algohdr, seqhdr, response)
+    def _process_delete_subscriptions(self, requesthdr, algohdr, seqhdr, body):
+        self.logger.info("delete subscriptions request")
+        params = ua.DeleteSubscriptionsParameters.from_binary(body)
 
-        elif typeid == ua.NodeId(ua.ObjectIds.CreateMonitoredItemsRequest_Encoding_DefaultBinary):
-            self.logger.info("create monitored items request")
-            params = ua.CreateMonitoredItemsParameters.from_binary(body)
-            results = self.session.create_monitored_items(params)
+        results = self.session.delete_subscriptions(params.SubscriptionIds)
+        for subid in params.SubscriptionIds:
+            self._publish_scheduler.remove_subscription(subid)
 
-            response = ua.CreateMonitoredItemsResponse()
-            response.Results = results
+        response = ua.DeleteSubscriptionsResponse()
+        response.Results = results
 
-            self.logger.info("sending create monitored items response")
-            self.send_response(requesthdr.RequestHandle, algohdr, seqhdr, response)
+        self.logger.info("sending delte subscription response")
+        self.send_response(requesthdr.RequestHandle, algohdr, seqhdr, response)
 
-        elif typeid == ua.NodeId(ua.ObjectIds.ModifyMonitoredItemsRequest_Encoding_DefaultBinary):
-            self.logger.info("modify monitored items request")
-            params = ua.ModifyMonitoredItemsParameters.from_binary(body)
-            results = self.session.modify_monitored_items(params)
+    def _process_create_monitored_items(self, requesthdr, algohdr, seqhdr, body):
+        self.logger.info("create monitored items request")
+        params = ua.CreateMonitoredItemsParameters.from_binary(body)
+        results = self.session.create_monitored_items(params)
 
-            response = ua.ModifyMonitoredItemsResponse()
-            response.Results = results
+        response = ua.CreateMonitoredItemsResponse()
+        response.Results = results
 
-            self.logger.info("sending modify monitored items response")
-            self.send_response(requesthdr.RequestHandle, algohdr, seqhdr, response)
+        self.logger.info("sending create monitored items response")
+        self.send_response(requesthdr.RequestHandle, algohdr, seqhdr, response)
 
-        elif typeid == ua.NodeId(ua.ObjectIds.DeleteMonitoredItemsRequest_Encoding_DefaultBinary):
-            self.logger.info("delete monitored items request")
-            params = ua.DeleteMonitoredItemsParameters.from_binary(body)
+    def _process_modify_monitored_items(self, requesthdr, algohdr, seqhdr, body):
+        self.logger.info("modify monitored items request")
+        params = ua.ModifyMonitoredItemsParameters.from_binary(body)
+        results = self.session.modify_monitored_items(params)
 
-            results = self.session.delete_monitored_items(params)
+        response = ua.ModifyMonitoredItemsResponse()
+        response.Results = results
 
-            response = ua.DeleteMonitoredItemsResponse()
-            response.Results = results
+        self.logger.info("sending modify monitored items response")
+        self.send_response(requesthdr.RequestHandle, algohdr, seqhdr, response)
 
-            self.logger.info("sending delete monitored items response")
-            self.send_response(requesthdr.RequestHandle, algohdr, seqhdr, response)
+    def _process_delete_monitored_items(self, requesthdr, algohdr, seqhdr, body):
+        self.logger.info("delete monitored items request")
+        params = ua.DeleteMonitoredItemsParameters.from_binary(body)
 
-        elif typeid == ua.NodeId(ua.ObjectIds.HistoryReadRequest_Encoding_DefaultBinary):
-            self.logger.info("history read request")
-            params = ua.HistoryReadParameters.from_binary(body)
+        results = self.session.delete_monitored_items(params)
 
-            results = self.session.history_read(params)
+        response = ua.DeleteMonitoredItemsResponse()
+        response.Results = results
 
-            response = ua.HistoryReadResponse()
-            response.Results = results
+        self.logger.info("sending delete monitored items response")
+        self.send_response(requesthdr.RequestHandle, algohdr, seqhdr, response)
 
-            self.logger.info("sending history read response")
-            self.send_response(requesthdr.RequestHandle, algohdr, seqhdr, response)
+    def _process_history_read(self, requesthdr, algohdr, seqhdr, body):
+        self.logger.info("history read request")
+        params = ua.HistoryReadParameters.from_binary(body)
 
-        elif typeid == ua.NodeId(ua.ObjectIds.RegisterNodesRequest_Encoding_DefaultBinary):
-            self.logger.info("register nodes request")
-            params = ua.RegisterNodesParameters.from_binary(body)
-            self.logger.info("Node registration not implemented")
+        results = self.session.history_read(params)
 
-            response = ua.RegisterNodesResponse()
-            response.Parameters.RegisteredNodeIds = params.NodesToRegister
+        response = ua.HistoryReadResponse()
+        response.Results = results
 
-            self.logger.info("sending register nodes response")
-            self.send_response(requesthdr.RequestHandle, algohdr, seqhdr, response)
+        self.logger.info("sending history read response")
+        self.send_response(requesthdr.RequestHandle, algohdr, seqhdr, response)
 
-        elif typeid == ua.NodeId(ua.ObjectIds.UnregisterNodesRequest_Encoding_DefaultBinary):
-            self.logger.info("unregister nodes request")
-            params = ua.UnregisterNodesParameters.from_binary(body)
+    def _process_register_nodes(self, requesthdr, algohdr, seqhdr, body):
+        self.logger.info("register nodes request")
+        params = ua.RegisterNodesParameters.from_binary(body)
+        self.logger.info("Node registration not implemented")
 
-            response = ua.UnregisterNodesResponse()
+        response = ua.RegisterNodesResponse()
+        response.Parameters.RegisteredNodeIds = params.NodesToRegister
 
-            self.logger.info("sending unregister nodes response")
-            self.send_response(requesthdr.RequestHandle, algohdr, seqhdr, response)
+        self.logger.info("sending register nodes response")
+        self.send_response(requesthdr.RequestHandle, algohdr, seqhdr, response)
 
-        elif typeid == ua.NodeId(ua.ObjectIds.PublishRequest_Encoding_DefaultBinary):
-            self.logger.info("publish request")
+    def _process_unregister_nodes(self, requesthdr, algohdr, seqhdr, body):
+        self.logger.info("unregister nodes request")
+        params = ua.UnregisterNodesParameters.from_binary(body)
 
-            if not self.session:
-                return False
+        response = ua.UnregisterNodesResponse()
 
-            params = ua.PublishParameters.from_binary(body)
+        self.logger.info("sending unregister nodes response")
+        self.send_response(requesthdr.RequestHandle, algohdr, seqhdr, response)
 
-            data = PublishRequestData()
-            data.requesthdr = requesthdr
-            data.seqhdr = seqhdr
-            data.algohdr = algohdr
-            with self._datalock:
-                self._publishdata_queue.append(data)  # will be used to send publish answers from server
-                if self._publish_result_queue:
-                    result = self._publish_result_queue.pop(0)
-                    self.forward_publish_response(result)
-            self.session.publish(params.SubscriptionAcknowledgements)
-            self.logger.info("publish forward to server")
+    def _process_publish(self, requesthdr, algohdr, seqhdr, body):
+        self.logger.info("publish request")
 
-        elif typeid == ua.NodeId(ua.ObjectIds.RepublishRequest_Encoding_DefaultBinary):
-            self.logger.info("re-publish request")
+        if not self.session:
+            return False
 
-            params = ua.RepublishParameters.from_binary(body)
-            msg = self.session.republish(params)
+        params = ua.PublishParameters.from_binary(body)
 
-            response = ua.RepublishResponse()
-            response.NotificationMessage = msg
+        data = PublishRequestData()
+        data.requesthdr = requesthdr
+        data.seqhdr = seqhdr
+        data.algohdr = algohdr
+        self._publish_scheduler.add_request(data)
+        self.session.publish(params.SubscriptionAcknowledgements)
+        self.logger.info("publish forward to server")
 
-            self.send_response(requesthdr.RequestHandle, algohdr, seqhdr, response)
+    def _process_republish(self, requesthdr, algohdr, seqhdr, body):
+        self.logger.info("re-publish request")
 
-        elif typeid == ua.NodeId(ua.ObjectIds.CloseSecureChannelRequest_Encoding_DefaultBinary):
-            self.logger.info("close secure channel request")
-            self._connection.close()
-            response = ua.CloseSecureChannelResponse()
-            self.send_response(requesthdr.RequestHandle, algohdr, seqhdr, response)
-            return False
+        params = ua.RepublishParameters.from_binary(body)
+        msg = self.session.republish(params)
 
-        elif typeid == ua.NodeId(ua.ObjectIds.CallRequest_Encoding_DefaultBinary):
-            self.logger.info("call request")
+        # message is kept encoded, append it to the encoded response header
+        response = ua.RepublishResponse()
+        response.ResponseHeader.RequestHandle = requesthdr.RequestHandle
+        data = response.TypeId.to_binary() + response.ResponseHeader.to_binary() + msg
+        self.send_encoded_response(data, algohdr, seqhdr)
 
-            params = ua.CallParameters.from_binary(body)
+    def _process_close_secure_channel(self, requesthdr, algohdr, seqhdr, body):
+        self.logger.info("close secure channel request")
+        self._connection.close()
+        response = ua.CloseSecureChannelResponse()
+        self.send_response(requesthdr.RequestHandle, algohdr, seqhdr, response)
+        return False
 
-            results = self.session.call(params.MethodsToCall)
+    def _process_call(self, requesthdr, algohdr, seqhdr, body):
+        self.logger.info("call request")
 
-            response = ua.CallResponse()
-            response.Results = results
+        params = ua.CallParameters.from_binary(body)
 
-            self.send_response(requesthdr.RequestHandle, algohdr, seqhdr, response)
+        # methods may run in an executor or be coroutines, answer when they are all done
+        future = self.session.call_async(params.MethodsToCall)
+        future.add_done_callback(lambda fut: self.iserver.loop.call_soon(
+            lambda: self._send_call_response(requesthdr, algohdr, seqhdr, fut.result())))
 
-        else:
-            self.logger.warning("Unknown message received %s", typeid)
-            raise utils.ServiceError(ua.StatusCodes.BadNotImplemented)
+    def _send_call_response(self, requesthdr, algohdr, seqhdr, results):
+        response = ua.CallResponse()
+        response.Results = results
 
-        return True
+        self.send_response(requesthdr.RequestHandle, algohdr, seqhdr, response)
 
     def close(self):
         """
@@ -453,5 +599,36 @@ class UaProcessor(object):
         everything we should
         """
         print("Cleanup client connection: ", self.name)
+        self._publish_scheduler.close()
         if self.session:
             self.session.close_session(True)
+
+
+UaProcessor.services.update((ua.NodeId(typeid), handler) for typeid, handler in (
+    (ua.ObjectIds.CreateSessionRequest_Encoding_DefaultBinary, UaProcessor._process_create_session),
+    (ua.ObjectIds.CloseSessionRequest_Encoding_DefaultBinary, UaProcessor._process_close_session),
+    (ua.ObjectIds.ActivateSessionRequest_Encoding_DefaultBinary, UaProcessor._process_activate_session),
+    (ua.ObjectIds.ReadRequest_Encoding_DefaultBinary, UaProcessor._process_read),
+    (ua.ObjectIds.WriteRequest_Encoding_DefaultBinary, UaProcessor._process_write),
+    (ua.ObjectIds.BrowseRequest_Encoding_DefaultBinary, UaProcessor._process_browse),
+    (ua.ObjectIds.GetEndpointsRequest_Encoding_DefaultBinary, UaProcessor._process_get_endpoints),
+    (ua.ObjectIds.FindServersRequest_Encoding_DefaultBinary, UaProcessor._process_find_servers),
+    (ua.ObjectIds.RegisterServerRequest_Encoding_DefaultBinary, UaProcessor._process_register_server),
+    (ua.ObjectIds.RegisterServer2Request_Encoding_DefaultBinary, UaProcessor._process_register_server2),
+    (ua.ObjectIds.TranslateBrowsePathsToNodeIdsRequest_Encoding_DefaultBinary, UaProcessor._process_translate_browsepaths_to_nodeids),
+    (ua.ObjectIds.AddNodesRequest_Encoding_DefaultBinary, UaProcessor._process_add_nodes),
+    (ua.ObjectIds.DeleteNodesRequest_Encoding_DefaultBinary, UaProcessor._process_delete_nodes),
+    (ua.ObjectIds.AddReferencesRequest_Encoding_DefaultBinary, UaProcessor._process_add_references),
+    (ua.ObjectIds.CreateSubscriptionRequest_Encoding_DefaultBinary, UaProcessor._process_create_subscription),
+    (ua.ObjectIds.DeleteSubscriptionsRequest_Encoding_DefaultBinary, UaProcessor._process_delete_subscriptions),
+    (ua.ObjectIds.CreateMonitoredItemsRequest_Encoding_DefaultBinary, UaProcessor._process_create_monitored_items),
+    (ua.ObjectIds.ModifyMonitoredItemsRequest_Encoding_DefaultBinary, UaProcessor._process_modify_monitored_items),
+    (ua.ObjectIds.DeleteMonitoredItemsRequest_Encoding_DefaultBinary, UaProcessor._process_delete_monitored_items),
+    (ua.ObjectIds.HistoryReadRequest_Encoding_DefaultBinary, UaProcessor._process_history_read),
+    (ua.ObjectIds.RegisterNodesRequest_Encoding_DefaultBinary, UaProcessor._process_register_nodes),
+    (ua.ObjectIds.UnregisterNodesRequest_Encoding_DefaultBinary, UaProcessor._process_unregister_nodes),
+    (ua.ObjectIds.PublishRequest_Encoding_DefaultBinary, UaProcessor._process_publish),
+    (ua.ObjectIds.RepublishRequest_Encoding_DefaultBinary, UaProcessor._process_republish),
+    (ua.ObjectIds.CloseSecureChannelRequest_Encoding_DefaultBinary, UaProcessor._process_close_secure_channel),
+    (ua.ObjectIds.CallRequest_Encoding_DefaultBinary, UaProcessor._process_call)
+))
@@ -7,3 +7,4 @@ from opcua.ua.uaprotocol_auto import *
 from opcua.ua.uaprotocol_hand import *
 from opcua.ua.uatypes import *  #TODO: This should be renamed to uatypes_hand
 
+from opcua.ua import ua_codec
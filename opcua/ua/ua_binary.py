@@ -8,9 +8,16 @@ import logging
 from datetime import datetime, timedelta, tzinfo, MAXYEAR
 from calendar import timegm
 import uuid
+from array import array as array_type
 
 from opcua.ua.uaerrors import UaError
 
+try:
+    import numpy
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+
 
 if sys.version_info.major > 2:
     unicode = str
@@ -69,18 +76,53 @@ def win_epoch_to_datetime(epch):
         return datetime(MAXYEAR, 12, 31, 23, 59, 59, 999999)
 
 
-def build_array_format_py2(prefix, length, fmtchar):
-    return prefix + str(length) + fmtchar
+def _array_typecode(fmtchar):
+    """
+    return the array module typecode with same kind and size as a struct format char
+    """
+    size = struct.calcsize("<" + fmtchar)
+    if fmtchar == "?":
+        return None
+    if fmtchar in "fd":
+        candidates = fmtchar
+    elif fmtchar.islower():
+        candidates = "bhilq"
+    else:
+        candidates = "BHILQ"
+    for typecode in candidates:
+        if array_type(typecode).itemsize == size:
+            return typecode
+    return None
+
+
+_array_container = list
 
 
-def build_array_format_py3(prefix, length, fmtchar):
-    return prefix + str(length) + chr(fmtchar)
+def set_array_container(container):
+    """
+    Select the python type returned when unpacking arrays of fixed size
+    numbers, for example Variant arrays of Double, Float or Int32.
+    list: default, one python object per element
+    array.array: a typed array, the data is copied once
+    memoryview: a view on the receive buffer, nothing is copied, the view keeps the
+    whole received message alive. Only available on little endian hosts.
+    numpy.ndarray: a read-only array on the receive buffer, reshaped to the
+    Variant dimensions. Requires numpy.
+    Arrays of other types are always returned as lists.
+    """
+    global _array_container
+    containers = [list, array_type, memoryview]
+    if NUMPY_AVAILABLE:
+        containers.append(numpy.ndarray)
+    if container not in containers:
+        raise UaError("Unsupported array container {0}".format(container))
+    if container is memoryview and sys.byteorder != "little":
+        raise UaError("memoryview array container requires a little endian host")
+    _array_container = container
 
 
-if sys.version_info.major < 3:
-    build_array_format = build_array_format_py2
-else:
-    build_array_format = build_array_format_py3
+def get_array_container():
+    return _array_container
 
 
 class _Primitive(object):
@@ -91,6 +133,7 @@ class _Primitive(object):
         length = len(array)
         b = [self.pack(val) for val in array]
         b.insert(0, Primitives.Int32.pack(length))
+        return b"".join(b)
 
     def unpack_array(self, data):
         length = Primitives.Int32.unpack(data)
@@ -197,25 +240,65 @@ class _Primitive1(_Primitive):
         self.struct = struct.Struct(fmt)
         self.size = self.struct.size
         self.format = self.struct.format
+        self.fmtchar = fmt[1:]
+        self.typecode = _array_typecode(self.fmtchar)
+        self.dtype = numpy.dtype(fmt) if NUMPY_AVAILABLE else None
+        # memoryview.cast uses native sizes, only use it when they match the wire size
+        self._castable = struct.calcsize(self.fmtchar) == self.size
 
     def pack(self, data):
         return struct.pack(self.format, data)
 
     def unpack(self, data):
         return struct.unpack(self.format, data.read(self.size))[0]
-    
-    #def pack_array(self, array):
-        #"""
-        #Basically the same as the method in _Primitive but MAYBE a bit more efficient....
-        #"""
-        #if array is None:
-            #return b'\xff\xff\xff\xff'
-        #length = len(array)
-        #if length == 0:
-            #return b'\x00\x00\x00\x00'
-        #if length == 1:
-            #return b'\x01\x00\x00\x00' + self.pack(array[0])
-        #return struct.pack(build_array_format("<i", length, self.format[1]), length, *array)
+
+    def pack_array(self, array):
+        """
+        pack a sequence of numbers with one struct call
+        array.array and memoryview objects of the matching type are copied as is
+        """
+        if array is None:
+            return b'\xff\xff\xff\xff'
+        if NUMPY_AVAILABLE and isinstance(array, numpy.ndarray):
+            # dtype is little endian, tobytes writes in C order
+            return Primitives.Int32.pack(array.size) + numpy.ascontiguousarray(array, dtype=self.dtype).tobytes()
+        length = len(array)
+        if length == 0:
+            return b'\x00\x00\x00\x00'
+        if sys.byteorder == "little" and self._is_wire_compatible(array):
+            return Primitives.Int32.pack(length) + array.tobytes()
+        return struct.pack("<i{0}{1}".format(length, self.fmtchar), length, *array)
+
+    def _is_wire_compatible(self, array):
+        if isinstance(array, memoryview):
+            return array.format == self.fmtchar and array.itemsize == self.size and array.ndim == 1
+        if isinstance(array, array_type):
+            return array.typecode == self.typecode
+        return False
+
+    def unpack_array(self, data, container=list):
+        """
+        unpack an array of numbers with one struct call
+        container select the returned type, see set_array_container
+        """
+        length = Primitives.Int32.unpack(data)
+        if length == -1:
+            return None
+        length = max(length, 0)
+        size = length * self.size
+        if container is list:
+            return list(struct.unpack("<{0}{1}".format(length, self.fmtchar), data.read(size)))
+        elif NUMPY_AVAILABLE and container is numpy.ndarray:
+            return numpy.frombuffer(data.read_view(size), dtype=self.dtype)
+        elif container is memoryview and self._castable:
+            return data.read_view(size).cast(self.fmtchar)
+        elif container is array_type and self.typecode is not None:
+            arr = array_type(self.typecode)
+            arr.frombytes(data.read_view(size))
+            if sys.byteorder != "little":
+                arr.byteswap()
+            return arr
+        return list(struct.unpack("<{0}{1}".format(length, self.fmtchar), data.read(size)))
 
 
 class Primitives1(object):
@@ -246,6 +329,8 @@ class Primitives(Primitives1):
 
 
 def pack_uatype_array(vtype, array):
+    if hasattr(Primitives, vtype.name):
+        return getattr(Primitives, vtype.name).pack_array(array)
     if array is None:
         return b'\xff\xff\xff\xff'
     length = len(array)
@@ -293,9 +378,18 @@ def unpack_uatype(vtype, data):
             raise UaError("can not unpack unknown vtype {0!s}".format(vtype))
 
 
-def unpack_uatype_array(vtype, data):
+def unpack_uatype_array(vtype, data, container=None):
+    """
+    unpack an array of vtype
+    container select the type returned for arrays of fixed size numbers,
+    if None the one given to set_array_container is used
+    """
     if hasattr(Primitives, vtype.name):
         st = getattr(Primitives, vtype.name)
+        if isinstance(st, _Primitive1):
+            if container is None:
+                container = _array_container
+            return st.unpack_array(data, container)
         return st.unpack_array(data)
     else:
         length = Primitives.Int32.unpack(data)
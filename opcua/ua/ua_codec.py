@@ -0,0 +1,315 @@
+"""
+Precompiled binary codecs for the structures generated in uaprotocol_auto
+
+The generated to_binary/_binary_init methods pack every field with its own
+Primitives call and join a list of tiny bytes objects. This module builds,
+once per class, a list of encode/decode steps where consecutive fixed-size
+fields are fused into one struct.Struct, and installs them on the classes.
+
+The codec in use can be chosen with set_codec() or with the environment
+variable PYOPCUA_CODEC ("struct", the default, or "generated").
+"""
+
+import os
+import sys
+import struct
+import logging
+import operator
+from enum import Enum
+
+from opcua.ua import ua_binary as uabin
+from opcua.ua import uaprotocol_auto as auto
+from opcua.ua.uatypes import StatusCode
+
+logger = logging.getLogger(__name__)
+
+CODECS = ("generated", "struct")
+
+_current_codec = "generated"
+_generated_methods = {}
+_compiled_methods = {}
+
+
+def _fixed_format(typename):
+    """
+    return struct format character of a fixed size primitive, or None
+    """
+    prim = getattr(uabin.Primitives1, typename, None)
+    if prim is None:
+        return None
+    fmt = prim.format
+    if isinstance(fmt, bytes):
+        fmt = fmt.decode()
+    return fmt[1:]
+
+
+class _Field(object):
+    """
+    describe how one field of a generated class is serialized
+    """
+
+    def __init__(self, name, typename, is_array):
+        self.name = name
+        self.typename = typename
+        self.is_array = is_array
+        self.fmt = None  # struct format char if the field has a fixed size
+        self.to_wire = None  # conversion applied before struct packing
+        self.from_wire = None  # conversion applied after struct unpacking
+        self.klass = None
+        klass = getattr(auto, typename, None)
+        if typename == "DateTime":
+            self.fmt = "q"
+            self.to_wire = uabin.datetime_to_win_epoch
+            self.from_wire = uabin.win_epoch_to_datetime
+        elif typename == "StatusCode":
+            self.fmt = "I"
+            self.to_wire = operator.attrgetter("value")
+            self.from_wire = StatusCode
+        elif isinstance(klass, type) and issubclass(klass, Enum):
+            self.fmt = "I"
+            self.to_wire = operator.attrgetter("value")
+            self.from_wire = klass
+        elif _fixed_format(typename) is not None:
+            self.fmt = _fixed_format(typename)
+        elif not hasattr(uabin.Primitives, typename):
+            if klass is None:
+                raise ValueError("Unknown ua type {0}".format(typename))
+            self.klass = klass
+
+    @property
+    def fusable(self):
+        return self.fmt is not None and not self.is_array
+
+
+def _fields_of(klass):
+    """
+    return list of _Field for a generated class, or None if we cannot compile it
+    """
+    if klass.__dict__.get("_binary_init") is None:
+        return None
+    if "Encoding" in klass.ua_types:
+        # classes with switch fields keep their generated code
+        return None
+    try:
+        default = klass()
+    except ValueError:
+        # some generated classes cannot even be instanciated with their defaults
+        return None
+    names = set(k for k in default.__dict__ if k != "_freeze")
+    if names != set(klass.ua_types.keys()):
+        return None
+    return [_Field(name, typename, isinstance(getattr(default, name), list))
+            for name, typename in klass.ua_types.items()]
+
+
+def _split_runs(fields):
+    """
+    group consecutive fixed size scalar fields together
+    """
+    runs = []
+    for field in fields:
+        if field.fusable and runs and isinstance(runs[-1], list):
+            runs[-1].append(field)
+        elif field.fusable:
+            runs.append([field])
+        else:
+            runs.append(field)
+    return runs
+
+
+def _run_encoder(run):
+    st = struct.Struct("<" + "".join(f.fmt for f in run))
+    getter = operator.attrgetter(*[f.name for f in run])
+    convs = [f.to_wire for f in run]
+    pack = st.pack
+    if len(run) == 1:
+        conv = convs[0]
+        if conv is None:
+            return lambda obj: pack(getter(obj))
+        return lambda obj: pack(conv(getter(obj)))
+    if not any(convs):
+        return lambda obj: pack(*getter(obj))
+
+    def encode(obj):
+        return pack(*[val if conv is None else conv(val) for conv, val in zip(convs, getter(obj))])
+    return encode
+
+
+def _run_decoder(run):
+    st = struct.Struct("<" + "".join(f.fmt for f in run))
+    names = [f.name for f in run]
+    convs = [f.from_wire for f in run]
+    unpack = st.unpack
+    size = st.size
+    if not any(convs):
+        def decode(data, attrs):
+            attrs.update(zip(names, unpack(data.read(size))))
+    else:
+        def decode(data, attrs):
+            vals = unpack(data.read(size))
+            attrs.update(zip(names, [val if conv is None else conv(val) for conv, val in zip(convs, vals)]))
+    return decode
+
+
+def _field_encoder(field):
+    getter = operator.attrgetter(field.name)
+    pack_length = uabin.Primitives.Int32.pack
+    if field.typename == "ExtensionObject":
+        pack_one = auto.extensionobject_to_binary
+    elif field.klass is not None or field.typename == "StatusCode":
+        pack_one = None
+    else:
+        pack_one = getattr(uabin.Primitives, field.typename).pack
+    if not field.is_array:
+        if pack_one is None:
+            return lambda obj: getter(obj).to_binary()
+        return lambda obj: pack_one(getter(obj))
+
+    if hasattr(uabin.Primitives, field.typename):
+        pack_array = getattr(uabin.Primitives, field.typename).pack_array
+        return lambda obj: pack_array(getter(obj))
+
+    if pack_one is None:
+        def encode(obj):
+            vals = getter(obj)
+            return pack_length(len(vals)) + b"".join([val.to_binary() for val in vals])
+    else:
+        def encode(obj):
+            vals = getter(obj)
+            return pack_length(len(vals)) + b"".join([pack_one(val) for val in vals])
+    return encode
+
+
+def _field_decoder(field):
+    name = field.name
+    unpack_length = uabin.Primitives.Int32.unpack
+    if field.typename == "ExtensionObject":
+        unpack_one = auto.extensionobject_from_binary
+    elif field.typename == "StatusCode":
+        unpack_one = StatusCode.from_binary
+    elif field.klass is not None:
+        klass = field.klass
+        unpack_one = None
+    else:
+        unpack_one = getattr(uabin.Primitives, field.typename).unpack
+    if not field.is_array:
+        if unpack_one is None:
+            def decode(data, attrs):
+                attrs[name] = klass.from_binary(data)
+        else:
+            def decode(data, attrs):
+                attrs[name] = unpack_one(data)
+        return decode
+
+    if hasattr(uabin.Primitives, field.typename):
+        unpack_array = getattr(uabin.Primitives, field.typename).unpack_array
+
+        def decode(data, attrs):
+            attrs[name] = unpack_array(data)
+        return decode
+
+    def decode(data, attrs):
+        length = unpack_length(data)
+        if length == -1:
+            attrs[name] = []
+            return
+        unpack = unpack_one if unpack_one is not None else klass.from_binary
+        attrs[name] = [unpack(data) for _ in range(length)]
+    return decode
+
+
+def compile_class(klass):
+    """
+    build fused to_binary, from_binary and _binary_init methods for a class
+    generated in uaprotocol_auto.
+    Returns a dict of methods or None if the class cannot be compiled
+    """
+    fields = _fields_of(klass)
+    if fields is None:
+        return None
+    encoders = []
+    decoders = []
+    for run in _split_runs(fields):
+        if isinstance(run, list):
+            encoders.append(_run_encoder(run))
+            decoders.append(_run_decoder(run))
+        else:
+            encoders.append(_field_encoder(run))
+            decoders.append(_field_decoder(run))
+
+    if len(encoders) == 1:
+        to_binary = encoders[0]
+    else:
+        def to_binary(self):
+            return b"".join([encode(self) for encode in encoders])
+
+    def _binary_init(self, data):
+        attrs = self.__dict__
+        for decode in decoders:
+            decode(data, attrs)
+
+    new = object.__new__
+
+    def from_binary(data):
+        obj = new(klass)
+        attrs = obj.__dict__
+        for decode in decoders:
+            decode(data, attrs)
+        attrs["_freeze"] = True
+        return obj
+
+    return {"to_binary": to_binary,
+            "from_binary": staticmethod(from_binary),
+            "_binary_init": _binary_init}
+
+
+def _generated_classes():
+    for name in dir(auto):
+        klass = getattr(auto, name)
+        if isinstance(klass, type) and klass.__module__ == auto.__name__ and hasattr(klass, "ua_types"):
+            yield klass
+
+
+def _compile_all():
+    for klass in _generated_classes():
+        try:
+            methods = compile_class(klass)
+        except Exception:
+            logger.exception("Could not compile codec for %s, using generated code", klass.__name__)
+            continue
+        if methods is None:
+            continue
+        _generated_methods[klass] = dict((key, klass.__dict__[key]) for key in methods)
+        _compiled_methods[klass] = methods
+
+
+def set_codec(name):
+    """
+    select the codec used by the classes of uaprotocol_auto
+    "generated" uses the per field methods from the generated code,
+    "struct" uses precompiled codecs with fused struct formats.
+    """
+    global _current_codec
+    if name not in CODECS:
+        raise ValueError("Unknown codec {0}, available codecs are {1}".format(name, CODECS))
+    if name == "struct" and not _compiled_methods:
+        if sys.version_info < (3, 6):
+            # field order is taken from ua_types which is only ordered on 3.6+
+            logger.warning("struct codec requires python 3.6 or newer, using generated codec")
+            return
+        _compile_all()
+    methods = _compiled_methods if name == "struct" else _generated_methods
+    for klass, meths in methods.items():
+        for key, meth in meths.items():
+            setattr(klass, key, meth)
+    _current_codec = name
+
+
+def get_codec():
+    """
+    return the name of the codec currently in use
+    """
+    return _current_codec
+
+
+set_codec(os.environ.get("PYOPCUA_CODEC", "struct"))
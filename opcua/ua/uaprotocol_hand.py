@@ -362,6 +362,7 @@ class MessageChunk(uatypes.FrozenClass):
         self.SequenceHeader = SequenceHeader()
         self.Body = body
         self._security_policy = security_policy
+        self._body_buffer = None
 
     @staticmethod
     def from_binary(security_policy, data):
@@ -384,17 +385,28 @@ class MessageChunk(uatypes.FrozenClass):
         obj = MessageChunk(crypto)
         obj.MessageHeader = header
         obj.SecurityHeader = security_header
-        decrypted = crypto.decrypt(data.read(len(data)))
         signature_size = crypto.vsignature_size()
-        if signature_size > 0:
-            signature = decrypted[-signature_size:]
-            decrypted = decrypted[:-signature_size]
-            crypto.verify(obj.MessageHeader.to_binary() + obj.SecurityHeader.to_binary() + decrypted, signature)
-        data = utils.Buffer(crypto.remove_padding(decrypted))
+        if signature_size > 0 or crypto.encrypted_block_size() != 1:
+            decrypted = crypto.decrypt(data.read(len(data)))
+            if signature_size > 0:
+                signature = decrypted[-signature_size:]
+                decrypted = decrypted[:-signature_size]
+                crypto.verify(obj.MessageHeader.to_binary() + obj.SecurityHeader.to_binary() + decrypted, signature)
+            data = utils.Buffer(crypto.remove_padding(decrypted))
+        # else nothing to decrypt or verify, keep reading the received data in place
         obj.SequenceHeader = SequenceHeader.from_binary(data)
-        obj.Body = data.read(len(data))
+        obj._body_buffer = data.copy()
+        obj.Body = data.read_view(len(data))
         return obj
 
+    def body_buffer(self):
+        """
+        return a Buffer over the chunk body, without copying received data
+        """
+        if self._body_buffer is not None:
+            return self._body_buffer.copy()
+        return utils.Buffer(self.Body)
+
     def encrypted_size(self, plain_size):
         size = plain_size + self._security_policy.signature_size()
         pbs = self._security_policy.plain_block_size()
@@ -477,6 +489,9 @@ class Message(object):
         return self._chunks[0].SecurityHeader
 
     def body(self):
+        if len(self._chunks) == 1:
+            return self._chunks[0].body_buffer()
+        # chunks must be contiguous to be decoded, this is the only copy of their bodies
         body = b"".join([c.Body for c in self._chunks])
         return utils.Buffer(body)
 
@@ -676,7 +691,7 @@ class SecureConnection(object):
         if msg.MessageHeader.ChunkType == ChunkType.Intermediate:
             return None
         if msg.MessageHeader.ChunkType == ChunkType.Abort:
-            err = ErrorMessage.from_binary(utils.Buffer(msg.Body))
+            err = ErrorMessage.from_binary(msg.body_buffer())
             logger.warning("Message %s aborted: %s", msg, err)
             # specs Part 6, 6.7.3 say that aborted message shall be ignored
             # and SecureChannel should not be closed
@@ -9,6 +9,7 @@ import os
 import uuid
 import re
 import itertools
+from array import array as array_type
 
 from opcua.ua import ua_binary as uabin
 from opcua.ua import status_codes
@@ -17,6 +18,12 @@ from opcua.ua.uaerrors import UaError
 from opcua.ua.uaerrors import UaStatusCodeError
 from opcua.ua.uaerrors import UaStringParsingError
 
+try:
+    import numpy
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+
 
 if sys.version_info.major > 2:
     unicode = str
@@ -749,12 +756,15 @@ class Variant(FrozenClass):
     """
 
     def __init__(self, value=None, varianttype=None, dimensions=None, is_array=None):
+        if _is_ndarray(value) and value.ndim == 0:
+            # a 0-d array holds a scalar
+            value = value.item()
         self.Value = value
         self.VariantType = varianttype
         self.Dimensions = dimensions
         self.is_array = is_array
         if self.is_array is None:
-            if isinstance(value, (list, tuple)):
+            if isinstance(value, (list, tuple, array_type, memoryview)) or _is_ndarray(value):
                 self.is_array = True
             else:
                 self.is_array = False
@@ -773,16 +783,24 @@ class Variant(FrozenClass):
             dims = get_shape(self.Value)
             if len(dims) > 1:
                 self.Dimensions = dims
+        elif self.Dimensions is None and _is_ndarray(self.Value) and self.Value.ndim > 1:
+            self.Dimensions = list(self.Value.shape)
 
     def __eq__(self, other):
-        if isinstance(other, Variant) and self.VariantType == other.VariantType and self.Value == other.Value:
-            return True
+        if isinstance(other, Variant) and self.VariantType == other.VariantType:
+            if _is_ndarray(self.Value) or _is_ndarray(other.Value):
+                return bool(numpy.array_equal(self.Value, other.Value))
+            if isinstance(self.Value, (array_type, memoryview)) or isinstance(other.Value, (array_type, memoryview)):
+                return _flat_list(self.Value) == _flat_list(other.Value)
+            return self.Value == other.Value
         return False
 
     def __ne__(self, other):
         return not self.__eq__(other)
 
     def _guess_type(self, val):
+        if isinstance(val, (array_type, memoryview)) or _is_ndarray(val):
+            return _guess_buffer_type(val)
         if isinstance(val, (list, tuple)):
             error_val = val
         while isinstance(val, (list, tuple)):
@@ -849,11 +867,76 @@ class Variant(FrozenClass):
         else:
             value = uabin.unpack_uatype(vtype, data)
         if uabin.test_bit(encoding, 6):
-            dimensions = uabin.unpack_uatype_array(VariantType.Int32, data)
-            value = reshape(value, dimensions)
+            dimensions = uabin.unpack_uatype_array(VariantType.Int32, data, list)
+            if isinstance(value, list):
+                value = reshape(value, dimensions)
+            elif _is_ndarray(value) and _product(dimensions) == value.size:
+                value = value.reshape(dimensions)
+            # other array containers stay flat, their shape is in Dimensions
         return Variant(value, vtype, dimensions, is_array=array)
 
 
+_BUFFER_TYPES = {
+    ("f", 4): VariantType.Float,
+    ("d", 8): VariantType.Double,
+    ("b", 1): VariantType.SByte,
+    ("B", 1): VariantType.Byte,
+    ("?", 1): VariantType.Boolean,
+}
+_BUFFER_INT_TYPES = {
+    (True, 2): VariantType.Int16,
+    (True, 4): VariantType.Int32,
+    (True, 8): VariantType.Int64,
+    (False, 2): VariantType.UInt16,
+    (False, 4): VariantType.UInt32,
+    (False, 8): VariantType.UInt64,
+}
+
+
+def _is_ndarray(val):
+    return NUMPY_AVAILABLE and isinstance(val, numpy.ndarray)
+
+
+def _flat_list(val):
+    """
+    elements of an array value as a flat list, array.array and memoryview
+    values are flat, their shape is in the Variant Dimensions
+    """
+    if isinstance(val, (array_type, memoryview)):
+        return val.tolist()
+    if isinstance(val, (list, tuple)):
+        return list(flatten(val))
+    return val
+
+
+def _product(dims):
+    size = 1
+    for dim in dims:
+        size *= dim
+    return size
+
+
+def _guess_buffer_type(val):
+    """
+    guess VariantType of an array.array, memoryview or numpy array from its format
+    """
+    if isinstance(val, array_type):
+        fmt = val.typecode
+        itemsize = val.itemsize
+    elif isinstance(val, memoryview):
+        fmt = val.format.lstrip("@=<")
+        itemsize = val.itemsize
+    else:
+        fmt = val.dtype.char
+        itemsize = val.dtype.itemsize
+    vtype = _BUFFER_TYPES.get((fmt, itemsize))
+    if vtype is None and len(fmt) == 1 and fmt in "hHiIlLqQ":
+        vtype = _BUFFER_INT_TYPES.get((fmt.islower(), itemsize))
+    if vtype is None:
+        raise UaError("Could not guess UA type of array with format {0}, specify UA type".format(fmt))
+    return vtype
+
+
 def reshape(flat, dims):
     subdims = dims[1:]
     subsize = 1
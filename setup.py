@@ -18,7 +18,8 @@ setup(name="freeopcua",
       license="GNU Lesser General Public License v3 or later",
       install_requires=install_requires,
       extras_require={
-          'encryption': ['cryptography']
+          'encryption': ['cryptography'],
+          'numpy': ['numpy']
       },
       classifiers=["Programming Language :: Python",
                    "Programming Language :: Python :: 3",